@@ -29,9 +29,20 @@ Acknowledgements:
 
 # pylint: disable=C0326
 
+import os
 import sys
 import array
+import errno
+import fcntl
 import json
+import mmap
+import select
+import socket
+import stat
+import struct
+import tempfile
+from collections import OrderedDict
+from string import Formatter
 
 # PyUSB
 try:
@@ -42,25 +53,29 @@ except:
     pass # ignore
 
 # libusb1
-import usb1
+try:
+    import usb1
+except ImportError:
+    usb1 = None  # only the hidraw and sim backends work without it
 
 import binascii
 import argparse
-from time import sleep
+import random
+from time import sleep, time
 import traceback
 
 try:
     from pydbus import SystemBus, SessionBus
-    from pydbus.generic import signal
 except ImportError:
     print("pydbus library not installed. Service will not work.");
 
 try:
-    from gi.repository import GLib
+    from gi.repository import GLib, Gio
 except ImportError:
     import glib as GLib
+    Gio = None  # the service publishes itself with GDBus, see GServicePublication
 
-from threading import Semaphore
+from threading import Lock, RLock, Timer, Thread, Condition, Event, current_thread, local
 
 app_version = "0.1"
 
@@ -70,6 +85,9 @@ default_time = 1000
 
 class UsbConstants(object):
     HID_REQ_SET_REPORT=0x09
+    REQUEST_TYPE_CLASS_INTERFACE_OUT=0x21  # ENDPOINT_OUT | RECIPIENT_INTERFACE | TYPE_CLASS
+    HID_REPORT_TYPE_OUTPUT=0x02
+    HID_REPORT_TYPE_FEATURE=0x03
 
 # USB Backends ----------------------------------------------------------------
 
@@ -77,8 +95,15 @@ class UsbBackend(object):
 
     TYPE_PYUSB = 'pyusb'
     TYPE_USB1  = 'usb1'
+    TYPE_SIM   = 'sim'
+    TYPE_HIDRAW = 'hidraw'
+
+    TYPE_DEFAULT = TYPE_USB1 if usb1 is not None else TYPE_HIDRAW  # hidraw needs no library
+
+    DETACH_MANUAL = 'manual'  # detach the kernel driver on connect and re-attach it on disconnect
+    DETACH_AUTO   = 'auto'    # let libusb detach on claim and re-attach on release
 
-    TYPE_DEFAULT = TYPE_USB1
+    DETACH_DEFAULT = DETACH_MANUAL
 
     def __init__(self, vendor_id, product_id, w_index):
         """"""
@@ -94,11 +119,44 @@ class UsbBackend(object):
         self.supports_interrupts = False
 
         self.is_detached = False  # If kernel driver needs to be reattached
+        self.detach_mode = UsbBackend.DETACH_DEFAULT
+        self.detach_count = 0
+        self.attach_count = 0
+
+        self.async_depth = 0  # Max. asynchronous transfers in flight, 0 sends synchronously
+
+        self.trace = None  # UsbTraceWriter capturing the outgoing packets
+
+    @staticmethod
+    def get_backend_class(backend_type):
+        """"""
+        if backend_type == UsbBackend.TYPE_PYUSB:
+            return UsbBackendPyUsb
+        elif backend_type == UsbBackend.TYPE_USB1:
+            return UsbBackendUsb1
+        elif backend_type == UsbBackend.TYPE_SIM:
+            return UsbBackendSim
+        elif backend_type == UsbBackend.TYPE_HIDRAW:
+            return UsbBackendHidraw
+        raise ValueError("Unknown Backend {}".format(backend_type))
+
+    @staticmethod
+    def enumerate_devices(context=None):
+        """
+        Scans the device descriptors without opening any device
+
+        :return: dict of (vendor_id, product_id) -> list of devices
+        """
+        raise NotImplemented()
 
     def get_usb_device(self):
         """"""
         raise NotImplemented()
 
+    def exists(self):
+        """"""
+        return self.get_usb_device() is not None
+
     def connect(self, device=None):
         """"""
         raise NotImplemented()
@@ -107,28 +165,254 @@ class UsbBackend(object):
         """"""
         raise NotImplemented()
 
-    def send_data(self, bm_request_type, bm_request, w_value, data):
-        """"""
+    def close(self):
+        """Frees what the backend keeps open beyond disconnect()"""
+        pass
+
+    def send_data(self, bm_request_type, bm_request, w_value, data, timeout=default_time):
+        """
+        :param timeout: milliseconds the transfer may take
+        """
         pass
 
+    def submit_data(self, bm_request_type, bm_request, w_value, data, callback=None, timeout=default_time):
+        """
+        Sends data asynchronously if supported, returns a UsbTransferFuture
+
+        A packet that cannot be sent raises and its callback is not called, only a transfer failing after
+        it was submitted completes its future with the error.
+        """
+        future = UsbTransferFuture(self, callback)
+        self.trace_packet(bm_request_type, bm_request, w_value, data)
+        self.send_data(bm_request_type, bm_request, w_value, data, timeout)
+        future.set_done()
+        return future
+
+    def get_queue_stats(self):
+        """"""
+        return None
+
+    def queues_transfers(self):
+        """True if submit_data returns before the transfer is done"""
+        return False
+
+    def get_kernel_driver_stats(self):
+        """"""
+        return {"mode": self.detach_mode, "detached": self.detach_count, "attached": self.attach_count}
+
     def read_interrupt(self, endpoint, length, callback=None, user_data=None, timeout=0):
         """"""
         pass
 
-    def handle_events(self):
+    def cancel_interrupt(self, transfer):
+        """Cancels a pending interrupt transfer which was not answered in time"""
+        pass
+
+    def is_transfer_completed(self, transfer):
+        """"""
+        return True
+
+    def handle_events(self, timeout=0):
+        """Handles pending events, blocks at most timeout seconds"""
         pass
 
+    def trace_packet(self, bm_request_type, bm_request, w_value, data):
+        """Captures an outgoing packet if tracing is enabled"""
+        if self.trace is not None:
+            self.trace.write_packet(self.vendor_id, self.product_id, bm_request_type, bm_request, w_value,
+                                    self.to_binary(data))
+
+    def trace_ack(self, latency):
+        """
+        Captures the acknowledge of the last packet if tracing is enabled
+        :param latency: seconds, None if the device did not acknowledge
+        """
+        if self.trace is not None:
+            self.trace.write_ack(self.vendor_id, self.product_id, latency)
+
+    @staticmethod
+    def to_binary(data):
+        """Encoded packets are passed as bytearray, hex strings are still accepted"""
+        if isinstance(data, bytearray):
+            return data
+        return bytearray(binascii.unhexlify(data))
+
+    def _log_data(self, prefix, data):
+        if self.verbose:
+            if isinstance(data, bytearray):
+                data = binascii.hexlify(data).decode("ascii")
+            print("{} '{}'".format(prefix, data))
+
     def _log(self, msg):
         if self.verbose:
             print(msg)
 
 
+class UsbTransferFuture(object):
+    """Completion of an asynchronously submitted transfer"""
+
+    def __init__(self, backend, callback=None):
+        """
+        :param backend: UsbBackend
+        :param callback: called with the future when the transfer is done
+        """
+        self.backend = backend
+        self.callback = callback
+        self.is_done = False
+        self.error = None
+        self.submitted_at = time()
+        self.completed_at = None
+
+    def set_done(self, error=None):
+        self.is_done = True
+        self.error = error
+        self.completed_at = time()
+        if self.callback is not None:
+            self.callback(self)
+
+    def done(self):
+        return self.is_done
+
+    def wait(self, timeout=None):
+        """Handles backend events until the transfer is done, returns False on timeout"""
+        deadline = None if timeout is None else time() + timeout
+        while not self.is_done:
+            remaining = 1.0 if deadline is None else deadline - time()
+            if remaining <= 0:
+                return False
+            self.backend.handle_events(remaining)
+        return True
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise GDeviceException("Transfer did not complete in time")
+        if self.error is not None:
+            raise GDeviceException("Transfer failed: {}".format(self.error))
+
+
+class UsbTraceRecord(object):
+    """Packet or acknowledge read from a trace file"""
+
+    KIND_PACKET = 1
+    KIND_ACK    = 2
+
+    def __init__(self, kind, timestamp, vendor_id, product_id):
+        self.kind = kind
+        self.timestamp = timestamp  # seconds since the start of the trace
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+
+        # packets
+        self.bm_request_type = None
+        self.bm_request = None
+        self.w_value = None
+        self.data = None  # bytearray
+
+        # acknowledges
+        self.latency = None  # seconds, None if the device did not acknowledge
+
+
+class UsbTraceWriter(object):
+    """
+    Writes the outgoing packets and their acknowledges to a binary trace file
+
+    File format (little endian): header "GLTR", version (B), start time (d), followed by records
+    starting with their kind (B) and the seconds since the start (d), vendor id (H), product id (H).
+    Packets continue with bmRequestType (B), bRequest (B), wValue (H), length (H) and the payload,
+    acknowledges with the latency in milliseconds (f), negative if the device did not acknowledge.
+    """
+
+    MAGIC = b"GLTR"
+    VERSION = 1
+
+    HEADER = struct.Struct("<4sBd")
+    RECORD = struct.Struct("<BdHH")
+    PACKET = struct.Struct("<BBHH")
+    ACK    = struct.Struct("<f")
+
+    def __init__(self, filename):
+        """"""
+        self.filename = filename
+        self.started_at = time()
+        self.lock = Lock()  # devices are used from several threads
+        self.packets = 0
+        self.acks = 0
+        self.file = open(filename, "wb")
+        self.file.write(UsbTraceWriter.HEADER.pack(UsbTraceWriter.MAGIC, UsbTraceWriter.VERSION, self.started_at))
+
+    def write_packet(self, vendor_id, product_id, bm_request_type, bm_request, w_value, data):
+        record = UsbTraceWriter.RECORD.pack(UsbTraceRecord.KIND_PACKET, time() - self.started_at, vendor_id, product_id) \
+            + UsbTraceWriter.PACKET.pack(bm_request_type, bm_request, w_value, len(data)) + bytes(data)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(record)
+                self.packets += 1
+
+    def write_ack(self, vendor_id, product_id, latency):
+        record = UsbTraceWriter.RECORD.pack(UsbTraceRecord.KIND_ACK, time() - self.started_at, vendor_id, product_id) \
+            + UsbTraceWriter.ACK.pack(-1.0 if latency is None else latency * 1000)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(record)
+                self.acks += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    @staticmethod
+    def read(filename):
+        """
+        :return: generator of UsbTraceRecord
+        """
+        with open(filename, "rb") as trace:
+            header = trace.read(UsbTraceWriter.HEADER.size)
+            if len(header) < UsbTraceWriter.HEADER.size:
+                raise ValueError("'{}' is not a trace file".format(filename))
+            magic, version, started_at = UsbTraceWriter.HEADER.unpack(header)
+            if magic != UsbTraceWriter.MAGIC or version != UsbTraceWriter.VERSION:
+                raise ValueError("'{}' is not a trace file of version {}".format(filename, UsbTraceWriter.VERSION))
+
+            while True:
+                data = trace.read(UsbTraceWriter.RECORD.size)
+                if len(data) < UsbTraceWriter.RECORD.size:
+                    return  # a truncated record is the end of an interrupted capture
+                record = UsbTraceRecord(*UsbTraceWriter.RECORD.unpack(data))
+                if record.kind == UsbTraceRecord.KIND_PACKET:
+                    data = trace.read(UsbTraceWriter.PACKET.size)
+                    if len(data) < UsbTraceWriter.PACKET.size:
+                        return
+                    record.bm_request_type, record.bm_request, record.w_value, length = UsbTraceWriter.PACKET.unpack(data)
+                    record.data = bytearray(trace.read(length))
+                    if len(record.data) < length:
+                        return
+                elif record.kind == UsbTraceRecord.KIND_ACK:
+                    data = trace.read(UsbTraceWriter.ACK.size)
+                    if len(data) < UsbTraceWriter.ACK.size:
+                        return
+                    latency = UsbTraceWriter.ACK.unpack(data)[0]
+                    record.latency = None if latency < 0 else latency / 1000.0
+                else:
+                    raise ValueError("Unknown record {} in trace '{}'".format(record.kind, filename))
+                yield record
+
+
 class UsbBackendPyUsb(UsbBackend):
 
     def __init__(self, vendor_id, product_id, w_index):
         """"""
         super(UsbBackendPyUsb, self).__init__(vendor_id, product_id, w_index)
 
+    @staticmethod
+    def enumerate_devices(context=None):
+        """"""
+        index = {}
+        for usb_device in usb.core.find(find_all=True):
+            index.setdefault((usb_device.idVendor, usb_device.idProduct), []).append(usb_device)
+        return index
+
     def get_usb_device(self):
         """"""
         return usb.core.find(idVendor = self.vendor_id, idProduct = self.product_id)
@@ -147,9 +431,11 @@ class UsbBackendPyUsb(UsbBackend):
         self.digg_info()
 
         # if a kernel driver is attached to the interface detach it, otherwise no data can be send
+        # pyusb has no auto detach, so the kernel driver is always detached manually
         if self.device.is_kernel_driver_active(self.w_index):
             self.device.detach_kernel_driver(self.w_index)
             self.is_detached = True
+            self.detach_count += 1
 
         return self.device
 
@@ -159,11 +445,12 @@ class UsbBackendPyUsb(UsbBackend):
         # reattach kernel driver, otherwise special key will not work
         if self.is_detached:
             self.device.attach_kernel_driver(self.w_index)
+            self.is_detached = False
+            self.attach_count += 1
 
-    def send_data(self, bm_request_type, bm_request, w_value, data):
-        # decode data to binary and send it
-        self._log(">> '{}'".format(data))
-        self.device.ctrl_transfer(bm_request_type, bm_request, w_value, self.w_index, binascii.unhexlify(data), 1000)
+    def send_data(self, bm_request_type, bm_request, w_value, data, timeout=default_time):
+        self._log_data(">>", data)
+        self.device.ctrl_transfer(bm_request_type, bm_request, w_value, self.w_index, self.to_binary(data), timeout)
 
     def read_interrupt(self, endpoint, length, callback=None, user_data=None, timeout=0):
         """"""
@@ -196,12 +483,34 @@ class UsbBackendPyUsb(UsbBackend):
 
 class UsbBackendUsb1(UsbBackend):
 
-    def __init__(self, vendor_id, product_id, w_index):
-        """"""
+    context_creations = 0  # number of libusb contexts created by this process
+
+    def __init__(self, vendor_id, product_id, w_index, context=None):
+        """
+        :param context: usb1.USBContext shared with other backends, a private one is created if None
+        """
         super(UsbBackendUsb1, self).__init__(vendor_id, product_id, w_index)
-        self.context = None
+        self.context = context
+        self.owns_context = context is None
+        self.is_auto_detached = False  # If libusb re-attaches the kernel driver on release
         self.interface = None
         self.supports_interrupts = True
+        self.cancelled_transfers = []  # keeps cancelled transfers alive until libusb is done with them
+        self.in_flight = []            # submitted control transfers
+        self.queue_stats = {"submitted": 0, "completed": 0, "failed": 0, "full": 0, "max_depth": 0}
+
+    @staticmethod
+    def enumerate_devices(context=None):
+        """"""
+        index = {}
+        for usb_device in context.getDeviceList(skip_on_error=True):
+            index.setdefault((usb_device.getVendorID(), usb_device.getProductID()), []).append(usb_device)
+        return index
+
+    def exists(self):
+        """Checks the device descriptors, the device is not opened"""
+        self._assert_valid_usb_context()
+        return (self.vendor_id, self.product_id) in self.enumerate_devices(self.context)
 
     def get_usb_device(self):
         """"""
@@ -226,9 +535,14 @@ class UsbBackendUsb1(UsbBackend):
 
         # if a kernel driver is attached to the interface detach it, otherwise no data can be send
         if self.device.kernelDriverActive(self.w_index):
-            self._log("Detaching kernel on interface {}".format(self.w_index))
-            self.device.detachKernelDriver(self.w_index)
-            self.is_detached = True
+            if self.detach_mode == UsbBackend.DETACH_AUTO and self._enable_auto_detach():
+                self._log("Kernel on interface {} is detached on claim".format(self.w_index))
+                self.is_auto_detached = True
+            else:
+                self._log("Detaching kernel on interface {}".format(self.w_index))
+                self.device.detachKernelDriver(self.w_index)
+                self.is_detached = True
+            self.detach_count += 1
         else:
             self._log("Kernel not active on interface {}".format(self.w_index))
 
@@ -237,6 +551,9 @@ class UsbBackendUsb1(UsbBackend):
         return self.device
 
     def disconnect(self):
+        # let queued transfers finish before the device is closed
+        self.flush()
+
         # free device resource to be able to reattach kernel driver
         try:
             if self.interface is not None:
@@ -252,12 +569,19 @@ class UsbBackendUsb1(UsbBackend):
         if self.is_detached:
             self._log("Attaching kernel on interface {}".format(self.w_index))
             self.device.attachKernelDriver(self.w_index)
+            self.is_detached = False
+            self.attach_count += 1
+        elif self.is_auto_detached:
+            # libusb already re-attached it when the interface was released
+            self.is_auto_detached = False
+            self.attach_count += 1
 
         if self.device is not None:
             self.device.close()
             self.device = None
 
-        if self.context is not None:
+        # a shared context lives as long as its owner
+        if self.context is not None and self.owns_context:
             self.context.close()
             self.context = None
 
@@ -265,10 +589,82 @@ class UsbBackendUsb1(UsbBackend):
         """"""
         return self.device.claimInterface(self.w_index)
 
-    def send_data(self, bm_request_type, bm_request, w_value, data):
-        # decode data to binary and send it
-        self._log("Send >> '{}'".format(data))
-        self.device.controlWrite(bm_request_type, bm_request, w_value, self.w_index, binascii.unhexlify(data), 1000)
+    def _enable_auto_detach(self):
+        try:
+            self.device.setAutoDetachKernelDriver(True)
+            return True
+        except usb1.USBErrorNotSupported:
+            self._log("Auto detach is not supported, detaching manually")
+            return False
+
+    def send_data(self, bm_request_type, bm_request, w_value, data, timeout=default_time):
+        self._log_data("Send >>", data)
+        self.device.controlWrite(bm_request_type, bm_request, w_value, self.w_index, self.to_binary(data), timeout)
+
+    def submit_data(self, bm_request_type, bm_request, w_value, data, callback=None, timeout=default_time):
+        """Queues an asynchronous control write, blocks while async_depth transfers are in flight"""
+        if self.async_depth <= 0:
+            return super(UsbBackendUsb1, self).submit_data(bm_request_type, bm_request, w_value, data, callback,
+                                                           timeout)
+
+        deadline = time() + timeout / 1000.0
+        if len(self.in_flight) >= self.async_depth:
+            self.queue_stats["full"] += 1
+            while len(self.in_flight) >= self.async_depth:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise GDeviceException("Transfer queue did not drain in time")
+                self.handle_events(remaining)
+
+        self._log_data("Submit >>", data)
+        self.trace_packet(bm_request_type, bm_request, w_value, data)
+        future = UsbTransferFuture(self, callback)
+        transfer = self.device.getTransfer() # type: usb1.USBTransfer
+        transfer.setControl(bm_request_type, bm_request, w_value, self.w_index, self.to_binary(data),
+                            callback=self._on_transfer_done, user_data=future,
+                            timeout=max(1, int((deadline - time()) * 1000)))
+        transfer.submit()
+
+        self.in_flight.append(transfer)
+        self.queue_stats["submitted"] += 1
+        self.queue_stats["max_depth"] = max(self.queue_stats["max_depth"], len(self.in_flight))
+        return future
+
+    def flush(self, timeout=None):
+        """Waits until all queued transfers are done"""
+        if timeout is None:
+            timeout = default_time / 1000.0
+        deadline = time() + timeout
+        while len(self.in_flight) > 0:
+            remaining = deadline - time()
+            if remaining <= 0:
+                self._log("{} transfers still in flight".format(len(self.in_flight)))
+                return False
+            self.handle_events(remaining)
+        return True
+
+    def _on_transfer_done(self, transfer):
+        if transfer in self.in_flight:
+            self.in_flight.remove(transfer)
+
+        future = transfer.getUserData() # type: UsbTransferFuture
+        if self.is_transfer_completed(transfer):
+            self.queue_stats["completed"] += 1
+            future.set_done()
+        else:
+            self.queue_stats["failed"] += 1
+            future.set_done("status {}".format(transfer.getStatus()))
+
+    def queues_transfers(self):
+        """"""
+        return self.async_depth > 0
+
+    def get_queue_stats(self):
+        """"""
+        stats = dict(self.queue_stats)
+        stats["depth"] = len(self.in_flight)
+        stats["max_allowed"] = self.async_depth
+        return stats
 
     def read_interrupt(self, endpoint, length, callback=None, user_data=None, timeout=0):
         """"""
@@ -277,12 +673,445 @@ class UsbBackendUsb1(UsbBackend):
         transfer.submit()
         return transfer
 
+    def cancel_interrupt(self, transfer):
+        """"""
+        self.cancelled_transfers = [t for t in self.cancelled_transfers if t.isSubmitted()]
+        if transfer is not None and transfer.isSubmitted():
+            try:
+                transfer.cancel()
+                self.cancelled_transfers.append(transfer)
+            except usb1.USBError as ex:
+                self._log("Exception while cancelling transfer: {}".format(ex))
+
+    def is_transfer_completed(self, transfer):
+        """"""
+        return transfer.getStatus() == usb1.TRANSFER_COMPLETED
+
     def handle_events(self, timeout=0):
+        """Blocks in libusb until an event arrives or timeout seconds are over"""
         self.context.handleEventsTimeout(timeout)
 
     def _assert_valid_usb_context(self):
         if self.context is None:
-            self.context = usb1.USBContext()
+            self.context = UsbBackendUsb1.create_context()
+            self.owns_context = True
+
+    @staticmethod
+    def create_context():
+        """"""
+        if usb1 is None:
+            raise GDeviceException("The usb1 backend needs the python library libusb1 (pip install libusb1)")
+        UsbBackendUsb1.context_creations += 1
+        return usb1.USBContext()
+
+class UsbSimDevice(object):
+    """A simulated G-Device on the UsbSimBus"""
+
+    def __init__(self, vendor_id, product_id):
+        """"""
+        self.vendor_id  = vendor_id
+        self.product_id = product_id
+
+        self.present = True
+        self.kernel_driver_active = True
+        self.claimed_by = None  # UsbBackendSim
+
+        # latency and ack model, in seconds
+        self.latency = 0.0005        # duration of a control write
+        self.latency_jitter = 0.0    # control writes take latency +- jitter (uniform)
+        self.ack_delay = 0.001       # from the end of a control write until its interrupt ack
+        self.ack_jitter = 0.0
+
+        # injected faults
+        self.error_rate = 0.0  # probability that a control write fails
+        self.stall_rate = 0.0  # probability that a command is never acknowledged
+
+        self.packets = []  # (timestamp, bm_request_type, bm_request, w_value, bytearray) of every control write
+
+    def configure(self, **options):
+        """Sets any of the latency, ack and fault attributes"""
+        for name, value in options.items():
+            if not hasattr(self, name):
+                raise ValueError("Unknown option '{}'".format(name))
+            self.__setattr__(name, value)
+        return self
+
+    def draw(self, value, jitter):
+        if jitter <= 0:
+            return value
+        return max(0.0, UsbSimBus.random.uniform(value - jitter, value + jitter))
+
+    def clear_packets(self):
+        self.packets = []
+
+
+class UsbSimBus(object):
+    """The simulated devices seen by UsbBackendSim, shared by the whole process"""
+
+    devices = {}  # (vendor_id, product_id) -> UsbSimDevice
+    random = random.Random(0)
+
+    @staticmethod
+    def add_device(vendor_id, product_id):
+        """Returns the simulated device, it is created on first use"""
+        key = (vendor_id, product_id)
+        if key not in UsbSimBus.devices:
+            UsbSimBus.devices[key] = UsbSimDevice(vendor_id, product_id)
+        return UsbSimBus.devices[key]
+
+    @staticmethod
+    def get_device(vendor_id, product_id):
+        """"""
+        return UsbSimBus.devices.get((vendor_id, product_id))
+
+    @staticmethod
+    def reset(seed=0):
+        UsbSimBus.devices = {}
+        UsbSimBus.random = random.Random(seed)
+
+
+class UsbPendingTransfer(object):
+    """Interrupt transfer of the backends not based on libusb"""
+
+    STATUS_PENDING   = 'pending'
+    STATUS_COMPLETED = 'completed'
+    STATUS_TIMED_OUT = 'timed_out'
+
+    def __init__(self, callback, user_data, timeout):
+        self.callback = callback
+        self.user_data = user_data
+        self.expires_at = time() + timeout / 1000.0 if timeout > 0 else None
+        self.ack_at = None
+        self.status = UsbPendingTransfer.STATUS_PENDING
+        self.data = None
+
+    def getUserData(self):
+        return self.user_data
+
+    def complete(self, status, data=None):
+        self.status = status
+        self.data = data
+        if self.callback is not None:
+            self.callback(self)
+
+
+class UsbBackendSim(UsbBackend):
+    """Emulates a G-Device on the UsbSimBus, no hardware needed"""
+
+    def __init__(self, vendor_id, product_id, w_index):
+        """"""
+        super(UsbBackendSim, self).__init__(vendor_id, product_id, w_index)
+        self.supports_interrupts = True
+        self.is_auto_detached = False
+        self.pending_transfers = []
+
+    @staticmethod
+    def enumerate_devices(context=None):
+        """"""
+        index = {}
+        for key, sim_device in UsbSimBus.devices.items():
+            if sim_device.present:
+                index.setdefault(key, []).append(sim_device)
+        return index
+
+    def get_usb_device(self):
+        """"""
+        sim_device = UsbSimBus.get_device(self.vendor_id, self.product_id)
+        if sim_device is not None and sim_device.present:
+            return sim_device
+        return None
+
+    def connect(self, device=None):
+        if device is None:
+            self.device = self.get_usb_device()
+        else:
+            self.device = device
+
+        # if not found exit
+        if self.device is None:
+            raise ValueError("USB device not found!")
+
+        if self.device.claimed_by is not None and self.device.claimed_by is not self:
+            raise GDeviceException("Interface {} is busy".format(self.w_index))
+
+        if self.device.kernel_driver_active:
+            if self.detach_mode == UsbBackend.DETACH_AUTO:
+                self.is_auto_detached = True
+            else:
+                self.is_detached = True
+            self.device.kernel_driver_active = False
+            self.detach_count += 1
+
+        self.device.claimed_by = self
+        return self.device
+
+    def disconnect(self):
+        if self.device is None:
+            return
+
+        if self.device.claimed_by is self:
+            self.device.claimed_by = None
+
+        if self.is_detached or self.is_auto_detached:
+            self.is_detached = False
+            self.is_auto_detached = False
+            self.device.kernel_driver_active = True
+            self.attach_count += 1
+
+        self.pending_transfers = []
+        self.device = None
+
+    def send_data(self, bm_request_type, bm_request, w_value, data, timeout=default_time):
+        self._log_data("Sim >>", data)
+        sim_device = self._assert_claimed()
+
+        latency = sim_device.draw(sim_device.latency, sim_device.latency_jitter)
+        if latency * 1000 > timeout:
+            sleep(timeout / 1000.0)
+            raise GDeviceException("Simulated transfer timed out")
+        sleep(latency)
+        if sim_device.error_rate > 0 and UsbSimBus.random.random() < sim_device.error_rate:
+            raise GDeviceException("Simulated transfer error")
+
+        sim_device.packets.append((time(), bm_request_type, bm_request, w_value, bytearray(self.to_binary(data))))
+
+        if sim_device.stall_rate > 0 and UsbSimBus.random.random() < sim_device.stall_rate:
+            return  # the device swallows the command
+
+        for transfer in self.pending_transfers:
+            if transfer.ack_at is None:
+                transfer.ack_at = time() + sim_device.draw(sim_device.ack_delay, sim_device.ack_jitter)
+                break
+
+    def read_interrupt(self, endpoint, length, callback=None, user_data=None, timeout=0):
+        """"""
+        self._assert_claimed()
+        transfer = UsbPendingTransfer(callback, user_data, timeout)
+        self.pending_transfers.append(transfer)
+        return transfer
+
+    def cancel_interrupt(self, transfer):
+        """"""
+        if transfer in self.pending_transfers:
+            self.pending_transfers.remove(transfer)
+
+    def is_transfer_completed(self, transfer):
+        """"""
+        return transfer.status == UsbPendingTransfer.STATUS_COMPLETED
+
+    def handle_events(self, timeout=0):
+        """Sleeps until the next ack or transfer timeout is due, at most timeout seconds"""
+        now = time()
+        next_event = None
+        for transfer in self.pending_transfers:
+            for at in (transfer.ack_at, transfer.expires_at):
+                if at is not None and (next_event is None or at < next_event):
+                    next_event = at
+
+        if next_event is None or next_event > now + timeout:
+            if timeout > 0:
+                sleep(timeout)
+            return
+
+        if next_event > now:
+            sleep(next_event - now)
+
+        now = time()
+        for transfer in list(self.pending_transfers):
+            if transfer.ack_at is not None and transfer.ack_at <= now:
+                status = UsbPendingTransfer.STATUS_COMPLETED
+            elif transfer.expires_at is not None and transfer.expires_at <= now:
+                status = UsbPendingTransfer.STATUS_TIMED_OUT
+            else:
+                continue
+            self.pending_transfers.remove(transfer)
+            transfer.complete(status)
+
+    def _assert_claimed(self):
+        if self.device is None or not self.device.present:
+            raise GDeviceException("Simulated device is not attached")
+        if self.device.claimed_by is not self:
+            raise GDeviceException("Interface {} is not claimed".format(self.w_index))
+        return self.device
+
+class UsbBackendHidraw(UsbBackend):
+    """
+    Writes the reports to the hidraw node of the interface, the usbhid kernel driver stays
+    attached, so nothing has to be claimed or detached and libusb is not needed.
+    """
+
+    SYSFS_HIDRAW = "/sys/class/hidraw"
+
+    REPORT_SIZE = 64
+
+    # (vendor_id, product_id) -> path used instead of the node found in sysfs, e.g. a pty for testing
+    device_paths = {}
+
+    def __init__(self, vendor_id, product_id, w_index):
+        """"""
+        super(UsbBackendHidraw, self).__init__(vendor_id, product_id, w_index)
+        self.supports_interrupts = True
+        self.fd = None
+        self.device_path = None
+        self.pending_transfers = []
+
+    @staticmethod
+    def find_hidraw_nodes(sysfs_root=None):
+        """
+        :return: dict of (vendor_id, product_id) -> list with a dict of interface -> device node per device
+        """
+        sysfs_root = sysfs_root or UsbBackendHidraw.SYSFS_HIDRAW
+        devices = OrderedDict()  # (vendor_id, product_id, usb device path) -> {interface: device node}
+        if os.path.isdir(sysfs_root):
+            for name in sorted(os.listdir(sysfs_root)):
+                hid_path = os.path.realpath(os.path.join(sysfs_root, name, "device"))
+                ids = UsbBackendHidraw._read_hid_ids(os.path.join(hid_path, "uevent"))
+                if ids is None:
+                    continue
+                # .../usb1/1-2/1-2:1.1/0003:046D:C336.0005
+                interface_path = os.path.dirname(hid_path)
+                try:
+                    interface = int(os.path.basename(interface_path).rsplit(".", 1)[1])
+                except (IndexError, ValueError):
+                    continue
+                key = ids + (os.path.dirname(interface_path),)
+                devices.setdefault(key, {})[interface] = os.path.join("/dev", name)
+
+        index = {}
+        for key, nodes in devices.items():
+            index.setdefault(key[0:2], []).append(nodes)
+        return index
+
+    @staticmethod
+    def _read_hid_ids(uevent_filename):
+        try:
+            with open(uevent_filename, "r") as uevent:
+                for line in uevent:
+                    if line.startswith("HID_ID="):
+                        # HID_ID=0003:0000046D:0000C336
+                        bus, vendor_id, product_id = line.strip()[len("HID_ID="):].split(":")
+                        return int(vendor_id, 16), int(product_id, 16)
+        except (IOError, OSError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def enumerate_devices(context=None):
+        """"""
+        index = UsbBackendHidraw.find_hidraw_nodes()
+        for key, path in UsbBackendHidraw.device_paths.items():
+            if os.path.exists(path):
+                index[key] = [{None: path}]
+        return index
+
+    def get_usb_device(self):
+        """Returns the path of the hidraw node of the interface"""
+        path = UsbBackendHidraw.device_paths.get((self.vendor_id, self.product_id))
+        if path is not None:
+            return path if os.path.exists(path) else None
+
+        for nodes in UsbBackendHidraw.find_hidraw_nodes().get((self.vendor_id, self.product_id), []):
+            if self.w_index in nodes:
+                return nodes[self.w_index]
+        return None
+
+    def connect(self, device=None):
+        if self.fd is None:
+            self.device_path = device or self.get_usb_device()
+            if self.device_path is None:
+                raise ValueError("USB device not found!")
+            self._log("Opening {}".format(self.device_path))
+            try:
+                self.fd = os.open(self.device_path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError as ex:
+                raise GDeviceException("Could not open '{}': {}".format(self.device_path, ex))
+        self.device = self.device_path
+        return self.device
+
+    def disconnect(self):
+        # nothing was claimed or detached, but the node of an unplugged device is dead for good
+        self.pending_transfers = []
+        self.device = None
+        if self.fd is not None:
+            fd = self.fd
+            self.fd = None
+            os.close(fd)
+
+    def close(self):
+        """"""
+        self.disconnect()
+
+    def send_data(self, bm_request_type, bm_request, w_value, data, timeout=default_time):
+        # the node is non-blocking, a write never waits for the device
+        self._log_data("Write >>", data)
+        if self.fd is None:
+            raise GDeviceException("Device '{}' is not connected".format(self.device_path))
+        data = bytes(self.to_binary(data))  # the first byte is the report id
+        try:
+            if (w_value >> 8) == UsbConstants.HID_REPORT_TYPE_FEATURE:
+                fcntl.ioctl(self.fd, UsbBackendHidraw.hidiocsfeature(len(data)), data)
+            else:
+                os.write(self.fd, data)
+        except (IOError, OSError) as ex:
+            # e.g. ENODEV after the device was unplugged
+            raise GDeviceException("Could not write to '{}': {}".format(self.device_path, ex))
+
+    @staticmethod
+    def hidiocsfeature(length):
+        """ioctl request HIDIOCSFEATURE(len) = _IOC(_IOC_WRITE|_IOC_READ, 'H', 0x06, len)"""
+        return (3 << 30) | (length << 16) | (ord('H') << 8) | 0x06
+
+    def read_interrupt(self, endpoint, length, callback=None, user_data=None, timeout=0):
+        """Input reports of the interface are read from the hidraw node"""
+        transfer = UsbPendingTransfer(callback, user_data, timeout)
+        self.pending_transfers.append(transfer)
+        return transfer
+
+    def cancel_interrupt(self, transfer):
+        """"""
+        if transfer in self.pending_transfers:
+            self.pending_transfers.remove(transfer)
+
+    def is_transfer_completed(self, transfer):
+        """"""
+        return transfer.status == UsbPendingTransfer.STATUS_COMPLETED
+
+    def handle_events(self, timeout=0):
+        """Waits at most timeout seconds for an input report, which completes the oldest pending transfer"""
+        if self.fd is None:
+            return
+
+        now = time()
+        wait = timeout
+        for transfer in self.pending_transfers:
+            if transfer.expires_at is not None:
+                wait = min(wait, max(0.0, transfer.expires_at - now))
+
+        readable, _, _ = select.select([self.fd], [], [], wait)
+        report = None
+        if readable:
+            try:
+                report = os.read(self.fd, UsbBackendHidraw.REPORT_SIZE)
+            except OSError as ex:
+                if ex.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise GDeviceException("Could not read from '{}': {}".format(self.device_path, ex))
+                report = None
+            if not report:
+                # a stand-in file is always readable, but has nothing to say
+                sleep(wait)
+
+        if report and self.pending_transfers and self._is_ack_report(report):
+            self.pending_transfers.pop(0).complete(UsbPendingTransfer.STATUS_COMPLETED, bytearray(report))
+
+        now = time()
+        for transfer in list(self.pending_transfers):
+            if transfer.expires_at is not None and transfer.expires_at <= now:
+                self.pending_transfers.remove(transfer)
+                transfer.complete(UsbPendingTransfer.STATUS_TIMED_OUT)
+
+    def _is_ack_report(self, report):
+        # the G-Devices answer with HID++ short or long reports
+        return bytearray(report[0:1]) in (bytearray([0x10]), bytearray([0x11]))
 
 # GDevices --------------------------------------------------------------------
 
@@ -291,60 +1120,236 @@ class GDeviceRegistry(object):
 
     STATE_FILE_EXTENSION = ".gstate"
 
-    def __init__(self, backend_type=UsbBackend.TYPE_DEFAULT, verbose=False, strict_filenames=True):
-        """"""
+    def __init__(self, backend_type=UsbBackend.TYPE_DEFAULT, verbose=False, strict_filenames=True, pacing=None,
+                 async_depth=0, detach_mode=UsbBackend.DETACH_DEFAULT, dedup=False, request_timeout=None,
+                 failure_threshold=None, trace_file=None):
+        """
+        :param trace_file: captures all outgoing packets of the devices to this file, see UsbTraceWriter
+        """
         self.verbose = verbose
         self.strict_filenames = strict_filenames
         self.backend_type = backend_type
+        self.pacing = pacing
+        self.async_depth = async_depth
+        self.detach_mode = detach_mode
+        self.dedup = dedup
+        self.request_timeout = request_timeout
+        self.failure_threshold = failure_threshold
+        self.trace = UsbTraceWriter(trace_file) if trace_file is not None else None
         self.known_devices = []
+
+        # presence of the known devices, kept up to date by hotplug events or rescans
+        self.device_index = None  # (vendor_id, product_id) -> list of attached devices, None until the first scan
+        self.presence = None  # device_name_short -> number of attached devices
+        self.last_scan = None
+        self.presence_callbacks = []  # called with (GDevice, is_present) when a device is attached or detached
+        self.pending_presence_events = []
+        self.usb_context = None  # type: usb1.USBContext
+        self.hotplug_handles = []
+        # the frame socket looks up devices from its own threads while the main loop rescans
+        self.lock = RLock()
+
+        self.devices_by_name = {}
         self.init_known_devices()
 
     def init_known_devices(self):
         self.known_devices = [G203(self.backend_type), G213(self.backend_type)]
+        self.devices_by_name = {}
         for known_device in self.known_devices:
             known_device.verbose = self.verbose
+            if self.backend_type == UsbBackend.TYPE_USB1:
+                # one context for all devices, so all interrupt transfers are handled by the same event loop
+                known_device.usb_context = self._get_usb_context()
+            elif self.backend_type == UsbBackend.TYPE_SIM:
+                UsbSimBus.add_device(known_device.id_vendor, known_device.id_product)
+            if self.pacing is not None:
+                known_device.pacing = self.pacing
+            known_device.async_depth = self.async_depth
+            known_device.detach_mode = self.detach_mode
+            known_device.dedup = self.dedup
+            known_device.trace = self.trace
+            if self.request_timeout is not None:
+                known_device.request_timeout = self.request_timeout
+            if self.failure_threshold is not None:
+                known_device.breaker.failure_threshold = self.failure_threshold
+            self.devices_by_name[known_device.device_name_short] = known_device
 
     def find_devices(self):
         """
         :return: GDevice[]
         """
+        with self.lock:
+            self._assert_presence_known()
 
-        found_devices = []
-        for known_device in self.known_devices:
-            if known_device.exists():
-                found_devices.append(known_device)
+            found_devices = []
+            for known_device in self.known_devices:
+                if self.presence[known_device.device_name_short] > 0:
+                    found_devices.append(known_device)
 
-        return found_devices
+            return found_devices
 
     def get_device(self, short_name_filter=None):
-        found_devices = self.find_devices()
-        for found_device in found_devices:
-            if found_device.device_name_short == short_name_filter:
-                return found_device
+        known_device = self.devices_by_name.get(short_name_filter)
+        if known_device is not None and self.is_present(known_device):
+            return known_device
         return None
 
     def get_known_device(self, short_name_filter=None):
+        return self.devices_by_name.get(short_name_filter)
+
+    def get_known_device_by_id(self, vendor_id, product_id):
         for known_device in self.known_devices:
-            if known_device.device_name_short == short_name_filter:
+            if known_device.id_vendor == vendor_id and known_device.id_product == product_id:
                 return known_device
         return None
 
-    def get_state_of_devices(self):
-        states = {}
+    def is_present(self, device):
+        with self.lock:
+            self._assert_presence_known()
+            return self.presence[device.device_name_short] > 0
+
+    def rescan(self):
+        """Rebuilds the device index from a single scan of the device descriptors, nothing is opened"""
+        context = None
+        if self.backend_type == UsbBackend.TYPE_USB1:
+            context = self._get_usb_context()
+
+        backend_class = UsbBackend.get_backend_class(self.backend_type)
+        device_index = backend_class.enumerate_devices(context)
+        with self.lock:
+            self.device_index = device_index
+            self.last_scan = time()
+            self._update_presence()
+
+    def _get_usb_context(self):
+        if self.usb_context is None:
+            self.usb_context = UsbBackendUsb1.create_context()
+        return self.usb_context
+
+    def close(self):
+        """Disconnects all devices and closes the shared libusb context"""
+        self.stop_monitoring()
         for known_device in self.known_devices:
-            states[known_device.device_name_short] = known_device.device_state.as_dict()
-        return states
+            try:
+                if known_device.is_connected:
+                    known_device.disconnect()
+                if known_device.backend is not None:
+                    known_device.backend.close()
+            except Exception as ex:
+                print("Failed to disconnect device '{}': {}".format(known_device.device_name_short, ex))
+            known_device.backend = None
+            known_device.usb_context = None
 
-    def set_state_of_devices(self, states):
-        states = {}
+        if self.usb_context is not None:
+            self.usb_context.close()
+            self.usb_context = None
+
+        if self.trace is not None:
+            self.trace.close()
+
+    def _assert_presence_known(self):
+        if self.device_index is None:
+            self.rescan()
+
+    def _update_presence(self):
+        """Derives the presence table from the index and queues attach/detach events for changed devices"""
+        previous = self.presence
+        presence = {}
         for known_device in self.known_devices:
-            if known_device.device_name_short in states:
-                known_device.device_state.import_dict(states[known_device.device_name_short])
+            attached = self.device_index.get((known_device.id_vendor, known_device.id_product), [])
+            presence[known_device.device_name_short] = len(attached)
+        self.presence = presence
+
+        if previous is None:
+            return
 
-    def restore_states_of_devices(self):
         for known_device in self.known_devices:
-            device_name = known_device.device_name_short
-            try:
+            name = known_device.device_name_short
+            was_present = previous.get(name, 0) > 0
+            is_present = self.presence[name] > 0
+            if was_present != is_present:
+                self.pending_presence_events.append((known_device, is_present))
+
+    def start_monitoring(self):
+        """Keeps the device index up to date with libusb hotplug events, returns False if not supported"""
+        if usb1 is None or not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            self._log("Hotplug is not supported, falling back to rescanning")
+            return False
+
+        context = self._get_usb_context()
+        with self.lock:
+            self.device_index = {}
+            self.presence = None
+            for known_device in self.known_devices:
+                # the already attached devices are enumerated right away
+                self.hotplug_handles.append(context.hotplugRegisterCallback(
+                    self._on_hotplug,
+                    vendor_id=known_device.id_vendor,
+                    product_id=known_device.id_product))
+
+            self._update_presence()
+            self.last_scan = time()
+        return True
+
+    def stop_monitoring(self):
+        if self.usb_context is not None:
+            for handle in self.hotplug_handles:
+                self.usb_context.hotplugDeregisterCallback(handle)
+            self.hotplug_handles = []
+
+    @property
+    def is_monitoring(self):
+        return len(self.hotplug_handles) > 0
+
+    def poll_monitor(self, timeout=0):
+        """Handles pending hotplug events and notifies the presence callbacks"""
+        if self.is_monitoring:
+            self.usb_context.handleEventsTimeout(timeout)
+
+        # libusb does not allow synchronous calls inside hotplug callbacks, so notify afterwards
+        with self.lock:
+            events = self.pending_presence_events
+            self.pending_presence_events = []
+        for device, is_present in events:
+            self._log("Device '{}' {}".format(device.device_name_short, "attached" if is_present else "detached"))
+            for callback in self.presence_callbacks:
+                callback(device, is_present)
+
+    def _on_hotplug(self, context, usb_device, event):
+        key = (usb_device.getVendorID(), usb_device.getProductID())
+        location = (usb_device.getBusNumber(), usb_device.getDeviceAddress())
+
+        with self.lock:
+            attached = [d for d in self.device_index.get(key, [])
+                        if (d.getBusNumber(), d.getDeviceAddress()) != location]
+            if event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED:
+                attached.append(usb_device)
+            self.device_index[key] = attached
+
+            if self.presence is not None:
+                self._update_presence()
+        return False  # stay registered
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def get_state_of_devices(self):
+        states = {}
+        for known_device in self.known_devices:
+            states[known_device.device_name_short] = known_device.device_state.as_dict()
+        return states
+
+    def set_state_of_devices(self, states):
+        states = {}
+        for known_device in self.known_devices:
+            if known_device.device_name_short in states:
+                known_device.device_state.import_dict(states[known_device.device_name_short])
+
+    def restore_states_of_devices(self):
+        for known_device in self.known_devices:
+            device_name = known_device.device_name_short
+            try:
                 known_device.restore_state()
             except Exception as ex:
                 print("Could not restore state of device '{}'".format(device_name))
@@ -376,14 +1381,48 @@ class GDeviceRegistry(object):
 
         self.load_state_from_json(state_json)
 
-    def write_state_of_devices(self, filename):
-        """"""
+    def write_state_of_devices(self, filename, state_json=None):
+        """
+        Replaces the state file atomically, after a crash it holds either the old or the new state
+        :param state_json: state to write, taken from the devices if None
+        :return: False if the file already held the state and was left alone
+        """
         self._assert_valid_state_filename(filename)
-        state_json = self.get_state_as_json()
+        if state_json is None:
+            state_json = self.get_state_as_json()
+
+        mode = 0o644
+        if os.path.exists(filename):
+            fh = open(filename, "r")
+            old_state_json = fh.read()
+            fh.close()
+            if old_state_json == state_json:
+                return False
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temp_filename = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", dir=directory)
+        fh = os.fdopen(fd, "w")
+        try:
+            try:
+                os.fchmod(fh.fileno(), mode)
+                fh.write(state_json)
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+            os.rename(temp_filename, filename)
+        except:
+            os.remove(temp_filename)
+            raise
 
-        fh = open(filename, "w")
-        fh.write(state_json)
-        fh.close()
+        # the rename itself has to reach the disk as well
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return True
 
     def get_state_as_json(self):
         return json.dumps(self.get_state_of_devices(), indent=4)
@@ -456,13 +1495,12 @@ class GValueSpec(object):
         self.max_value = max_value
         self.default_value = default_value
 
-    def format_color_hex(self, value):
-        if value is None:
-            value = self.default_value
-        value = int(value, 16)
-        return self.format_num(value)
+    @property
+    def byte_length(self):
+        """Number of bytes of a value in a binary command, e.g. 2 for '04x'"""
+        return int(self.format[:-1]) // 2
 
-    def format_num(self, value):
+    def clamp(self, value):
         if value is None:
             value = self.default_value
 
@@ -471,7 +1509,172 @@ class GValueSpec(object):
         elif self.max_value is not None and value > self.max_value:
             value = self.max_value
 
-        return format(value, self.format)
+        return value
+
+    def format_color_hex(self, value):
+        if value is None:
+            value = self.default_value
+        value = int(value, 16)
+        return self.format_num(value)
+
+    def format_num(self, value):
+        return format(self.clamp(value), self.format)
+
+    def pack_num(self, value):
+        """Big endian bytes of the clamped value"""
+        value = self.clamp(value)
+        return bytearray((value >> (8 * i)) & 0xff for i in reversed(range(self.byte_length)))
+
+
+class GPacketTemplate(object):
+    """A hex command template compiled into a binary layout with fixed value offsets"""
+
+    def __init__(self, template, specs):
+        """
+        :param template: str e.g. "11ff0e3d{field}01{color}0200000000000000000000"
+        :param specs: dict of placeholder name -> GValueSpec
+        """
+        self.template = template
+        self.values = []  # (name, spec, offset, length)
+
+        layout = ""
+        for literal, name, _, _ in Formatter().parse(template):
+            layout += literal
+            if name:
+                spec = specs[name]
+                self.values.append((name, spec, len(layout) // 2, spec.byte_length))
+                layout += "00" * spec.byte_length
+
+        self.layout = bytes(binascii.unhexlify(layout))
+
+    def encode(self, values):
+        """Patches the values into a copy of the layout, safe to call from several threads"""
+        packet = bytearray(self.layout)
+        for name, spec, offset, length in self.values:
+            packet[offset:offset + length] = spec.pack_num(values.get(name))
+        return packet
+
+
+class GPacketCache(object):
+    """Bounded LRU of fully encoded packets, stored as immutable bytes so callers cannot change them"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.packets = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        packet = self.packets.pop(key, None)
+        if packet is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.packets[key] = packet  # most recently used goes last
+        return packet
+
+    def put(self, key, packet):
+        self.packets.pop(key, None)
+        self.packets[key] = packet
+        while len(self.packets) > self.max_size:
+            self.packets.popitem(last=False)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.packets)}
+
+
+class GLatencyHistogram(object):
+    """Latencies counted in buckets growing by factor 2, cheap enough to record every transfer"""
+
+    BUCKET_BOUNDS = [0.05 * 2 ** i for i in range(18)]  # upper bounds in milliseconds, 0.05 ms to 6.5 s
+
+    def __init__(self):
+        self.counts = [0] * (len(GLatencyHistogram.BUCKET_BOUNDS) + 1)  # the last bucket takes the rest
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        index = 0
+        bounds = GLatencyHistogram.BUCKET_BOUNDS
+        while index < len(bounds) and ms > bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """
+        :param p: percentile between 0 and 100
+        :return: milliseconds, interpolated within the bucket
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        bounds = GLatencyHistogram.BUCKET_BOUNDS
+        for index, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                lower = bounds[index - 1] if index > 0 else 0.0
+                upper = bounds[index] if index < len(bounds) else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count if self.count > 0 else None,
+            "min_ms": self.min,
+            "max_ms": self.max,
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99)
+        }
+
+
+class GLatencyStats(object):
+    """Latency histograms of a device per stage (e.g. transfer, ack) and command (e.g. prepare, color)"""
+
+    STAGE_TRANSFER   = "transfer"    # control transfer from submit until completed
+    STAGE_ACK        = "ack"         # interrupt acknowledging a packet
+    STAGE_PACE       = "pace"        # wait after a packet, for the ack or the fixed timings
+    STAGE_COMMAND    = "command"     # whole command including the prepare packet
+    STAGE_CONNECT    = "connect"
+    STAGE_DISCONNECT = "disconnect"
+
+    COMMAND_DEVICE = "device"  # command name of the stages not caused by a command
+
+    def __init__(self):
+        self.histograms = {}  # (stage, command) -> GLatencyHistogram
+
+    def record(self, stage, command, seconds):
+        key = (stage, command or GLatencyStats.COMMAND_DEVICE)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = GLatencyHistogram()
+            self.histograms[key] = histogram
+        histogram.record(seconds)
+
+    def get_histogram(self, stage, command=None):
+        return self.histograms.get((stage, command or GLatencyStats.COMMAND_DEVICE))
+
+    def reset(self):
+        self.histograms = {}
+
+    def get_stats(self):
+        """:return: dict stage -> command -> statistics"""
+        stats = {}
+        for (stage, command), histogram in self.histograms.items():
+            stats.setdefault(stage, {})[command] = histogram.get_stats()
+        return stats
 
 
 class GDeviceException(Exception):
@@ -482,15 +1685,144 @@ class GControllerException(Exception):
     """"""
 
 
+class GCircuitBreaker(object):
+    """
+    Rejects the commands to a device right away after it failed several times in a row. A failing device is
+    probed after probe_interval seconds, either by the next command or by GDevice.probe().
+    """
+
+    STATE_CLOSED    = 'closed'     # commands go through
+    STATE_OPEN      = 'open'       # commands are rejected
+    STATE_HALF_OPEN = 'half_open'  # one probe is allowed, its outcome closes or opens the breaker again
+
+    DEFAULT_FAILURE_THRESHOLD = 3
+    DEFAULT_PROBE_INTERVAL = 5.0
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, probe_interval=DEFAULT_PROBE_INTERVAL):
+        """"""
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+
+        self.state = GCircuitBreaker.STATE_CLOSED
+        self.opened_at = None
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.rejections = 0
+        self.trips = 0
+        self.probes = 0
+        self.last_error = None
+
+        self.probe_owner = None  # thread sending the probe while half open
+        self.lock = Lock()
+
+    def is_open(self):
+        return self.state == GCircuitBreaker.STATE_OPEN
+
+    def is_due_for_probe(self, now=None):
+        if now is None:
+            now = time()
+        return self.is_open() and now - self.opened_at >= self.probe_interval
+
+    def assert_allows(self, device_name):
+        """
+        Raises a GDeviceException if the device is failing and not due for a probe, the first command after the
+        probe interval becomes the probe and every other command is rejected until its outcome is known
+        """
+        with self.lock:
+            if self.state == GCircuitBreaker.STATE_CLOSED or self.is_probing():
+                return
+            if self.is_due_for_probe():
+                self._begin_probe()
+                return
+            self.rejections += 1
+            if self.state == GCircuitBreaker.STATE_HALF_OPEN:
+                raise GDeviceException("Device '{}' is failing ({}), a probe is in progress".format(
+                    device_name, self.last_error))
+            raise GDeviceException("Device '{}' is failing ({}), retrying in {:.1f} s".format(
+                device_name, self.last_error, self.opened_at + self.probe_interval - time()))
+
+    def is_probing(self):
+        """:return: True if the current thread sends the probe"""
+        return self.state == GCircuitBreaker.STATE_HALF_OPEN and self.probe_owner == current_thread()
+
+    def begin_probe(self):
+        """:return: False if another thread already sends the probe"""
+        with self.lock:
+            if self.state == GCircuitBreaker.STATE_HALF_OPEN and not self.is_probing():
+                return False
+            self._begin_probe()
+            return True
+
+    def _begin_probe(self):
+        self.probes += 1
+        self.state = GCircuitBreaker.STATE_HALF_OPEN
+        self.probe_owner = current_thread()
+
+    def release_probe(self):
+        """Opens the breaker again if the probe of the current thread ended without reaching the device"""
+        with self.lock:
+            if self.is_probing():
+                self.state = GCircuitBreaker.STATE_OPEN
+                self.probe_owner = None
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.state = GCircuitBreaker.STATE_CLOSED
+            self.probe_owner = None
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.state == GCircuitBreaker.STATE_HALF_OPEN \
+                    or (self.state == GCircuitBreaker.STATE_CLOSED
+                        and self.consecutive_failures >= self.failure_threshold):
+                if self.state == GCircuitBreaker.STATE_CLOSED:
+                    self.trips += 1
+                self.state = GCircuitBreaker.STATE_OPEN
+                self.opened_at = time()
+                self.probe_owner = None
+
+    def get_stats(self):
+        """"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failures": self.failures,
+            "rejections": self.rejections,
+            "trips": self.trips,
+            "probes": self.probes,
+            "last_error": self.last_error
+        }
+
+
+class GAckRequest(object):
+    """Interrupt transfer waiting for the device to acknowledge a packet, passed as its user data"""
+
+    def __init__(self, command):
+        """"""
+        self.command = command
+        self.requested_at = time()
+        self.transfer = None  # assigned once submitted, its callback may already have run
+
+
 class GDevice(object):
     """Abstract G-Device"""
 
+    PACING_ACK   = 'ack'    # next packet goes out as soon as the device acknowledged the last one
+    PACING_FIXED = 'fixed'  # always sleep the device timings after each packet
+
+    PACING_DEFAULT = PACING_ACK
+
     def __init__(self, backend_type=UsbBackend.TYPE_DEFAULT):
         """"""
         self.verbose = False;
 
         self.backend_type = backend_type
         self.backend = None # type: UsbBackend
+        self.usb_context = None # type: usb1.USBContext  # shared libusb context, see GDeviceRegistry
 
         self.device_name_short = ""
         self.device_name = ""
@@ -502,6 +1834,7 @@ class GDevice(object):
         self.ep_inter    = None    # Interrupt Endpoint (e.g. 0x82)
 
         self.is_detached = False    # If kernel driver needs to be reattached
+        self.is_connected = False   # If the device is connected and claimed
 
         self.bm_request_type = 0x00   # Device specific
         self.bm_request      = 0x00   # Device specific
@@ -515,10 +1848,32 @@ class GDevice(object):
         # timings
         self.timeout_after_prepare = 0
         self.timeout_after_cmd = 0
+        self.ack_timeout = 0.5  # seconds to wait for the interrupt acknowledging a command
+        self.request_timeout = 1.0  # seconds a command may take, the transfer timeouts are limited by it
+        self.deadline = None  # time() by which the current request has to be done, see send_data_batch
+        self.breaker = GCircuitBreaker()
+        self.latency = GLatencyStats()
+        self.current_command = None  # name of the command of the packet in flight
+        self.trace = None  # UsbTraceWriter passed to the backend, see GDeviceRegistry
+        self.pacing = GDevice.PACING_DEFAULT
+        self.async_depth = 0  # Max. control transfers queued by the backend, 0 sends synchronously
+        self.detach_mode = UsbBackend.DETACH_DEFAULT
+
+        # skip commands that would not change the tracked device_state
+        self.dedup = False
+        self.suppressed_writes = 0
 
         # mutexes
-        self.wait_on_interrupt = False
         self.wait_lock = None
+        self.ack_lock = Lock()  # the acks may be handled by the worker of another device sharing the context
+
+        # interrupt acknowledgement
+        self.ack_requests = []  # GAckRequest still waiting for their ack, oldest first
+        self.ack_count = 0
+        self.ack_timeouts = 0
+        self.ack_latency_total = 0.0
+        self.ack_latency_max = 0.0
+        self.last_ack_latency = None
 
         # value specs
         self.field_spec  = GValueSpec("02x", 0, self.max_color_fields, 0)
@@ -532,17 +1887,23 @@ class GDevice(object):
         self.cmd_breathe = "{color}{speed}{bright}"
         self.cmd_cycle   = "{speed}{bright}"
 
+        # binary commands compiled from the hex format on first use
+        self.templates = None
+        self.packet_cache = GPacketCache()
+
         self.interrupt_length = 20
 
     def _init_backend(self):
         """"""
         if self.backend is None:
-            if self.backend_type == UsbBackend.TYPE_PYUSB:
-                self.backend = UsbBackendPyUsb(self.id_vendor, self.id_product, self.w_index)
-            elif self.backend_type == UsbBackend.TYPE_USB1:
-                self.backend = UsbBackendUsb1(self.id_vendor, self.id_product, self.w_index)
+            backend_class = UsbBackend.get_backend_class(self.backend_type)
+            if self.usb_context is not None:
+                self.backend = backend_class(self.id_vendor, self.id_product, self.w_index, context=self.usb_context)
             else:
-                raise ValueError("Unknown Backend {}".format(self.backend_type))
+                self.backend = backend_class(self.id_vendor, self.id_product, self.w_index)
+            self.backend.async_depth = self.async_depth
+            self.backend.detach_mode = self.detach_mode
+            self.backend.trace = self.trace
 
     def restore_state(self):
         """"""
@@ -551,89 +1912,295 @@ class GDevice(object):
                 has_state = self.device_state.static or self.device_state.breathing or self.device_state.cycling
 
                 if has_state:
-                    if self.device_state.static and self.device_state.colors is not None:
+                    # reuse an already open connection (e.g. a service session)
+                    was_connected = self.is_connected
+                    if not was_connected:
                         self.connect()
-                        try:
+                    try:
+                        if self.device_state.static and self.device_state.colors is not None:
                             if self.device_state.colors_uniform and len(self.device_state.colors) > 0:
-                                self.send_color_command(self.device_state.colors[0], 0)
+                                self.send_color_command(self.device_state.colors[0], 0, force=True)
                             else:
                                 for i, color in enumerate(self.device_state.colors):
                                     if color is not None:
-                                        self.send_color_command(color, i)
-                        finally:
-                            self.disconnect()
+                                        self.send_color_command(color, i, force=True)
 
-                    elif self.device_state.breathing:
-                        self.connect()
-                        try:
+                        elif self.device_state.breathing:
                             if self.device_state.colors is not None and len(self.device_state.colors) > 0:
                                 self.send_breathe_command(
                                         self.device_state.colors[0],
                                         self.device_state.speed,
-                                        self.device_state.brightness)
-                        finally:
-                            self.disconnect()
+                                        self.device_state.brightness,
+                                        force=True)
 
-                    elif self.device_state.cycling:
-                        self.connect()
-                        try:
+                        elif self.device_state.cycling:
                             self.send_cycle_command(
                                     self.device_state.speed,
-                                    self.device_state.brightness)
-                        finally:
+                                    self.device_state.brightness,
+                                    force=True)
+                    finally:
+                        if not was_connected:
                             self.disconnect()
 
     def exists(self):
         """"""
         self._init_backend()
-        return self.backend.get_usb_device() is not None
+        return self.backend.exists()
 
     def connect(self):
         """"""
         self._init_backend()
-        self.backend.connect()
+        started_at = time()
+        try:
+            self.backend.connect()
+        except Exception as ex:
+            self.breaker.record_failure(ex)
+            raise
+        self.latency.record(GLatencyStats.STAGE_CONNECT, None, time() - started_at)
+        self.is_connected = True
 
     def disconnect(self):
         """"""
+        self.is_connected = False
+        started_at = time()
         self.backend.disconnect()
+        self.latency.record(GLatencyStats.STAGE_DISCONNECT, None, time() - started_at)
 
     def on_interrupt(self, sender):
-        self.wait_on_interrupt = False
-        self._log("Received interrupt from sender: {}".format(sender))
+        request = sender.getUserData()  # type: GAckRequest
+        with self.ack_lock:
+            if request not in self.ack_requests:
+                return  # late callback of a transfer that was already given up
+            self.ack_requests.remove(request)
+        if self.backend.is_transfer_completed(sender):
+            self.last_ack_latency = time() - request.requested_at
+            self.ack_count += 1
+            self.ack_latency_total += self.last_ack_latency
+            self.ack_latency_max = max(self.ack_latency_max, self.last_ack_latency)
+            self.latency.record(GLatencyStats.STAGE_ACK, request.command, self.last_ack_latency)
+            self.backend.trace_ack(self.last_ack_latency)
+            self._log("Received interrupt after {:.2f} ms".format(self.last_ack_latency * 1000))
+        else:
+            self.ack_timeouts += 1
+            self.backend.trace_ack(None)
+            self._log("Interrupt transfer ended without data")
 
     def _can_do_interrup(self):
         return self.backend.supports_interrupts and self.ep_inter is not None
 
     def begin_interrupt(self):
         if self._can_do_interrup():
-            self.backend.read_interrupt(endpoint=self.ep_inter, length=self.interrupt_length, callback=self.on_interrupt,
-                                        user_data=None, timeout=5000)
-            self.wait_on_interrupt = True
+            # registered before the transfer is submitted, with a shared context the worker of another device
+            # may handle the acknowledge before read_interrupt returns
+            request = GAckRequest(self.current_command)
+            with self.ack_lock:
+                self.ack_requests.append(request)
+            request.transfer = self.backend.read_interrupt(
+                endpoint=self.ep_inter, length=self.interrupt_length, callback=self.on_interrupt,
+                user_data=request, timeout=int(self.ack_timeout * 1000))
+
+    def end_interrupt(self):
+        """Waits until the device acknowledged the commands sent, returns False if one was not in time"""
+        if not self._can_do_interrup():
+            return False
 
-    def end_interrupt(self): # ChangeMe: stupid busy wait ...
-        if self._can_do_interrup():
-            max_iter = 10000
-            while self.wait_on_interrupt:
-                max_iter = max_iter-1
-                self.backend.handle_events()
-                if max_iter == 0:
-                    self._log("Did not get a interrupt response in time")
-                    # yield # hack ... works but why?
-                    return
+        acknowledged = True
+        while True:
+            with self.ack_lock:
+                if len(self.ack_requests) == 0:
+                    return acknowledged
+                request = self.ack_requests[0]
+
+            deadline = request.requested_at + self.ack_timeout
+            if self.deadline is not None:
+                deadline = min(deadline, self.deadline)
+            remaining = deadline - time()
+            if remaining > 0:
+                self.backend.handle_events(remaining)
+            elif self._give_up_interrupt(request):
+                self._log("Did not get a interrupt response in time")
+                self.ack_timeouts += 1
+                acknowledged = False
+
+    def drop_interrupt(self):
+        """Takes the acknowledges that already arrived without waiting for them, the missing ones are given up"""
+        if not self._can_do_interrup() or len(self.ack_requests) == 0:
+            return
+        self.backend.handle_events(0)
+        with self.ack_lock:
+            missing = list(self.ack_requests)
+        for request in missing:
+            # not a timeout, the fixed timings do not wait for the device
+            self._give_up_interrupt(request)
+
+    def _give_up_interrupt(self, request):
+        """:return: False if the ack arrived meanwhile"""
+        with self.ack_lock:
+            if request not in self.ack_requests:
+                return False
+            self.ack_requests.remove(request)
+        self.backend.trace_ack(None)
+        self.backend.cancel_interrupt(request.transfer)
+        return True
 
-    def send_data(self, data):
-        if self.cmd_prepare is not None:
-            self.begin_interrupt()
-            self.backend.send_data(self.bm_request_type, self.bm_request, self.w_value, self.cmd_prepare)
-            sleep(self.timeout_after_prepare)
-            self.end_interrupt()
+    def get_ack_stats(self):
+        """"""
+        return {
+            "acks": self.ack_count,
+            "timeouts": self.ack_timeouts,
+            "last_ms": None if self.last_ack_latency is None else self.last_ack_latency * 1000,
+            "avg_ms": self.ack_latency_total * 1000 / self.ack_count if self.ack_count > 0 else None,
+            "max_ms": self.ack_latency_max * 1000
+        }
+
+    def compile_templates(self):
+        """Compiles the hex commands into binary packet templates"""
+        specs = {
+            "field":  self.field_spec,
+            "color":  self.color_spec,
+            "speed":  self.speed_spec,
+            "bright": self.bright_spec
+        }
+
+        self.templates = {}
+        for command in ["prepare", "color", "breathe", "cycle"]:
+            template = getattr(self, "cmd_" + command)
+            if template is not None:
+                self.templates[command] = GPacketTemplate(template, specs)
+
+        self.packet_cache = GPacketCache(self.packet_cache.max_size)
+
+    def encode_command(self, command, **values):
+        """
+        :param command: str name of the command e.g. "color"
+        :param values: raw values, colors as hex strings
+        :return: bytearray, a copy the caller may change
+        """
+        key = (command, tuple(sorted(values.items())))
+        packet = self.packet_cache.get(key)
+        if packet is None:
+            if self.templates is None:
+                self.compile_templates()
+            if "color" in values:
+                values["color"] = int(values["color"], 16)
+            packet = bytes(self.templates[command].encode(values))
+            self.packet_cache.put(key, packet)
+        return bytearray(packet)
+
+    def send_data(self, data, command=None):
+        self.send_data_batch([data], command=command)
+
+    def send_data_batch(self, packets, callback=None, command=None):
+        """
+        Sends the prepare command once, followed by all packets
 
+        :param packets: list of encoded packets
+        :param callback: called with the UsbTransferFuture of each packet
+        :param command: name of the command of the packets e.g. "color", used for the latency statistics
+        :return: UsbTransferFuture[]
+        """
+        self.breaker.assert_allows(self.device_name_short)
+
+        # a deadline set by the caller (e.g. the service) already includes the time the request waited
+        own_deadline = self.deadline is None
+        if own_deadline:
+            self.deadline = time() + self.request_timeout
+
+        started_at = time()
+        futures = []
+        commands = []
+        # queued transfers are all submitted before the first is waited for, the frame is paced as a whole
+        pipelined = self.backend.queues_transfers()
+        try:
+            if self.cmd_prepare is not None:
+                futures.append(self._send_packet(self.encode_command("prepare"), self.timeout_after_prepare, callback,
+                                                 "prepare", pace=not pipelined))
+                commands.append("prepare")
+
+            for data in packets:
+                futures.append(self._send_packet(data, self.timeout_after_cmd, callback, command, pace=not pipelined))
+                commands.append(command)
+
+            for future in futures:
+                future.result(self.get_remaining_time())
+            if pipelined and len(futures) > 0:
+                self._pace(self.timeout_after_cmd, command)
+        except Exception as ex:
+            self.breaker.record_failure(ex)
+            raise
+        finally:
+            self.current_command = None
+            # the next request does not wait for the acks of a failed one
+            with self.ack_lock:
+                missing = list(self.ack_requests)
+            for request in missing:
+                self._give_up_interrupt(request)
+            if own_deadline:
+                self.deadline = None
+
+        self.breaker.record_success()
+        for packet_command, future in zip(commands, futures):
+            self.latency.record(GLatencyStats.STAGE_TRANSFER, packet_command, future.completed_at - future.submitted_at)
+        if command is not None:
+            self.latency.record(GLatencyStats.STAGE_COMMAND, command, time() - started_at)
+        return futures
+
+    def get_remaining_time(self):
+        """Seconds left until the deadline of the current request"""
+        if self.deadline is None:
+            return self.request_timeout
+        remaining = self.deadline - time()
+        if remaining <= 0:
+            raise GDeviceException("Deadline of the request exceeded")
+        return remaining
+
+    def _send_packet(self, data, pause, callback=None, command=None, pace=True):
+        timeout = max(1, int(self.get_remaining_time() * 1000))
+        self.current_command = command
         self.begin_interrupt()
-        self.backend.send_data(self.bm_request_type, self.bm_request, self.w_value, data)
-        sleep(self.timeout_after_cmd)
-        self.end_interrupt()
+        future = self.backend.submit_data(self.bm_request_type, self.bm_request, self.w_value, data, callback,
+                                          timeout)
+        if pace:
+            self._pace(pause, command)
+        return future
+
+    def probe(self):
+        """
+        Sends the prepare command to check if a failing device recovered
+        :return: True if the device answered, the breaker is closed again
+        """
+        if not self.breaker.begin_probe():
+            return False
+        self._log("Probing device '{}'".format(self.device_name_short))
+        was_connected = self.is_connected
+        try:
+            if not was_connected:
+                self.connect()
+            try:
+                self.send_data_batch([])
+            finally:
+                if not was_connected:
+                    self.disconnect()
+        except Exception as ex:
+            if self.breaker.is_probing():
+                self.breaker.record_failure(ex)
+            self._log("Probe of device '{}' failed: {}".format(self.device_name_short, ex))
+            return False
+        return True
 
-    def send_colors_command(self, colors):
+    def _pace(self, pause, command=None):
+        """Waits until the device is ready for the next packet"""
+        paced_at = time()
+        if self.pacing == GDevice.PACING_ACK and self._can_do_interrup():
+            # the acknowledges are all we need, end_interrupt has its own deadline
+            self.end_interrupt()
+        else:
+            # backends without interrupts only have the fixed timings
+            sleep(pause)
+            self.drop_interrupt()
+        self.latency.record(GLatencyStats.STAGE_PACE, command, time() - paced_at)
+
+    def send_colors_command(self, colors, force=False):
         """"""
         if len(colors) <= 1:
             if len(colors) == 1:
@@ -641,25 +2208,54 @@ class GDevice(object):
             else:
                 color = "FFFFFF"
 
-            self.send_color_command(color, 0)
+            self.send_color_command(color, 0, force)
 
         elif len(colors) > 1:
-            for i in range(0, min(len(colors), self.max_color_fields)):
-                self.send_color_command(colors[i], i + 1)
-
-    def send_color_command(self, color, field=0):
+            colors = colors[0:self.max_color_fields]
+            for color in colors:
+                GDevice.assert_valid_color(color)
+
+            if len(colors) == 0:
+                return
+
+            state = self.device_state
+            if self._is_suppressed(force, state.static and not state.colors_uniform and state.colors is not None
+                                   and GDevice.same_colors(state.colors[1:len(colors) + 1], colors)):
+                return
+
+            self._log("Set colors {}".format(colors))
+            self.send_data_batch([self.encode_command("color", field=i + 1, color=color) for i, color in enumerate(colors)],
+                                 command="color")
+
+            # the other fields only keep their colors if the device showed static colors before
+            self.device_state.reset(clear_colors=not self.device_state.static)
+            self.device_state.static = True
+            self.device_state.colors_uniform = False
+            for i, color in enumerate(colors):
+                self.device_state.set_color_at(color, i + 1)
+
+    def send_color_command(self, color, field=0, force=False):
         GDevice.assert_valid_color(color)
+
+        state = self.device_state
+        if self._is_suppressed(force, state.static and state.colors_uniform == (field == 0) and state.colors is not None
+                               and GDevice.same_colors(state.colors[field:field + 1], [color])):
+            return
+
         self._log("Set color '{}' at slot {}".format(color, field))
-        self.send_data(self.cmd_color.format(
-                            field=self.field_spec.format_num(field),
-                            color=self.color_spec.format_color_hex(color)))
+        self.send_data(self.encode_command("color", field=field, color=color), "color")
 
-        self.device_state.reset()
+        self.device_state.reset(clear_colors=not self.device_state.static)
         self.device_state.static = True
         self.device_state.colors_uniform = (field == 0)
-        self.device_state.set_color_at(color, field)
+        if field == 0:
+            # field 0 sets every field of the device
+            for i in range(self.max_color_fields + 1):
+                self.device_state.set_color_at(color, i)
+        else:
+            self.device_state.set_color_at(color, field)
 
-    def send_breathe_command(self, color, speed, brightness=None):
+    def send_breathe_command(self, color, speed, brightness=None, force=False):
         if not self.can_breathe:
             raise GDeviceException("Device does not support the breathe effect")
 
@@ -667,10 +2263,12 @@ class GDevice(object):
             brightness = self.bright_spec.max_value
         GDevice.assert_valid_color(color)
 
-        self.send_data(self.cmd_breathe.format(
-                            color=self.color_spec.format_color_hex(color),
-                            speed=self.speed_spec.format_num(speed),
-                            bright=self.bright_spec.format_num(brightness)))
+        state = self.device_state
+        if self._is_suppressed(force, state.breathing and state.speed == speed and state.brightness == brightness
+                               and state.colors is not None and GDevice.same_colors(state.colors[0:1], [color])):
+            return
+
+        self.send_data(self.encode_command("breathe", color=color, speed=speed, bright=brightness), "breathe")
 
         self.device_state.reset()
         self.device_state.breathing = True
@@ -678,26 +2276,48 @@ class GDevice(object):
         self.device_state.brightness = brightness
         self.device_state.set_color_at(color)
 
-    def send_cycle_command(self, speed, brightness=None):
+    def send_cycle_command(self, speed, brightness=None, force=False):
         if not self.can_cycle:
             raise GDeviceException("Device does not support the cycle effect")
 
         if brightness is None:
             brightness = self.bright_spec.max_value
 
-        self.send_data(self.cmd_cycle.format(
-                                speed=self.speed_spec.format_num(speed),
-                                bright=self.bright_spec.format_num(brightness)))
+        state = self.device_state
+        if self._is_suppressed(force, state.cycling and state.speed == speed and state.brightness == brightness):
+            return
+
+        self.send_data(self.encode_command("cycle", speed=speed, bright=brightness), "cycle")
 
         self.device_state.reset()
         self.device_state.cycling = True
         self.device_state.speed = speed
         self.device_state.brightness = brightness
 
+    def _is_suppressed(self, force, unchanged):
+        """Counts and reports a command that can be skipped, because the device already shows what it would set"""
+        if force or not self.dedup or not unchanged:
+            return False
+        # nothing reaches the device, the next command probes it
+        self.breaker.release_probe()
+        self.suppressed_writes += 1
+        self._log("Device already in the requested state, command suppressed")
+        return True
+
     def _log(self, msg):
         if self.verbose:
             print(msg)
 
+    @staticmethod
+    def same_colors(colors_a, colors_b):
+        """Compares lists of hex colors ignoring the case"""
+        if len(colors_a) != len(colors_b):
+            return False
+        for color_a, color_b in zip(colors_a, colors_b):
+            if color_a is None or color_b is None or color_a.lower() != color_b.lower():
+                return False
+        return True
+
     @staticmethod
     def assert_valid_color(color):
         if not GDevice.is_valid_color(color):
@@ -734,7 +2354,7 @@ class G203(GDevice):
 
         self.is_detached = False    # If kernel driver needs to be reattached
 
-        self.bm_request_type = usb1.ENDPOINT_OUT | usb1.RECIPIENT_INTERFACE | usb1.TYPE_CLASS # 0x21
+        self.bm_request_type = UsbConstants.REQUEST_TYPE_CLASS_INTERFACE_OUT # 0x21
         self.bm_request      = UsbConstants.HID_REQ_SET_REPORT # 0x09
         self.w_value         = 0x0211 # ???
 
@@ -794,7 +2414,7 @@ class G213(GDevice):
 
         self.is_detached = False    # If kernel driver needs to be reattached
 
-        self.bm_request_type = usb1.ENDPOINT_OUT | usb1.RECIPIENT_INTERFACE | usb1.TYPE_CLASS # 0x21
+        self.bm_request_type = UsbConstants.REQUEST_TYPE_CLASS_INTERFACE_OUT # 0x21
         self.bm_request      = UsbConstants.HID_REQ_SET_REPORT # 0x09
         self.w_value         = 0x0211 # ???
 
@@ -829,6 +2449,333 @@ class G213(GDevice):
         #                                         |   brightness
         #                                         speed
 
+
+class GBroadcast(object):
+    """Sends the same command to several connected devices at once and measures how far apart they started"""
+
+    # command name -> GDevice method
+    COMMANDS = {
+        "colors":   "send_colors_command",
+        "color_at": "send_color_command",
+        "breathe":  "send_breathe_command",
+        "cycle":    "send_cycle_command"
+    }
+
+    def __init__(self, command, params=None):
+        """
+        :param command: one of COMMANDS
+        :param params: dict of keyword arguments for the GDevice method
+        """
+        if command not in GBroadcast.COMMANDS:
+            raise GControllerException("Unknown broadcast command '{}'".format(command))
+        self.command = command
+        self.params = params or {}
+        self.results = OrderedDict()  # device_name_short -> result of the device
+        self.timings = {}  # device_name_short -> (started_at, finished_at, error)
+
+    def add_error(self, device_name, error):
+        """Reports a device that could not take part"""
+        self.results[device_name] = {"ok": False, "error": str(error), "start_ms": None, "latency_ms": None}
+
+    def send(self, devices, timeout=None):
+        """
+        :param devices: GDevice[] connected devices
+        :param timeout: seconds to wait for the devices, None waits until all are done
+        :return: dict report
+        """
+        start = Event()
+        threads = []
+        for device in devices:
+            thread = Thread(target=self.send_to, args=(device, start),
+                            name="glight-broadcast-" + device.device_name_short)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # all devices are connected, so nothing but the command itself is left between start and the first packet
+        started_at = time()
+        start.set()
+        deadline = None if timeout is None else started_at + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time()))
+
+        return self.finish([device.device_name_short for device in devices], started_at)
+
+    def send_to(self, device, start, timeout=None):
+        """
+        Sends the command to the connected device as soon as start is set
+        :return: the exception of the device or None
+        """
+        if not start.wait(timeout):
+            raise GDeviceException("The other devices were not ready in time")
+        started_at = time()
+        error = None
+        try:
+            getattr(device, GBroadcast.COMMANDS[self.command])(**self.params)
+        except Exception as ex:
+            error = ex
+        self.timings[device.device_name_short] = (started_at, time(), error)
+        return error
+
+    def finish(self, device_names, started_at):
+        """
+        :param device_names: devices the command was sent to
+        :return: dict report
+        """
+        for name in device_names:
+            if name in self.results:
+                continue
+            if name not in self.timings:
+                self.add_error(name, "Did not finish in time")
+                continue
+            device_started_at, finished_at, error = self.timings[name]
+            self.results[name] = {
+                "ok": error is None,
+                "error": None if error is None else str(error),
+                "start_ms": (device_started_at - started_at) * 1000,
+                "latency_ms": (finished_at - device_started_at) * 1000
+            }
+
+        return self.get_report(started_at)
+
+    def get_report(self, started_at=None):
+        starts = [result["start_ms"] for result in self.results.values() if result["start_ms"] is not None]
+        finishes = [result["start_ms"] + result["latency_ms"] for result in self.results.values()
+                    if result["start_ms"] is not None]
+        return {
+            "command": self.command,
+            "ok": all(result["ok"] for result in self.results.values()),
+            "total_ms": max(finishes) if len(finishes) > 0 else 0.0,
+            "start_skew_ms": max(starts) - min(starts) if len(starts) > 0 else 0.0,
+            "devices": self.results
+        }
+
+
+class GBatch(object):
+    """Ordered operations for several devices, validated up front and sent with one connection per device"""
+
+    # operation name -> (required parameters, optional parameters)
+    OPERATIONS = {
+        "colors":   (("colors",), ()),
+        "color_at": (("color",), ("field",)),
+        "breathe":  (("color", "speed"), ("brightness",)),
+        "cycle":    (("speed",), ("brightness",))
+    }
+
+    def __init__(self, operations):
+        """
+        :param operations: dict[] e.g. {"device": "g213", "op": "breathe", "color": "ff0000", "speed": 1000}
+        """
+        self.operations = operations
+        self.results = [None] * len(operations)
+
+    def validate(self, get_device):
+        """
+        Checks every operation before anything is sent
+
+        :param get_device: callable returning the GDevice for a device name or None
+        :raise GControllerException: listing all invalid operations
+        """
+        errors = []
+        for index, operation in enumerate(self.operations):
+            try:
+                self._validate_operation(operation, get_device)
+            except Exception as ex:
+                errors.append("Operation {}: {}".format(index, ex))
+        if len(errors) > 0:
+            raise GControllerException("Invalid batch, nothing was sent. " + " ".join(errors))
+
+    def _validate_operation(self, operation, get_device):
+        if not isinstance(operation, dict):
+            raise GControllerException("Not an object")
+
+        op = operation.get("op")
+        if op not in GBatch.OPERATIONS:
+            raise GControllerException("Unknown operation '{}'".format(op))
+        required, optional = GBatch.OPERATIONS[op]
+        params = set(operation.keys()) - {"device", "op"}
+        missing = set(required) - params
+        if len(missing) > 0:
+            raise GControllerException("Missing parameters {}".format(sorted(missing)))
+        unknown = params - set(required) - set(optional)
+        if len(unknown) > 0:
+            raise GControllerException("Unknown parameters {}".format(sorted(unknown)))
+
+        device = get_device(operation.get("device"))
+        if device is None:
+            raise GControllerException("Device '{}' not found".format(operation.get("device")))
+        if op == "breathe" and not device.can_breathe:
+            raise GControllerException("Device does not support the breathe effect")
+        if op == "cycle" and not device.can_cycle:
+            raise GControllerException("Device does not support the cycle effect")
+        if "field" in operation:
+            GBatch._assert_valid_number("Field", operation["field"], 0, device.max_color_fields)
+        if "speed" in operation:
+            GBatch._assert_valid_number("Speed", operation["speed"], device.speed_spec.min_value,
+                                        device.speed_spec.max_value)
+        if "brightness" in operation:
+            GBatch._assert_valid_number("Brightness", operation["brightness"], device.bright_spec.min_value,
+                                        device.bright_spec.max_value)
+
+        if "colors" in operation:
+            colors = operation["colors"]
+            if not isinstance(colors, list):
+                raise GControllerException("Colors must be a list")
+        else:
+            colors = [operation["color"]] if "color" in operation else []
+        for color in colors:
+            if not isinstance(color, (str, type(u""))):
+                raise GControllerException("Color {!r} is not a string".format(color))
+            GDevice.assert_valid_color(color)
+
+    @staticmethod
+    def _assert_valid_number(name, value, min_value, max_value):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise GControllerException("{} {!r} is not an integer".format(name, value))
+        if not min_value <= value <= max_value:
+            raise GControllerException("{} {} is out of range {} .. {}".format(name, value, min_value, max_value))
+
+    def get_device_names(self):
+        """:return: str[] in the order of their first operation"""
+        device_names = []
+        for operation in self.operations:
+            if operation["device"] not in device_names:
+                device_names.append(operation["device"])
+        return device_names
+
+    def add_error(self, device_name, error):
+        """Reports all operations of a device that could not be connected"""
+        for index, operation in enumerate(self.operations):
+            if operation["device"] == device_name:
+                self.results[index] = {"device": device_name, "op": operation["op"], "ok": False, "error": str(error)}
+
+    def send(self, device_name, device):
+        """
+        Sends the operations of the device in order, the rest is skipped after the first failure
+        :param device: connected GDevice
+        :return: True if all operations of the device were sent
+        """
+        error = None
+        for index, operation in enumerate(self.operations):
+            if operation["device"] != device_name:
+                continue
+            result = {"device": device_name, "op": operation["op"], "ok": False, "error": None}
+            if error is not None:
+                result["error"] = "Skipped after operation {} failed".format(error)
+            else:
+                params = dict((key, value) for key, value in operation.items() if key not in ("device", "op"))
+                try:
+                    getattr(device, GBroadcast.COMMANDS[operation["op"]])(**params)
+                    result["ok"] = True
+                except Exception as ex:
+                    error = index
+                    result["error"] = str(ex)
+            self.results[index] = result
+        return error is None
+
+    def get_report(self):
+        return {
+            "ok": all(result is not None and result["ok"] for result in self.results),
+            "results": self.results
+        }
+
+
+class GTraceReplay(object):
+    """Sends the packets of a trace (see UsbTraceWriter) through GDevice.send_data_batch again"""
+
+    COMMAND = "replay"  # command name in the latency statistics
+
+    def __init__(self, device_registry, speed=1.0, verbose=False):
+        """
+        :param device_registry: GDeviceRegistry
+        :param speed: 1.0 keeps the original timing, 2.0 replays twice as fast, 0 as fast as possible
+        """
+        self.device_registry = device_registry
+        self.speed = speed
+        self.verbose = verbose
+        self.skipped = 0
+
+    def load(self, filename):
+        """
+        Groups the packets into the batches they were sent in: the prepare packet starts a batch
+
+        :return: list of (timestamp, GDevice, packets)
+        """
+        batches = []
+        open_batches = {}  # device_name_short -> packets of the last batch of the device
+        self.skipped = 0
+        for record in UsbTraceWriter.read(filename):
+            if record.kind != UsbTraceRecord.KIND_PACKET:
+                continue
+            device = self.device_registry.get_known_device_by_id(record.vendor_id, record.product_id)
+            if device is None:
+                self.skipped += 1
+                continue
+
+            name = device.device_name_short
+            if device.cmd_prepare is not None and record.data == device.encode_command("prepare"):
+                open_batches[name] = []
+                batches.append((record.timestamp, device, open_batches[name]))
+            elif name in open_batches:
+                open_batches[name].append(record.data)
+            else:
+                # devices without a prepare command send each packet on its own
+                batches.append((record.timestamp, device, [record.data]))
+        return batches
+
+    def run(self, filename):
+        """
+        :return: dict report
+        """
+        batches = self.load(filename)
+        devices = []
+        for timestamp, device, packets in batches:
+            if device not in devices:
+                devices.append(device)
+
+        failed = 0
+        try:
+            for device in devices:
+                device.connect()
+            # connecting is not part of the recorded schedule
+            started_at = time()
+            for timestamp, device, packets in batches:
+                if self.speed > 0:
+                    remaining = started_at + timestamp / self.speed - time()
+                    if remaining > 0:
+                        sleep(remaining)
+                try:
+                    device.send_data_batch(packets, command=GTraceReplay.COMMAND)
+                except Exception as ex:
+                    failed += 1
+                    self._log("Failed to replay packets to device '{}': {}".format(device.device_name_short, ex))
+        finally:
+            for device in devices:
+                if device.is_connected:
+                    device.disconnect()
+
+        latency = {}
+        for device in devices:
+            histogram = device.latency.get_histogram(GLatencyStats.STAGE_COMMAND, GTraceReplay.COMMAND)
+            latency[device.device_name_short] = histogram.get_stats() if histogram is not None else None
+
+        return {
+            "batches": len(batches),
+            "packets": sum(len(packets) + (1 if device.cmd_prepare is not None else 0)
+                           for timestamp, device, packets in batches),
+            "failed": failed,
+            "skipped": self.skipped,
+            "speed": self.speed,
+            "trace_s": batches[-1][0] if len(batches) > 0 else 0.0,
+            "elapsed_s": time() - started_at,
+            "latency": latency
+        }
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+
 # GServices and GClients ------------------------------------------------------
 
 class GlightCommon(object):
@@ -881,21 +2828,38 @@ class GlightController(GlightCommon):
 
     BACKEND_LOCAL = 0
     BACKEND_DBUS = 1
+    BACKEND_SOCKET = 2  # frames only, see GFrameSocketServer
 
-    def __init__(self, backend_type, verbose=False):
-        """"""
+    def __init__(self, backend_type, verbose=False, registry_options=None, idle_timeout=0, frame_socket=None):
+        """
+        :param idle_timeout: seconds a local device stays connected after a command, 0 releases it right away,
+                             None keeps it connected until close()
+        :param frame_socket: path of the frame socket of the service for BACKEND_SOCKET
+        """
         self.verbose = verbose
         self.backend_type = backend_type
+        self.registry_options = registry_options or {}
+        self.frame_socket = frame_socket
         self.client = None  # type: GlightClient
+        self.frame_client = None  # type: GFrameSocketClient
         self.device_registry = None  # type: GDeviceRegistry
+
+        # keeps local devices detached from the kernel during a burst of commands
+        self.idle_timeout = idle_timeout
+        self.device_lock = RLock()
+        self.release_timers = {}  # device_name_short -> Timer
+
         self.init_backend()
 
     def init_backend(self):
         if self.is_con_local:
-            self.device_registry = GDeviceRegistry()
+            self.device_registry = GDeviceRegistry(verbose=self.verbose, **self.registry_options)
         elif self.is_con_dbus:
             self.client = GlightClient()
             self.client.connect()
+        elif self.is_con_socket:
+            self.frame_client = GFrameSocketClient(self.frame_socket, verbose=self.verbose)
+            self.frame_client.connect()
 
     @property
     def is_con_local(self):
@@ -905,7 +2869,16 @@ class GlightController(GlightCommon):
     def is_con_dbus(self):
         return self.backend_type == self.BACKEND_DBUS
 
-    def _assert_supported_backend(self):
+    @property
+    def is_con_socket(self):
+        return self.backend_type == self.BACKEND_SOCKET
+
+    def _assert_supported_backend(self, socket_supported=False):
+        """
+        :param socket_supported: the frame socket supports the method as well, it only streams frames
+        """
+        if self.is_con_socket and socket_supported:
+            return
         if not (self.is_con_local or self.is_con_dbus):
             raise GControllerException("Unsupported backend '{}'".format(self.backend_type))
 
@@ -923,8 +2896,73 @@ class GlightController(GlightCommon):
             return self.device_registry.get_device(short_name_filter=device_name)
         return None
 
+    def open_device(self, device_name):
+        """
+        Connects the local device or reuses the connection kept since the last command,
+        must be paired with close_device()
+
+        :return: GDevice
+        """
+        device = self.get_device(device_name) # type: GDevice
+        self._assert_device_is_found(device_name, device)
+        # a failing device is rejected before it is connected
+        device.breaker.assert_allows(device_name)
+
+        self.device_lock.acquire()
+        try:
+            timer = self.release_timers.pop(device.device_name_short, None)
+            if timer is not None:
+                timer.cancel()
+            if not device.is_connected:
+                device.connect()
+        except:
+            device.breaker.release_probe()
+            self.device_lock.release()
+            raise
+        return device
+
+    def close_device(self, device, failed=False):
+        """Releases the device after idle_timeout seconds, right away if the command failed"""
+        try:
+            if self.idle_timeout is None and not failed:
+                pass  # released by close()
+            elif self.idle_timeout is not None and self.idle_timeout > 0 and not failed:
+                timer = Timer(self.idle_timeout, self._release_idle_device, [device])
+                timer.daemon = True
+                self.release_timers[device.device_name_short] = timer
+                timer.start()
+            elif device.is_connected:
+                device.disconnect()
+        finally:
+            self.device_lock.release()
+
+    def _release_idle_device(self, device):
+        self.device_lock.acquire()
+        try:
+            # the device was used again while this timer waited for the lock
+            if self.release_timers.get(device.device_name_short) is not current_thread():
+                return
+            del self.release_timers[device.device_name_short]
+            if device.is_connected:
+                device.disconnect()
+        finally:
+            self.device_lock.release()
+
+    def _send_to_device(self, device_name, send):
+        """
+        :param send: callable taking the connected GDevice
+        """
+        device = self.open_device(device_name)
+        failed = True
+        try:
+            send(device)
+            failed = False
+        finally:
+            device.breaker.release_probe()
+            self.close_device(device, failed)
+
     def list_devices(self):
-        self._assert_supported_backend()
+        self._assert_supported_backend(socket_supported=True)
         device_list = {}
         if self.is_con_local:
             gdevices = self.device_registry.find_devices()
@@ -934,6 +2972,10 @@ class GlightController(GlightCommon):
             devices = self.client.list_devices()
             for device_name_short, device_name in devices.items():
                 device_list[device_name_short] = device_name
+        elif self.is_con_socket:
+            # the frame socket only knows the short names
+            for device_name_short in self.frame_client.device_ids.keys():
+                device_list[device_name_short] = device_name_short
 
         return device_list
 
@@ -948,7 +2990,15 @@ class GlightController(GlightCommon):
         self._assert_supported_backend()
         if self.is_con_local:
             self.device_registry.load_state_of_devices(filename)
-            self.device_registry.restore_states_of_devices()
+            # restored through open_device() to reuse the connection kept for the following commands
+            for device in self.device_registry.find_devices():
+                try:
+                    self._send_to_device(device.device_name_short, lambda device: device.restore_state())
+                except Exception as ex:
+                    print("Could not restore state of device '{}'".format(device.device_name_short))
+                    print("Exception: {}".format(ex))
+                    if self.verbose:
+                        print(traceback.format_exc())
         elif self.is_con_dbus:
             self.client.load_state()
 
@@ -1017,54 +3067,125 @@ class GlightController(GlightCommon):
     def set_cycle(self, device_name, speed, brightness=None):
         self._assert_supported_backend()
         if self.is_con_local:
-            device = self.get_device(device_name) # type: GDevice
-            self._assert_device_is_found(device_name, device)
-            device.connect()
-            try:
-                device.send_cycle_command(speed, brightness)
-            finally:
-                device.disconnect()
+            self._send_to_device(device_name, lambda device: device.send_cycle_command(speed, brightness))
         elif self.is_con_dbus:
             self.client.set_cycle(device_name, speed, brightness)
 
     def set_color_at(self, device_name, color, field=0):
-        self._assert_supported_backend()
+        self._assert_supported_backend(socket_supported=(field == 0))
         if self.is_con_local:
-            device = self.get_device(device_name) # type: GDevice
-            self._assert_device_is_found(device_name, device)
-            device.connect()
-            try:
-                device.send_color_command(color, field)
-            finally:
-                device.disconnect()
+            self._send_to_device(device_name, lambda device: device.send_color_command(color, field))
         elif self.is_con_dbus:
             self.client.set_color_at(device_name, color, field)
+        elif self.is_con_socket:
+            self.frame_client.send_frame(device_name, [color])
 
     def set_breathe(self, device_name, color, speed=None, brightness=None):
         self._assert_supported_backend()
         if self.is_con_local:
-            device = self.get_device(device_name) # type: GDevice
-            self._assert_device_is_found(device_name, device)
-            device.connect()
-            try:
-                device.send_breathe_command(color, speed, brightness)
-            finally:
-                device.disconnect()
+            self._send_to_device(device_name, lambda device: device.send_breathe_command(color, speed, brightness))
         elif self.is_con_dbus:
             self.client.set_breathe(device_name, color, speed, brightness)
 
     def set_colors(self, device_name, colors):
+        self._assert_supported_backend(socket_supported=True)
+        if self.is_con_local:
+            self._send_to_device(device_name, lambda device: device.send_colors_command(colors))
+        elif self.is_con_dbus:
+            self.client.set_colors(device_name, colors)
+        elif self.is_con_socket:
+            self.frame_client.send_frame(device_name, colors)
+
+    def broadcast(self, device_names, command, **params):
+        """
+        Sends the command to all devices at once, see GBroadcast
+
+        :param device_names: str[]
+        :param command: str e.g. "breathe"
+        :param params: keyword arguments of the command e.g. color="ff0000", speed=1000
+        :return: dict report with the total latency and the start skew
+        """
         self._assert_supported_backend()
         if self.is_con_local:
-            device = self.get_device(device_name) # type: GDevice
-            self._assert_device_is_found(device_name, device)
-            device.connect()
+            broadcast = GBroadcast(command, params)
+            devices = []
             try:
-                device.send_colors_command(colors)
+                # connecting takes the longest, so it is done before the devices are started together
+                for device_name in device_names:
+                    try:
+                        devices.append(self.open_device(device_name))
+                    except Exception as ex:
+                        broadcast.add_error(device_name, ex)
+                report = broadcast.send(devices)
             finally:
-                device.disconnect()
+                for device in devices:
+                    result = broadcast.results.get(device.device_name_short)
+                    self.close_device(device, failed=(result is None or not result["ok"]))
+            return report
         elif self.is_con_dbus:
-            self.client.set_colors(device_name, colors)
+            return json.loads(self.client.broadcast(device_names, command, json.dumps(params)))
+
+    def apply_batch(self, operations):
+        """
+        Applies ordered operations of several devices, see GBatch
+
+        :param operations: dict[] e.g. [{"device": "g213", "op": "colors", "colors": ["ff0000"]}]
+        :return: dict report with one result per operation
+        """
+        self._assert_supported_backend()
+        if self.is_con_local:
+            batch = GBatch(operations)
+            batch.validate(self.get_device)
+            for device_name in batch.get_device_names():
+                try:
+                    device = self.open_device(device_name)
+                except Exception as ex:
+                    batch.add_error(device_name, ex)
+                    continue
+                failed = True
+                try:
+                    failed = not batch.send(device_name, device)
+                finally:
+                    self.close_device(device, failed)
+            return batch.get_report()
+        elif self.is_con_dbus:
+            return json.loads(self.client.apply_batch(json.dumps(operations)))
+
+    def close(self):
+        """Releases the devices and the libusb context of the local backend"""
+        if self.frame_client is not None:
+            try:
+                self.frame_client.flush()
+            finally:
+                self.frame_client.close()
+        self.device_lock.acquire()
+        try:
+            for timer in self.release_timers.values():
+                timer.cancel()
+            self.release_timers = {}
+            if self.device_registry is not None:
+                self.device_registry.close()
+        finally:
+            self.device_lock.release()
+
+    def get_stats(self):
+        """
+        :return: dict
+        """
+        self._assert_supported_backend(socket_supported=True)
+        if self.is_con_local:
+            # sessions, queues etc. are only kept by the service
+            devices = {}
+            for device in self.device_registry.known_devices:
+                devices[device.device_name_short] = {
+                    "interrupts": device.get_ack_stats(),
+                    "latency": device.latency.get_stats()
+                }
+            return {"devices": devices}
+        elif self.is_con_dbus:
+            return json.loads(self.client.get_stats())
+        elif self.is_con_socket:
+            return {"frame_socket": self.frame_client.get_stats()}
 
     def quit(self):
         self._assert_supported_backend()
@@ -1074,6 +3195,294 @@ class GlightController(GlightCommon):
             self.client.quit()
 
 
+class GCommandQueue(object):
+    """
+    Latest-wins slots for the unsent commands of one device. A worker thread sends them one by one, a newer
+    command replaces an older unsent one of the same kind, so the device never lags more than one round trip
+    behind the producers.
+    """
+
+    KEY_FRAME  = "frame"
+    KEY_EFFECT = "effect"
+
+    DEFAULT_MAX_PENDING = 64
+
+    def __init__(self, name, execute, verbose=False, on_dropped=None, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param name: name of the device
+        :param execute: called with each command by the worker thread
+        :param on_dropped: called with each command and the reason if it is dropped unsent
+        :param max_pending: unsent commands a new key is rejected at, None does not limit them
+        """
+        self.name = name
+        self.execute = execute
+        self.verbose = verbose
+        self.on_dropped = on_dropped
+        self.max_pending = max_pending
+
+        self.pending = OrderedDict()  # key -> command, oldest first
+        self.pinned = set()  # keys of pending commands a newer one never replaces
+        self.condition = Condition()
+        self.busy = False
+        self.running = True
+
+        self.queued = 0
+        self.superseded = 0
+        self.rejected = 0
+        self.sent = 0
+        self.failed = 0
+
+        self.worker = Thread(target=self._run, name="glight-queue-" + name)
+        self.worker.daemon = True
+        self.worker.start()
+
+    @staticmethod
+    def field_key(field):
+        return "field", field
+
+    def put(self, key, command, replaces_all=False, pinned=False):
+        """
+        Queues the command and returns immediately
+        :param replaces_all: the command overwrites everything the pending ones would set, so they are dropped
+        :param pinned: the command is sent even if a newer one replaces all, e.g. a call waiting for its outcome
+        :raise GDeviceException: if max_pending commands are unsent already
+        """
+        self.condition.acquire()
+        try:
+            if replaces_all:
+                replaced = [pending_key for pending_key in self.pending if pending_key not in self.pinned]
+            elif key in self.pending:
+                # reinserted to keep the order in which the commands were requested
+                replaced = [key]
+            else:
+                replaced = []
+            if self.max_pending is not None and len(self.pending) - len(replaced) >= self.max_pending:
+                self.rejected += 1
+                raise GDeviceException("Too many unsent commands for device '{}'".format(self.name))
+            dropped = [self.pending.pop(pending_key) for pending_key in replaced]
+            self.superseded += len(dropped)
+            self.pending[key] = command
+            if pinned:
+                self.pinned.add(key)
+            self.queued += 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        self._drop(dropped, "Superseded by a newer request")
+
+    def _run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while self.running and len(self.pending) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                key = next(iter(self.pending))
+                command = self.pending.pop(key)
+                self.pinned.discard(key)
+                self.busy = True
+            finally:
+                self.condition.release()
+
+            try:
+                self.execute(command)
+                self.sent += 1
+            except Exception as ex:
+                self.failed += 1
+                print("Failed to send queued command to device '{}': {}".format(self.name, ex))
+                if self.verbose:
+                    print(traceback.format_exc())
+            finally:
+                self.condition.acquire()
+                try:
+                    self.busy = False
+                    self.condition.notify_all()
+                finally:
+                    self.condition.release()
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until all queued commands are sent
+        :return: True if the queue is idle
+        """
+        deadline = time() + timeout if timeout is not None else None
+        self.condition.acquire()
+        try:
+            while self.running and (self.busy or len(self.pending) > 0):
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return True
+        finally:
+            self.condition.release()
+
+    def stop(self, timeout=None):
+        """Drops the unsent commands and ends the worker after the command in progress"""
+        self.condition.acquire()
+        try:
+            self.running = False
+            dropped = list(self.pending.values())
+            self.pending.clear()
+            self.pinned.clear()
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        self._drop(dropped, "Queue stopped")
+        if self.worker is not current_thread():
+            self.worker.join(timeout)
+
+    def _drop(self, commands, reason):
+        if self.on_dropped is not None:
+            for command in commands:
+                self.on_dropped(command, reason)
+
+    def get_stats(self):
+        return {
+            "queued": self.queued,
+            "superseded": self.superseded,
+            "rejected": self.rejected,
+            "sent": self.sent,
+            "failed": self.failed,
+            "pending": len(self.pending)
+        }
+
+
+class GServiceRequest(object):
+    """Call of the service executed by the worker of a device"""
+
+    def __init__(self, request_id, device_name, command, on_done=None, connect=True):
+        """
+        :param request_id: id returned to the caller of an async method, None if nobody waits for the outcome
+        :param command: callable taking the connected GDevice
+        :param on_done: called with (error, dropped) once the request was sent, failed or dropped unsent
+        :param connect: False runs the command with the device locked but not connected, e.g. for a device that is gone
+        """
+        self.request_id = request_id
+        self.device_name = device_name
+        self.command = command
+        self.on_done = on_done
+        self.connect = connect
+
+
+class GServiceReply(object):
+    """Reply to a DBUS call, sent once from any thread"""
+
+    def __init__(self, invocation, out_signature):
+        """
+        :param invocation: Gio.DBusMethodInvocation
+        :param out_signature: signature of the out args e.g. "(s)", "()" if the method returns nothing
+        """
+        self.invocation = invocation
+        self.out_signature = out_signature
+        self.lock = Lock()
+        self.is_sent = False
+
+    def _take(self):
+        with self.lock:
+            if self.is_sent:
+                return False
+            self.is_sent = True
+            return True
+
+    def send(self, result):
+        if not self._take():
+            return
+        if self.out_signature == "()":
+            self.invocation.return_value(None)
+        elif len(GLib.Variant.split_signature(self.out_signature)) == 1:
+            self.invocation.return_value(GLib.Variant(self.out_signature, (result,)))
+        else:
+            self.invocation.return_value(GLib.Variant(self.out_signature, result))
+
+    def fail(self, error):
+        if not self._take():
+            return
+        # named like pydbus names them
+        error_name = type(error).__name__
+        if "." not in error_name:
+            error_name = "unknown." + error_name
+        self.invocation.return_dbus_error(error_name, str(error))
+
+    def send_result_of(self, finish, *args):
+        """Sends what finish(*args) returns or the exception it raises"""
+        try:
+            result = finish(*args)
+        except Exception as ex:
+            self.fail(ex)
+        else:
+            self.send(result)
+
+
+class GServicePublication(object):
+    """
+    Offers the methods and signals of the service on the bus through GDBus. pydbus replies as soon as a method
+    returns, so a call waiting for its device would hold up the main loop and with it the calls for all other
+    devices. A method returning DEFERRED leaves its reply to the worker of its device, see
+    GlightService.run_on_workers.
+    """
+
+    DEFERRED = object()  # result of a method whose reply is sent later
+
+    def __init__(self, bus, path, service):
+        """
+        :param bus: pydbus bus
+        :param service: object implementing the interface described by the XML in its class docstring
+        """
+        self.bus = bus
+        self.path = path
+        self.service = service
+        self.interface = Gio.DBusNodeInfo.new_for_xml(type(service).__doc__).interfaces[0]
+        self.registration_id = None
+        self.name_owner = None
+        self.dispatching = local()  # reply of the call the main loop dispatches right now
+
+    def publish(self, bus_name):
+        self.registration_id = self.bus.con.register_object(self.path, self.interface, self.on_method_call,
+                                                            None, None)
+        # the name is only taken once the calls can be answered
+        self.name_owner = self.bus.request_name(bus_name)
+
+    def unpublish(self):
+        if self.name_owner is not None:
+            self.name_owner.unown()
+            self.name_owner = None
+        if self.registration_id is not None:
+            self.bus.con.unregister_object(self.registration_id)
+            self.registration_id = None
+
+    def take_reply(self):
+        """:return: GServiceReply of the call dispatched by this thread, None if there is none or it was taken"""
+        reply = getattr(self.dispatching, "reply", None)
+        self.dispatching.reply = None
+        return reply
+
+    def on_method_call(self, connection, sender, object_path, interface_name, method_name, parameters, invocation):
+        method_info = self.interface.lookup_method(method_name)
+        reply = GServiceReply(invocation, "(" + "".join(arg.signature for arg in method_info.out_args) + ")")
+        self.dispatching.reply = reply
+        try:
+            result = getattr(self.service, method_name)(*parameters.unpack())
+            if result is not GServicePublication.DEFERRED:
+                reply.send(result)
+        except Exception as ex:
+            print("Exception while handling {}(): {}".format(method_name, ex))
+            if self.service.verbose:
+                print(traceback.format_exc())
+            reply.fail(ex)
+        finally:
+            self.dispatching.reply = None
+
+    def emit_signal(self, name, args):
+        signal_info = self.interface.lookup_signal(name)
+        signature = "(" + "".join(arg.signature for arg in signal_info.args) + ")"
+        self.bus.con.emit_signal(None, self.path, self.interface.name, name, GLib.Variant(signature, args))
+
+
 class GlightService(GlightRemoteCommon):
     """
       <node>
@@ -1111,10 +3520,68 @@ class GlightService(GlightRemoteCommon):
             <arg type='x' name='speed'  direction='in'/>
             <arg type='x' name='brightness' direction='in'/>
           </method>
+          <method name='set_color_at_async'>
+            <arg type='s' name='device' direction='in'/>
+            <arg type='s' name='color'  direction='in'/>
+            <arg type='q' name='field'  direction='in'/>
+            <arg type='t' name='request_id' direction='out'/>
+          </method>
+          <method name='set_colors_async'>
+            <arg type='s'  name='device' direction='in'/>
+            <arg type='as' name='colors' direction='in'/>
+            <arg type='t'  name='request_id' direction='out'/>
+          </method>
+          <method name='set_breathe_async'>
+            <arg type='s' name='device' direction='in'/>
+            <arg type='s' name='color'  direction='in'/>
+            <arg type='x' name='speed'  direction='in'/>
+            <arg type='x' name='brightness' direction='in'/>
+            <arg type='t' name='request_id' direction='out'/>
+          </method>
+          <method name='set_cycle_async'>
+            <arg type='s' name='device' direction='in'/>
+            <arg type='x' name='speed'  direction='in'/>
+            <arg type='x' name='brightness' direction='in'/>
+            <arg type='t' name='request_id' direction='out'/>
+          </method>
+          <method name='broadcast'>
+            <arg type='as' name='devices' direction='in'/>
+            <arg type='s' name='command' direction='in'/>
+            <arg type='s' name='params'  direction='in'/>
+            <arg type='s' name='resp'    direction='out'/>
+          </method>
+          <method name='apply_batch'>
+            <arg type='s' name='operations' direction='in'/>
+            <arg type='s' name='report' direction='out'/>
+          </method>
+          <method name='get_stats'>
+            <arg type='s' name='resp'  direction='out'/>
+          </method>
           <method name='echo'>
             <arg type='x' name='s' direction='in'/>
           </method>
           <method name='quit'/>
+          <signal name='DevicePresenceChanged'>
+            <arg type='s' name='device'/>
+            <arg type='b' name='present'/>
+          </signal>
+          <signal name='StateChanged'>
+            <arg type='s' name='device'/>
+            <arg type='t' name='seq'/>
+            <arg type='s' name='state'/>
+          </signal>
+          <signal name='RequestCompleted'>
+            <arg type='t' name='request_id'/>
+            <arg type='s' name='device'/>
+          </signal>
+          <signal name='RequestFailed'>
+            <arg type='t' name='request_id'/>
+            <arg type='s' name='device'/>
+            <arg type='s' name='error'/>
+          </signal>
+          <signal name='StateSaveFailed'>
+            <arg type='s' name='error'/>
+          </signal>
         </interface>
       </node>
     """
@@ -1125,14 +3592,86 @@ class GlightService(GlightRemoteCommon):
     bus_name = "de.sgdw.linux.glight"
     bus_path = "/" + bus_name.replace(".", "/")
 
-    def __init__(self, state_file=None, verbose=False):
-        """"""
+    DEFAULT_IDLE_TIMEOUT = 5.0     # seconds until an unused device is given back to the kernel
+    SESSION_CHECK_INTERVAL = 1000  # milliseconds between checks for idle sessions
+    HOTPLUG_POLL_INTERVAL = 250    # milliseconds between handling hotplug events
+    PROBE_CHECK_INTERVAL = 1000    # milliseconds between checks for failing devices due for a probe
+    RESCAN_INTERVAL = 5            # seconds between rescans if hotplug is not supported
+    DEFAULT_SAVE_DELAY = 2.0       # seconds until a saved state is written to the state file
+
+    def __init__(self, state_file=None, verbose=False, idle_timeout=None, registry_options=None, coalesce=False,
+                 frame_socket=None, frame_socket_uids=None, frame_buffer=None, frame_buffer_rate=None,
+                 frame_buffer_uid=None, frame_buffer_gid=None, save_delay=None):
+        """
+        :param save_delay: seconds save_state waits before the state file is written, calls in between share the write
+        :param frame_socket: path of the GFrameSocketServer endpoint, None does not offer it
+        :param frame_socket_uids: users allowed to stream frames besides root and the user of the service
+        :param frame_buffer: directory of the GFrameBuffer of each device, None does not offer them
+        :param frame_buffer_rate: samples of the frame buffers per second
+        :param frame_buffer_uid: user owning the frame buffers
+        :param frame_buffer_gid: group owning the frame buffers, its members may write frames
+        """
         self.state_file = state_file
         self.verbose = verbose
+        self.registry_options = registry_options or {}
+
+        # save_state only marks the state dirty, a timer writes it behind the caller's back
+        self.save_delay = save_delay
+        if self.save_delay is None:
+            self.save_delay = self.DEFAULT_SAVE_DELAY
+        self.save_lock = Lock()
+        self.state_write_lock = Lock()
+        self.state_dirty = False
+        self.save_timer = None
+        self.state_writes = 0
+        self.state_writes_skipped = 0
+        self.state_write_failures = 0
+        self.state_write_error = None  # error of the last write, None once a write succeeded
+
+        self.frame_socket = frame_socket
+        self.frame_socket_uids = frame_socket_uids
+        self.frame_server = None  # type: GFrameSocketServer
+
+        self.frame_buffer = frame_buffer
+        self.frame_buffer_rate = frame_buffer_rate
+        self.frame_buffer_uid = frame_buffer_uid
+        self.frame_buffer_gid = frame_buffer_gid
+        self.frame_sampler = None  # type: GFrameBufferSampler
+
+        # color and effect calls return once queued, see GCommandQueue
+        self.coalesce = coalesce
+        self.command_queues = {}  # device_name_short -> GCommandQueue
+
+        # ids of the requests of the async methods, their outcome is signaled
+        self.request_lock = Lock()
+        self.last_request_id = 0
+        self.last_call_id = 0  # calls waiting for their outcome, see run_on_worker
+        self.requests_completed = 0
+        self.requests_failed = 0
+
+        # sequence number of the last StateChanged signal per device, clients use it to spot missed signals
+        self.state_lock = Lock()
+        self.state_seqs = {}
 
         self.loop = None
         self.bus  = None
-        self.lock = Semaphore()
+        self.publication = None  # type: GServicePublication
+
+        # each device has its own lock, so commands for different devices run in parallel
+        self.device_locks = {}  # device_name_short -> RLock, held while the device is used
+        self.sessions_lock = Lock()  # guards the sessions and their counters, never held during transfers
+
+        # device sessions: devices stay connected and claimed between calls
+        self.idle_timeout = idle_timeout
+        if self.idle_timeout is None:
+            self.idle_timeout = self.DEFAULT_IDLE_TIMEOUT
+        self.sessions = {}  # device_name_short -> time of last use
+        self.session_hits = 0
+        self.session_misses = 0
+        self.session_timer = None
+        self.presence_timer = None
+        self.probe_timer = None
+        self.probe_thread = None
 
         self.device_registry = None # type: GDeviceRegistry
         self.init_backend()
@@ -1142,34 +3681,557 @@ class GlightService(GlightRemoteCommon):
         self.prepare_run()
         self.loop = GLib.MainLoop()
 
-        self.bus = self.get_bus()
-        self.bus.publish(self.bus_name, self)
+        self.publish(self.get_bus())
+
+        if self.idle_timeout > 0:
+            self.session_timer = GLib.timeout_add(self.SESSION_CHECK_INTERVAL, self.on_session_timer)
+
+        self.start_presence_monitoring()
+        self.probe_timer = GLib.timeout_add(self.PROBE_CHECK_INTERVAL, self.on_probe_timer)
+
+        if self.frame_socket is not None:
+            self.frame_server = GFrameSocketServer(self, self.frame_socket, self.frame_socket_uids, verbose=self.verbose)
+            self.frame_server.start()
+
+        if self.frame_buffer is not None:
+            self.frame_sampler = GFrameBufferSampler(self, self.frame_buffer, self.frame_buffer_rate,
+                                                     self.frame_buffer_uid, self.frame_buffer_gid, verbose=self.verbose)
+            self.frame_sampler.start()
+
+        try:
+            self.loop.run()
+        finally:
+            self.unpublish()
+            if self.frame_server is not None:
+                self.frame_server.stop()
+                self.frame_server = None
+            if self.frame_sampler is not None:
+                self.frame_sampler.stop()
+                self.frame_sampler = None
+            self.flush_state(retry=False)
+            if self.session_timer is not None:
+                GLib.source_remove(self.session_timer)
+                self.session_timer = None
+            if self.probe_timer is not None:
+                GLib.source_remove(self.probe_timer)
+                self.probe_timer = None
+            self.stop_presence_monitoring()
+            self.stop_command_queues()
+            devices = self.lock_devices(self.device_registry.known_devices)
+            try:
+                self.release_all_sessions()
+                self.device_registry.close()
+            finally:
+                self.unlock_devices(devices)
+
+    def publish(self, bus):
+        """
+        Offers the service on the bus, its calls are dispatched by the main loop
+        :param bus: pydbus bus
+        """
+        self.bus = bus
+        self.publication = GServicePublication(bus, self.bus_path, self)
+        self.publication.publish(self.bus_name)
+
+    def unpublish(self):
+        if self.publication is not None:
+            self.publication.unpublish()
+            self.publication = None
+
+    def init_backend(self):
+        self.device_registry = GDeviceRegistry(verbose=self.verbose, **self.registry_options)
+        self.device_registry.presence_callbacks.append(self.on_presence_changed)
+        self.device_locks = {}
+        for known_device in self.device_registry.known_devices:
+            self.device_locks[known_device.device_name_short] = RLock()
+
+    def get_device_lock(self, device):
+        """
+        :param device: GDevice
+        :return: RLock
+        """
+        return self.device_locks[device.device_name_short]
+
+    def lock_devices(self, devices):
+        """Locks several devices, always in the same order to avoid deadlocks"""
+        devices = sorted(devices, key=lambda device: device.device_name_short)
+        for device in devices:
+            self.get_device_lock(device).acquire()
+        return devices
+
+    def unlock_devices(self, devices):
+        for device in devices:
+            self.get_device_lock(device).release()
+
+    def prepare_run(self):
+        if self.state_file is not None:
+            self.load_state()
+
+    def open_device(self, device_name):
+        """
+        Locks and connects the device, must be paired with close_device()
+        :return: GDevice or None if the device is not present, then nothing is locked
+        """
+        device = self.device_registry.get_device(short_name_filter=device_name) # type: GDevice
+        if device is not None:
+            lock = self.get_device_lock(device)
+            lock.acquire()
+            try:
+                self.open_session(device)
+            except:
+                lock.release()
+                raise
+        return device
+
+    def close_device(self, device):
+        """
+        :param device: GDevice
+        :return:
+        """
+        if device is not None:
+            try:
+                self.close_session(device)
+            finally:
+                self.get_device_lock(device).release()
+
+    def open_session(self, device):
+        """Connects the device or reuses its open session, must be called with the device lock held"""
+        name = device.device_name_short
+        reuse = name in self.sessions and device.is_connected
+        if not reuse:
+            device.connect()
+        with self.sessions_lock:
+            if reuse:
+                self.session_hits += 1
+            else:
+                self.session_misses += 1
+            self.sessions[name] = time()
+
+    def close_session(self, device):
+        """Keeps the device connected for reuse, must be called with the device lock held"""
+        if self.idle_timeout > 0 and device.is_connected:
+            with self.sessions_lock:
+                self.sessions[device.device_name_short] = time()
+        else:
+            self.release_session(device)
+
+    def release_session(self, device):
+        """Disconnects the device and hands it back to the kernel, must be called with the device lock held"""
+        with self.sessions_lock:
+            self.sessions.pop(device.device_name_short, None)
+        if device.is_connected:
+            try:
+                device.disconnect()
+            except Exception as ex:
+                print("Failed to release device '{}': {}".format(device.device_name_short, ex))
+                if self.verbose:
+                    print(traceback.format_exc())
+                # whatever the backend still holds belongs to a device that is gone
+                self.close_backend(device)
+
+    def close_backend(self, device):
+        """Drops the handles of the backend of the device, must be called with the device lock held"""
+        if device.backend is not None:
+            try:
+                device.backend.close()
+            except Exception as ex:
+                print("Failed to close backend of device '{}': {}".format(device.device_name_short, ex))
+
+    def release_all_sessions(self):
+        """"""
+        with self.sessions_lock:
+            device_names = list(self.sessions.keys())
+        for device_name in device_names:
+            device = self.device_registry.get_known_device(device_name)
+            if device is not None:
+                with self.get_device_lock(device):
+                    self.release_session(device)
+
+    def release_idle_sessions(self, now=None):
+        """Devices in use are skipped, they are not idle anyway"""
+        if now is None:
+            now = time()
+        with self.sessions_lock:
+            sessions = list(self.sessions.items())
+        for device_name, last_used in sessions:
+            if now - last_used >= self.idle_timeout:
+                device = self.device_registry.get_known_device(device_name)
+                if device is not None:
+                    lock = self.get_device_lock(device)
+                    # never block the main loop, try again on the next tick
+                    if lock.acquire(False):
+                        try:
+                            with self.sessions_lock:
+                                unused = self.sessions.get(device_name) == last_used
+                            if unused:
+                                self._log("Releasing idle device '{}'".format(device_name))
+                                self.release_session(device)
+                        finally:
+                            lock.release()
+
+    def on_session_timer(self):
+        self.release_idle_sessions()
+        return True
+
+    def queue_command(self, device_name, key, command, replaces_all=False, request_id=None, on_done=None,
+                      pinned=False, connect=True):
+        """
+        Queues the command in the latest-wins slot of the device, the caller does not wait for the device
+        :param pinned: see GCommandQueue.put
+        :param connect: see GServiceRequest, False queues commands for devices that are not present as well
+        """
+        if connect:
+            device = self.device_registry.get_device(short_name_filter=device_name) # type: GDevice
+        else:
+            device = self.device_registry.get_known_device(device_name)
+        if device is None:
+            raise GDeviceException("Device '{}' not found".format(device_name))
+
+        name = device.device_name_short
+        # the frame socket queues from its own threads
+        with self.request_lock:
+            queue = self.command_queues.get(name)
+            if queue is None:
+                queue = GCommandQueue(name, self.execute_request, self.verbose, on_dropped=self.on_request_dropped)
+                self.command_queues[name] = queue
+        queue.put(key, GServiceRequest(request_id, name, command, on_done, connect), replaces_all, pinned)
+
+    def submit_request(self, device_name, key, command, replaces_all=False):
+        """
+        Queues the command for the worker of the device
+        :return: request id, the outcome is signaled by RequestCompleted or RequestFailed
+        """
+        with self.request_lock:
+            self.last_request_id += 1
+            request_id = self.last_request_id
+
+        if not self.coalesce:
+            # every request is sent, in the order of the calls
+            key = ("request", request_id)
+            replaces_all = False
+        self.queue_command(device_name, key, command, replaces_all, request_id)
+        return request_id
+
+    def execute_request(self, request):
+        """
+        Called by the worker of the device
+        :param request: GServiceRequest
+        """
+        try:
+            if request.connect:
+                self.send_to_device(request.device_name, request.command)
+            else:
+                device = self.device_registry.get_known_device(request.device_name)
+                with self.get_device_lock(device):
+                    request.command(device)
+        except Exception as ex:
+            self.on_request_done(request, ex)
+            raise
+        self.on_request_done(request)
+
+    def on_request_dropped(self, request, reason):
+        self.on_request_done(request, reason, dropped=True)
+
+    def on_request_done(self, request, error=None, dropped=False):
+        if request.on_done is not None:
+            request.on_done(error, dropped)
+        if request.request_id is None:
+            return
+        with self.request_lock:
+            if error is None:
+                self.requests_completed += 1
+            else:
+                self.requests_failed += 1
+        if error is None:
+            self.emit_signal_idle("RequestCompleted", request.request_id, request.device_name)
+        else:
+            self.emit_signal_idle("RequestFailed", request.request_id, request.device_name, str(error))
+
+    def wait_for_command_queues(self, timeout=None):
+        """:return: True if all queued commands were sent"""
+        idle = True
+        for queue in list(self.command_queues.values()):
+            idle = queue.wait_idle(timeout) and idle
+        return idle
+
+    def stop_command_queues(self):
+        for queue in list(self.command_queues.values()):
+            queue.stop()
+        self.command_queues = {}
+
+    def send_to_device(self, device_name, command):
+        """Runs command(device) on the connected device, a failing device is rejected without waiting for the lock"""
+        known_device = self.device_registry.get_known_device(device_name)
+        if known_device is not None:
+            known_device.breaker.assert_allows(device_name)
+            deadline = time() + known_device.request_timeout
+        else:
+            deadline = None
+
+        try:
+            self._send_to_open_device(device_name, command, deadline)
+        finally:
+            # a command that never reached the device leaves the probe to the next one
+            if known_device is not None:
+                known_device.breaker.release_probe()
+
+    def _send_to_open_device(self, device_name, command, deadline):
+        device = self.open_device(device_name)
+        if device is not None and deadline is not None and time() >= deadline:
+            self.close_device(device)
+            raise GDeviceException("Deadline of the request exceeded while waiting for device '{}'".format(device_name))
+
+        try:
+            if device is not None:
+                device.deadline = deadline
+                state = json.dumps(device.device_state.as_dict(), sort_keys=True)
+                try:
+                    command(device)
+                finally:
+                    device.deadline = None
+                    # a command failing halfway may still have changed the state
+                    if json.dumps(device.device_state.as_dict(), sort_keys=True) != state:
+                        self.on_state_changed(device)
+            else:
+                raise GDeviceException("Device '{}' not found".format(device_name))
+        except Exception:
+            if device is not None:
+                self.release_session(device)
+            raise
+        finally:
+            self.close_device(device)
+
+    def on_probe_timer(self):
+        # probes take up to a request timeout, they must not block the main loop
+        if self.probe_thread is None or not self.probe_thread.is_alive():
+            due = [device for device in self.device_registry.known_devices if device.breaker.is_due_for_probe()]
+            if len(due) > 0:
+                self.probe_thread = Thread(target=self.probe_devices, args=(due,), name="glight-probe")
+                self.probe_thread.daemon = True
+                self.probe_thread.start()
+        return True
+
+    def probe_devices(self, devices):
+        """Probes failing devices and restores the state of the recovered ones"""
+        for device in devices:
+            lock = self.get_device_lock(device)
+            lock.acquire()
+            try:
+                if device.probe():
+                    print("Device '{}' recovered".format(device.device_name_short))
+                    device.restore_state()
+                    self.on_state_changed(device)
+            except Exception as ex:
+                print("Failed to restore device '{}': {}".format(device.device_name_short, ex))
+            finally:
+                lock.release()
+
+    def dispatch_command(self, device_name, key, command, replaces_all=False):
+        """Sends the command and waits for it or queues it if coalescing is enabled"""
+        if self.coalesce:
+            self.queue_command(device_name, key, command, replaces_all)
+        else:
+            return self.run_on_worker(device_name, command)
+
+    def run_on_worker(self, device_name, command):
+        """Runs command(device) on the worker of the device and waits for its outcome, see run_on_workers"""
+        def finish(errors):
+            if errors[device_name] is not None:
+                raise errors[device_name]
+
+        return self.run_on_workers({device_name: command}, finish=finish)
+
+    def run_on_workers(self, commands, on_done=None, connect=True, slot=None, finish=None):
+        """
+        Runs the commands on the workers of their devices at the same time and waits for all of them. A DBUS call
+        does not wait, the main loop goes on with the next call and the worker done last sends the reply.
+
+        :param commands: dict device_name -> callable taking the connected GDevice
+        :param on_done: called with (device_name, error) by the worker once the command of a device is done
+        :param connect: see GServiceRequest
+        :param slot: (key, replaces_all) of the latest-wins slot the commands take, None queues them behind all
+                     pending commands, where nothing drops them
+        :param finish: called with dict device_name -> exception or None once all commands are done, returns the
+                       result of the call
+        :return: result of finish, GServicePublication.DEFERRED if the reply of a DBUS call is sent later
+        """
+        if finish is None:
+            finish = lambda errors: errors
+        reply = self.publication.take_reply() if self.publication is not None else None
+        errors = {}
+        done = Event()
+        lock = Lock()
+
+        def on_command_done(device_name, error):
+            if error is not None and not isinstance(error, Exception):
+                error = GDeviceException(error)  # the reason of a dropped command
+            if on_done is not None:
+                on_done(device_name, error)
+            with lock:
+                errors[device_name] = error
+                finished = len(errors) == len(commands)
+            if finished:
+                if reply is not None:
+                    reply.send_result_of(finish, errors)
+                done.set()
+
+        if len(commands) == 0:
+            return finish(errors)
+        for device_name, command in commands.items():
+            if slot is not None:
+                key, replaces_all = slot
+            else:
+                with self.request_lock:
+                    self.last_call_id += 1
+                    key = ("call", self.last_call_id)
+                replaces_all = False
+            try:
+                self.queue_command(device_name, key, command, replaces_all, pinned=slot is None, connect=connect,
+                                   on_done=lambda error, dropped, device_name=device_name:
+                                   on_command_done(device_name, error))
+            except Exception as ex:
+                on_command_done(device_name, ex)
 
-        self.loop.run()
+        if reply is not None:
+            return GServicePublication.DEFERRED
+        done.wait()
+        return finish(errors)
 
-    def init_backend(self):
-        self.device_registry = GDeviceRegistry()
+    def start_presence_monitoring(self):
+        if self.device_registry.start_monitoring():
+            self.presence_timer = GLib.timeout_add(self.HOTPLUG_POLL_INTERVAL, self.on_presence_timer)
+        else:
+            self.presence_timer = GLib.timeout_add_seconds(self.RESCAN_INTERVAL, self.on_presence_timer)
 
-    def prepare_run(self):
-        if self.state_file is not None:
-            self.load_state()
+    def stop_presence_monitoring(self):
+        if self.presence_timer is not None:
+            GLib.source_remove(self.presence_timer)
+            self.presence_timer = None
+        self.device_registry.stop_monitoring()
 
-    def open_device(self, device_name):
-        self.lock.acquire()
-        device = self.device_registry.get_device(short_name_filter=device_name) # type: GDevice
-        if device is not None:
-            device.connect()
-        return device
+    def on_presence_timer(self):
+        try:
+            if not self.device_registry.is_monitoring:
+                self.device_registry.rescan()
+            self.device_registry.poll_monitor()
+        except Exception as ex:
+            print("Failed to update device presence: {}".format(ex))
+            if self.verbose:
+                print(traceback.format_exc())
+        return True
 
-    def close_device(self, device):
+    def on_presence_changed(self, device, is_present):
         """
         :param device: GDevice
-        :return:
+        :param is_present: bool
         """
-        if device is not None:
-            device.disconnect()
+        name = device.device_name_short
+        if is_present:
+            print("Device '{}' attached, restoring its state".format(name))
+        else:
+            print("Device '{}' detached".format(name))
+
+        with self.request_lock:
+            self.last_call_id += 1
+            key = ("presence", self.last_call_id)
+        try:
+            # the worker waits for a transfer still running on the device, the main loop does not
+            self.queue_command(name, key, lambda device: self.update_presence(device, is_present),
+                               pinned=True, connect=False)
+        except Exception as ex:
+            print("Could not update device '{}': {}".format(name, ex))
+
+        self.emit_signal("DevicePresenceChanged", name, is_present)
+
+    def update_presence(self, device, is_present):
+        """Called by the worker of the device with its lock held"""
+        name = device.device_name_short
+        # an open session is stale after the device was unplugged
+        with self.sessions_lock:
+            has_session = name in self.sessions
+        if has_session:
+            self.release_session(device)
+        if not is_present:
+            self.close_backend(device)
+            return
+
+        try:
+            self.restore_device(device)
+        except Exception as ex:
+            print("Could not restore state of device '{}'".format(name))
+            print("Exception: {}".format(ex))
+            if self.verbose:
+                print(traceback.format_exc())
 
-        self.lock.release()
+    def on_state_changed(self, device):
+        """Signals the state of the device, called with the lock of the device held"""
+        name = device.device_name_short
+        state_json = json.dumps(device.device_state.as_dict())
+        # numbered and queued together, so the signals of a device leave in the order of their numbers
+        with self.state_lock:
+            seq = self.state_seqs.get(name, 0) + 1
+            self.state_seqs[name] = seq
+            self.emit_signal_idle("StateChanged", name, seq, state_json)
+
+    def emit_signal(self, name, *args):
+        """Emits a DBUS signal, if the service is published"""
+        if self.publication is not None:
+            self.publication.emit_signal(name, args)
+
+    def emit_signal_idle(self, name, *args):
+        """Emits a DBUS signal from the main loop, can be called from any thread"""
+        GLib.idle_add(self._emit_signal_once, name, args)
+
+    def _emit_signal_once(self, name, args):
+        self.emit_signal(name, *args)
+        return False  # removes the idle source
+
+    def collect_stats(self):
+        devices = {}
+        for device in self.device_registry.known_devices:
+            devices[device.device_name_short] = {
+                "interrupts": device.get_ack_stats(),
+                "suppressed_writes": device.suppressed_writes,
+                "breaker": device.breaker.get_stats(),
+                "latency": device.latency.get_stats(),
+                "packet_cache": device.packet_cache.get_stats(),
+                "transfer_queue": device.backend.get_queue_stats() if device.backend is not None else None,
+                "kernel_driver": device.backend.get_kernel_driver_stats() if device.backend is not None else None
+            }
+
+        return {
+            "presence": {
+                "devices": self.device_registry.presence,
+                "hotplug": self.device_registry.is_monitoring
+            },
+            "usb_contexts_created": UsbBackendUsb1.context_creations,
+            "sessions": {
+                "hits": self.session_hits,
+                "misses": self.session_misses,
+                "open": sorted(self.sessions.keys()),
+                "idle_timeout": self.idle_timeout
+            },
+            "command_queues": dict((name, queue.get_stats()) for name, queue in self.command_queues.items()),
+            "requests": {
+                "submitted": self.last_request_id,
+                "completed": self.requests_completed,
+                "failed": self.requests_failed
+            },
+            "frame_socket": self.frame_server.get_stats() if self.frame_server is not None else None,
+            "frame_buffer": self.frame_sampler.get_stats() if self.frame_sampler is not None else None,
+            "state_file": {
+                "writes": self.state_writes,
+                "skipped": self.state_writes_skipped,
+                "failed": self.state_write_failures,
+                "last_error": self.state_write_error,
+                "dirty": self.state_dirty
+            },
+            "devices": devices
+        }
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
 
     def unmarshall_num_par(self, num_val, if_not_set=None):
         """None is not allowed over dbus, so a negative value is the None equivalent over the wire"""
@@ -1177,12 +4239,55 @@ class GlightService(GlightRemoteCommon):
             return if_not_set
         return num_val
 
+    def restore_states(self, state_json=None):
+        """
+        Restores the states of the attached devices on their workers, the others only take the new state
+        :param state_json: states to load first, the current states are restored if None
+        """
+        states = json.loads(state_json) if state_json is not None else {}
+        commands = {}
+        for device in self.device_registry.known_devices:
+            commands[device.device_name_short] = \
+                lambda device, state=states.get(device.device_name_short): self.restore_device(device, state)
+
+        def finish(errors):
+            for name, error in errors.items():
+                if error is not None:
+                    print("Could not restore state of device '{}'".format(name))
+                    print("Exception: {}".format(error))
+
+        return self.run_on_workers(commands, connect=False, finish=finish)
+
+    def restore_device(self, device, state=None):
+        """
+        Called by the worker of the device with its lock held
+        :param state: dict of the new state, None restores the current one
+        """
+        try:
+            if state is not None:
+                device.device_state.import_dict(state)
+            opened = self.open_device(device.device_name_short)
+            if opened is not None:
+                try:
+                    opened.restore_state()
+                except Exception:
+                    self.release_session(opened)
+                    raise
+                finally:
+                    self.close_device(opened)
+        finally:
+            self.on_state_changed(device)
+
     # Public
     def load_state(self, filename = None):
         if self.state_file is not None:
             try:
-                self.device_registry.load_state_of_devices(self.state_file)
-                self.device_registry.restore_states_of_devices()
+                fh = open(self.state_file, "r")
+                try:
+                    state_json = fh.read()
+                finally:
+                    fh.close()
+                return self.restore_states(state_json)
             except Exception as ex:
                 print("Failed to restore state '{}'".format(ex.message))
                 if self.verbose:
@@ -1192,16 +4297,58 @@ class GlightService(GlightRemoteCommon):
     # Public
     def save_state(self, filename = None):
         if self.state_file is not None:
+            with self.save_lock:
+                self.state_dirty = True
+                self._arm_save_timer()
+        else:
+            raise GDeviceException("No state file configured")
+
+    def _arm_save_timer(self):
+        """Called with the save lock held"""
+        if self.save_timer is None:
+            self.save_timer = Timer(self.save_delay, self.flush_state)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def flush_state(self, retry=True):
+        """
+        Writes the state file if the state was saved since the last write
+        :param retry: a failed write stays pending and is tried again after the save delay
+        """
+        with self.save_lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()  # flushed early, e.g. on shutdown
+                self.save_timer = None
+            if not self.state_dirty:
+                return
+            self.state_dirty = False
+
+        # written without the save lock, so save_state never waits for the disk
+        with self.state_write_lock:
             try:
-                self.device_registry.write_state_of_devices(self.state_file)
+                # the workers change the states while the file is written, so it gets a consistent copy
+                devices = self.lock_devices(self.device_registry.known_devices)
+                try:
+                    state_json = self.device_registry.get_state_as_json()
+                finally:
+                    self.unlock_devices(devices)
+
+                if self.device_registry.write_state_of_devices(self.state_file, state_json):
+                    self.state_writes += 1
+                else:
+                    self.state_writes_skipped += 1
+                self.state_write_error = None
             except Exception as ex:
-                print("Failed to save state '{}'".format(ex.message))
+                print("Failed to save state '{}'".format(ex))
                 if self.verbose:
-                    print("Exception: {}".format(ex))
                     print(traceback.format_exc())
-                raise GDeviceException("Failed to save state")
-        else:
-            raise GDeviceException("No state file configured")
+                self.state_write_failures += 1
+                self.state_write_error = str(ex)
+                with self.save_lock:
+                    self.state_dirty = True
+                    if retry:
+                        self._arm_save_timer()
+                self.emit_signal_idle("StateSaveFailed", str(ex))
 
     # Public
     def get_state(self):
@@ -1212,8 +4359,7 @@ class GlightService(GlightRemoteCommon):
         try:
             if self.verbose:
                 print("Set state '{}'".format(state_json))
-            self.device_registry.load_state_from_json(state_json)
-            self.device_registry.restore_states_of_devices()
+            return self.restore_states(state_json)
         except Exception as ex:
             print("Failed to set state '{}'".format(ex.message))
             if self.verbose:
@@ -1226,77 +4372,180 @@ class GlightService(GlightRemoteCommon):
         for device in self.device_registry.find_devices():
             devices[device.device_name_short] = device.device_name
         print("list_devices() := {}".format(devices))
-        self.lock.release()
         return devices
 
+    # Public
+    def broadcast(self, device_names, command, params_json):
+        """Sends one command to several devices at once, returns the JSON report of GBroadcast"""
+        print("broadcast({}, '{}', {})".format(device_names, command, params_json))
+        broadcast = GBroadcast(command, json.loads(params_json or "{}"))
+
+        targets = []
+        for device_name in device_names:
+            device = self.device_registry.get_device(short_name_filter=device_name) # type: GDevice
+            if device is None:
+                broadcast.add_error(device_name, "Device '{}' not found".format(device_name))
+            elif device.device_name_short not in targets:
+                targets.append(device.device_name_short)
+
+        # each worker connects its device, the last one ready starts all of them
+        start = Event()
+        started_at = []
+        waiting = set(targets)
+        waiting_lock = Lock()
+
+        def ready(device_name):
+            with waiting_lock:
+                waiting.discard(device_name)
+                if len(waiting) == 0 and not start.is_set():
+                    started_at.append(time())
+                    start.set()
+
+        def send(device):
+            ready(device.device_name_short)
+            error = broadcast.send_to(device, start, device.get_remaining_time())
+            if error is not None:
+                raise error  # the session of the device is released like after any failed call
+
+        def on_done(device_name, error):
+            # a device that could not be connected does not hold up the others
+            ready(device_name)
+            if error is not None and device_name not in broadcast.timings:
+                broadcast.add_error(device_name, error)
+
+        # coalesced it takes the slot of its command, so it is neither overtaken by older queued commands nor
+        # sent after newer ones
+        slot = self.get_broadcast_slot(broadcast) if self.coalesce else None
+        def finish(errors):
+            return json.dumps(broadcast.finish(targets, started_at[0] if len(started_at) > 0 else time()))
+
+        return self.run_on_workers(dict((device_name, send) for device_name in targets), on_done=on_done, slot=slot,
+                                   finish=finish)
+
+    @staticmethod
+    def get_broadcast_slot(broadcast):
+        """:return: (key, replaces_all) of the GCommandQueue slot of the command"""
+        if broadcast.command == "color_at" and broadcast.params.get("field", 0) != 0:
+            return GCommandQueue.field_key(broadcast.params["field"]), False
+        if broadcast.command in ("colors", "color_at"):
+            return GCommandQueue.KEY_FRAME, True
+        return GCommandQueue.KEY_EFFECT, True
+
+    # Public
+    def apply_batch(self, operations_json):
+        """Applies ordered operations of several devices, one connection per device, returns the JSON report of GBatch"""
+        print("apply_batch({})".format(operations_json))
+        operations = json.loads(operations_json)
+        if not isinstance(operations, list):
+            raise GControllerException("The operations of a batch must be a list")
+        batch = GBatch(operations)
+        batch.validate(lambda device_name: self.device_registry.get_device(short_name_filter=device_name))
+
+        # the devices take their operations in parallel, each in order on its worker
+        commands = {}
+        for device_name in batch.get_device_names():
+            commands[device_name] = \
+                lambda device, device_name=device_name: self.assert_batch_sent(batch, device_name, device)
+
+        def finish(errors):
+            for device_name, error in errors.items():
+                if error is not None \
+                        and not any(result is not None and result["device"] == device_name for result in batch.results):
+                    batch.add_error(device_name, error)
+            return json.dumps(batch.get_report())
+
+        return self.run_on_workers(commands, finish=finish)
+
+    @staticmethod
+    def assert_batch_sent(batch, device_name, device):
+        if not batch.send(device_name, device):
+            # the session of the device is released like after any failed call
+            raise GDeviceException("Batch failed at device '{}'".format(device_name))
+
+    def prepare_color_at(self, color, field):
+        """Validates the call, :return: (key, command, replaces_all) for dispatch_command or submit_request"""
+        GDevice.assert_valid_color(color)
+        if field == 0:
+            key = GCommandQueue.KEY_FRAME
+        else:
+            key = GCommandQueue.field_key(field)
+        return key, lambda device: device.send_color_command(color, field), field == 0
+
+    def prepare_colors(self, colors):
+        """Validates the call, :return: (key, command, replaces_all) for dispatch_command or submit_request"""
+        for color in colors:
+            GDevice.assert_valid_color(color)
+        return GCommandQueue.KEY_FRAME, lambda device: device.send_colors_command(colors), True
+
+    def prepare_breathe(self, color, speed, brightness):
+        """Validates the call, :return: (key, command, replaces_all) for dispatch_command or submit_request"""
+        GDevice.assert_valid_color(color)
+        speed = self.unmarshall_num_par(speed)
+        brightness = self.unmarshall_num_par(brightness)
+        return (GCommandQueue.KEY_EFFECT,
+                lambda device: device.send_breathe_command(color=color, speed=speed, brightness=brightness), True)
+
+    def prepare_cycle(self, speed, brightness):
+        """Validates the call, :return: (key, command, replaces_all) for dispatch_command or submit_request"""
+        speed = self.unmarshall_num_par(speed)
+        brightness = self.unmarshall_num_par(brightness)
+        return GCommandQueue.KEY_EFFECT, lambda device: device.send_cycle_command(speed=speed, brightness=brightness), True
+
     # Public
     def set_color_at(self, device_name, color, field):
-        device = self.open_device(device_name)
-        try:
-            if device is not None:
-                print("set_color_at('{}', '{}', {})".format(device_name, color, field))
-                device.send_color_command(color, field)
-            else:
-                raise GDeviceException("Device '{}' not found".format(device_name))
-        finally:
-            self.close_device(device)
+        print("set_color_at('{}', '{}', {})".format(device_name, color, field))
+        return self.dispatch_command(device_name, *self.prepare_color_at(color, field))
 
     # Public
     def set_colors(self, device_name, colors):
-        device = self.open_device(device_name)
-        try:
-            if device is not None:
-                print("set_colors('{}', {})".format(device_name, colors))
-                device.send_colors_command(colors)
-            else:
-                raise GDeviceException("Device '{}' not found".format(device_name))
-        finally:
-            self.close_device(device)
+        print("set_colors('{}', {})".format(device_name, colors))
+        return self.dispatch_command(device_name, *self.prepare_colors(colors))
 
     # Public
     def set_breathe(self, device_name, color, speed, brightness):
-        device = self.open_device(device_name)
-        try:
-            if device is not None:
-                print("set_breathe('{}', '{}', {}, {})".format(device_name, color, speed, brightness))
-                device.send_breathe_command(
-                    color=color,
-                    speed=self.unmarshall_num_par(speed),
-                    brightness=self.unmarshall_num_par(brightness))
-            else:
-                raise GDeviceException("Device '{}' not found".format(device_name))
-        finally:
-            self.close_device(device)
+        print("set_breathe('{}', '{}', {}, {})".format(device_name, color, speed, brightness))
+        return self.dispatch_command(device_name, *self.prepare_breathe(color, speed, brightness))
 
     # Public
     def set_cycle(self, device_name, speed, brightness):
-        device = self.open_device(device_name)
-        try:
-            if device is not None:
-                print("set_cycle('{}', {}, {})".format(device_name, speed, brightness))
-                device.send_cycle_command(
-                    speed=self.unmarshall_num_par(speed),
-                    brightness=self.unmarshall_num_par(brightness))
-            else:
-                raise GDeviceException("Device '{}' not found".format(device_name))
-        finally:
-            self.close_device(device)
+        print("set_cycle('{}', {}, {})".format(device_name, speed, brightness))
+        return self.dispatch_command(device_name, *self.prepare_cycle(speed, brightness))
+
+    # Public
+    def set_color_at_async(self, device_name, color, field):
+        print("set_color_at_async('{}', '{}', {})".format(device_name, color, field))
+        return self.submit_request(device_name, *self.prepare_color_at(color, field))
+
+    # Public
+    def set_colors_async(self, device_name, colors):
+        print("set_colors_async('{}', {})".format(device_name, colors))
+        return self.submit_request(device_name, *self.prepare_colors(colors))
+
+    # Public
+    def set_breathe_async(self, device_name, color, speed, brightness):
+        print("set_breathe_async('{}', '{}', {}, {})".format(device_name, color, speed, brightness))
+        return self.submit_request(device_name, *self.prepare_breathe(color, speed, brightness))
+
+    # Public
+    def set_cycle_async(self, device_name, speed, brightness):
+        print("set_cycle_async('{}', {}, {})".format(device_name, speed, brightness))
+        return self.submit_request(device_name, *self.prepare_cycle(speed, brightness))
+
+    # Public
+    def get_stats(self):
+        return json.dumps(self.collect_stats())
 
     # Public
     def echo(self, s):
         """returns whatever is passed to it"""
-        self.lock.acquire()
         print("echo('{}')".format(s))
-        self.lock.release()
         return s
 
     # Public
     def quit(self):
         """removes this object from the DBUS connection and exits"""
-        self.lock.acquire()
         if self.loop is not None:
             self.loop.quit()
-        self.lock.release()
 
 
 class GlightClient(GlightRemoteCommon):
@@ -1365,6 +4614,38 @@ class GlightClient(GlightRemoteCommon):
             self.marshall_num_par(speed),
             self.marshall_num_par(brightness))
 
+    def set_color_at_async(self, device, color, field):
+        """:return: request id, see subscribe_requests"""
+        return self.proxy.set_color_at_async(device, color, field)
+
+    def set_colors_async(self, device, colors):
+        """:return: request id, see subscribe_requests"""
+        return self.proxy.set_colors_async(device, colors)
+
+    def set_breathe_async(self, device, color, speed, brightness):
+        """:return: request id, see subscribe_requests"""
+        return self.proxy.set_breathe_async(
+            device,
+            color,
+            self.marshall_num_par(speed),
+            self.marshall_num_par(brightness))
+
+    def set_cycle_async(self, device, speed, brightness):
+        """:return: request id, see subscribe_requests"""
+        return self.proxy.set_cycle_async(
+            device,
+            self.marshall_num_par(speed),
+            self.marshall_num_par(brightness))
+
+    def broadcast(self, devices, command, params_json):
+        return self.proxy.broadcast(devices, command, params_json)
+
+    def apply_batch(self, operations_json):
+        return self.proxy.apply_batch(operations_json)
+
+    def get_stats(self):
+        return self.proxy.get_stats()
+
     def echo(self, s):
         return self.proxy.echo(s)
 
@@ -1382,6 +4663,37 @@ class GlightClient(GlightRemoteCommon):
         """
         self.bus.subscribe(object=dbus_filter, signal_fired=callback)
 
+    def subscribe_presence(self, callback):
+        """
+        :param callback: called with (device_name_short, is_present) when a device is attached or detached
+        """
+        self.proxy.DevicePresenceChanged.connect(callback)
+
+    def subscribe_state(self, callback):
+        """
+        :param callback: called with (device_name_short, state dict, missed) after the state of a device changed,
+                         missed is the number of StateChanged signals of the device that were not received,
+                         call get_state to catch up if it is not 0
+        """
+        last_seqs = {}
+
+        def on_state_changed(device_name, seq, state_json):
+            last_seq = last_seqs.get(device_name)
+            # the numbers start again at 1 when the service was restarted
+            missed = seq - last_seq - 1 if last_seq is not None and seq > last_seq else 0
+            last_seqs[device_name] = seq
+            callback(device_name, json.loads(state_json), missed)
+
+        self.proxy.StateChanged.connect(on_state_changed)
+
+    def subscribe_requests(self, on_completed, on_failed):
+        """
+        :param on_completed: called with (request_id, device_name_short) when an async request was sent
+        :param on_failed: called with (request_id, device_name_short, error) when it failed or was superseded
+        """
+        self.proxy.RequestCompleted.connect(on_completed)
+        self.proxy.RequestFailed.connect(on_failed)
+
     def do(self):
 
         print(GlightService.bus_name)
@@ -1409,6 +4721,527 @@ class GlightClient(GlightRemoteCommon):
 
 # App handling ----------------------------------------------------------------
 
+class GFrameSocket(object):
+    """
+    Messages of the frame socket. The SOCK_SEQPACKET socket keeps the messages apart, so each one is a
+    little endian header followed by its payload.
+    """
+
+    DEFAULT_PATH = "/run/glight-frames.sock"
+    VERSION = 1
+    MAX_MESSAGE_SIZE = 4096
+
+    MSG_HELLO = 1  # service > client: version, credits, then the device names separated by zero bytes
+    MSG_FRAME = 2  # client > service: device id, frame number, then 3 bytes RGB per field
+    MSG_ACK   = 3  # service > client: device id, frame number, status, gives the credit of the frame back
+
+    HELLO_FORMAT = "<BBH"
+    FRAME_FORMAT = "<BBI"
+    ACK_FORMAT   = "<BBIB"
+
+    STATUS_SENT       = 0
+    STATUS_SUPERSEDED = 1  # a newer frame of the device was sent instead
+    STATUS_FAILED     = 2
+    STATUS_REJECTED   = 3  # malformed frame, unknown device or no credit left
+
+    STATUS_NAMES = ["sent", "superseded", "failed", "rejected"]
+
+    @staticmethod
+    def encode_colors(colors):
+        return binascii.unhexlify("".join(colors))
+
+    @staticmethod
+    def decode_colors(data):
+        colors = binascii.hexlify(data).decode("ascii")
+        return [colors[i:i + 6] for i in range(0, len(colors), 6)]
+
+
+class GFrameSocketConnection(object):
+    """Client connected to the GFrameSocketServer"""
+
+    def __init__(self, sock, uid):
+        self.sock = sock
+        self.uid = uid
+        self.in_flight = 0  # frames not acknowledged yet
+        self.send_lock = Lock()
+        self.device_names = []  # the device id of a frame is the index of the device in this list
+
+    def send(self, data):
+        """Sends one message, the workers of several devices acknowledge concurrently"""
+        with self.send_lock:
+            try:
+                self.sock.send(data)
+            except (socket.error, OSError):
+                pass  # the client is gone, its reader ends the connection
+
+
+class GFrameSocketServer(object):
+    """
+    Local endpoint for streaming frames without DBUS. Frames go to the latest-wins frame slot of the
+    command queue of the device, so the device sets the pace. Every frame is acknowledged with its outcome
+    and a client may only have as many frames unacknowledged as it got credits.
+    """
+
+    DEFAULT_CREDITS = 4
+
+    def __init__(self, service, path=None, allowed_uids=None, credits=DEFAULT_CREDITS, verbose=False):
+        """
+        :param service: GlightService
+        :param allowed_uids: users allowed to stream frames besides root and the user of the service
+        """
+        self.service = service
+        self.path = path or GFrameSocket.DEFAULT_PATH
+        self.allowed_uids = set(allowed_uids or []) | {0, os.getuid()}
+        self.credits = credits
+        self.verbose = verbose
+
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.lock = Lock()
+        self.connections = []
+
+        self.stats = {"connections": 0, "refused": 0, "frames": 0}
+        for status in GFrameSocket.STATUS_NAMES:
+            self.stats[status] = 0
+
+    def start(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            if self.is_in_use():
+                raise GControllerException("Frame socket '{}' is used by another service".format(self.path))
+            os.remove(self.path)  # left behind by a service that was killed
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.path)
+        # everybody may connect, the credentials of the peer decide
+        os.chmod(self.path, 0o666)
+        self.sock.listen(4)
+        self.running = True
+
+        self.thread = Thread(target=self._accept, name="glight-frame-socket")
+        self.thread.daemon = True
+        self.thread.start()
+        print("Streaming frames on '{}'".format(self.path))
+
+    def is_in_use(self):
+        """:return: True if a service still accepts connections on the socket path"""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            probe.connect(self.path)
+            return True
+        except (socket.error, OSError):
+            return False
+        finally:
+            probe.close()
+
+    def get_device_names(self):
+        """
+        Every known device gets an id, not only the attached ones, so a device attached later is addressable.
+        Its presence is checked when a frame for it is queued.
+        """
+        return [device.device_name_short for device in self.service.device_registry.known_devices]
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            connections = list(self.connections)
+        for connection in [self] + connections:
+            try:
+                # wakes up the threads blocked in accept and recv
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass
+        self.sock.close()
+        self.thread.join(1.0)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _accept(self):
+        while self.running:
+            try:
+                sock, _ = self.sock.accept()
+            except (socket.error, OSError):
+                break
+
+            creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+            pid, uid, gid = struct.unpack("3i", creds)
+            if uid not in self.allowed_uids:
+                print("Refused frame socket connection of process {} (uid {})".format(pid, uid))
+                with self.lock:
+                    self.stats["refused"] += 1
+                sock.close()
+                continue
+
+            connection = GFrameSocketConnection(sock, uid)
+            with self.lock:
+                self.connections.append(connection)
+                self.stats["connections"] += 1
+            thread = Thread(target=self._serve, args=(connection,), name="glight-frame-socket-{}".format(pid))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        try:
+            connection.device_names = self.get_device_names()
+            names = b"\0".join(name.encode("ascii") for name in connection.device_names)
+            connection.send(struct.pack(GFrameSocket.HELLO_FORMAT, GFrameSocket.MSG_HELLO, GFrameSocket.VERSION,
+                                        self.credits) + names)
+            while self.running:
+                data = connection.sock.recv(GFrameSocket.MAX_MESSAGE_SIZE)
+                if not data:
+                    break
+                self.handle_frame(connection, data)
+        except (socket.error, OSError) as ex:
+            if self.running:
+                print("Frame socket connection failed: {}".format(ex))
+        finally:
+            with self.lock:
+                self.connections.remove(connection)
+            connection.sock.close()
+
+    def handle_frame(self, connection, data):
+        header_size = struct.calcsize(GFrameSocket.FRAME_FORMAT)
+        if len(data) < header_size:
+            self.send_ack(connection, 0, 0, GFrameSocket.STATUS_REJECTED)
+            return
+
+        msg_type, device_id, frame = struct.unpack_from(GFrameSocket.FRAME_FORMAT, data)
+        payload = data[header_size:]
+        if (msg_type != GFrameSocket.MSG_FRAME or device_id >= len(connection.device_names)
+                or len(payload) == 0 or len(payload) % 3 != 0):
+            self.send_ack(connection, device_id, frame, GFrameSocket.STATUS_REJECTED)
+            return
+
+        with self.lock:
+            self.stats["frames"] += 1
+            has_credit = connection.in_flight < self.credits
+            if has_credit:
+                connection.in_flight += 1
+        if not has_credit:
+            self.send_ack(connection, device_id, frame, GFrameSocket.STATUS_REJECTED)
+            return
+
+        colors = GFrameSocket.decode_colors(payload)
+        on_done = lambda error, dropped: self.on_frame_done(connection, device_id, frame, error, dropped)
+        try:
+            self.service.queue_command(connection.device_names[device_id], GCommandQueue.KEY_FRAME,
+                                       lambda device: device.send_colors_command(colors),
+                                       replaces_all=True, on_done=on_done)
+        except Exception as ex:
+            on_done(ex, False)
+
+    def on_frame_done(self, connection, device_id, frame, error, dropped):
+        if error is None:
+            status = GFrameSocket.STATUS_SENT
+        elif dropped:
+            status = GFrameSocket.STATUS_SUPERSEDED
+        else:
+            status = GFrameSocket.STATUS_FAILED
+            if self.verbose:
+                print("Frame {} of device '{}' failed: {}".format(frame, connection.device_names[device_id], error))
+        with self.lock:
+            connection.in_flight -= 1
+        self.send_ack(connection, device_id, frame, status)
+
+    def send_ack(self, connection, device_id, frame, status):
+        with self.lock:
+            self.stats[GFrameSocket.STATUS_NAMES[status]] += 1
+        connection.send(struct.pack(GFrameSocket.ACK_FORMAT, GFrameSocket.MSG_ACK, device_id, frame, status))
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["open"] = len(self.connections)
+        stats["credits"] = self.credits
+        return stats
+
+
+class GFrameSocketClient(object):
+    """Streams frames to the GFrameSocketServer, blocks while all credits are in use"""
+
+    def __init__(self, path=None, timeout=5.0, verbose=False):
+        """
+        :param timeout: seconds to wait for the service
+        """
+        self.path = path or GFrameSocket.DEFAULT_PATH
+        self.timeout = timeout
+        self.verbose = verbose
+
+        self.sock = None
+        self.credits = 0
+        self.device_ids = OrderedDict()  # device_name_short -> device id
+        self.last_frame = 0
+        self.in_flight = 0
+        self.acks = dict((status, 0) for status in GFrameSocket.STATUS_NAMES)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+        data = self.sock.recv(GFrameSocket.MAX_MESSAGE_SIZE)
+        header_size = struct.calcsize(GFrameSocket.HELLO_FORMAT)
+        if len(data) < header_size:
+            self.close()
+            raise GControllerException("The service refused the frame socket connection")
+        msg_type, version, self.credits = struct.unpack_from(GFrameSocket.HELLO_FORMAT, data)
+        if msg_type != GFrameSocket.MSG_HELLO or version != GFrameSocket.VERSION:
+            self.close()
+            raise GControllerException("Unsupported frame socket version {}".format(version))
+
+        self.device_ids = OrderedDict()
+        for device_id, name in enumerate(data[header_size:].split(b"\0")):
+            self.device_ids[name.decode("ascii")] = device_id
+
+    def send_frame(self, device_name, colors):
+        """
+        :param colors: str[] one color per field, a single color sets the whole device
+        :return: int number of the frame
+        """
+        if device_name not in self.device_ids:
+            raise GControllerException("Could not find device '{}'".format(device_name))
+        for color in colors:
+            GDevice.assert_valid_color(color)
+
+        while self.in_flight >= self.credits:
+            self.receive_ack()
+
+        self.last_frame = (self.last_frame + 1) & 0xffffffff
+        self.sock.send(struct.pack(GFrameSocket.FRAME_FORMAT, GFrameSocket.MSG_FRAME, self.device_ids[device_name],
+                                   self.last_frame) + GFrameSocket.encode_colors(colors))
+        self.in_flight += 1
+        return self.last_frame
+
+    def receive_ack(self):
+        """:return: (device id, frame, status)"""
+        data = self.sock.recv(GFrameSocket.MAX_MESSAGE_SIZE)
+        if not data:
+            raise GControllerException("The service closed the frame socket")
+        msg_type, device_id, frame, status = struct.unpack_from(GFrameSocket.ACK_FORMAT, data)
+        self.in_flight -= 1
+        self.acks[GFrameSocket.STATUS_NAMES[status]] += 1
+        if self.verbose and status != GFrameSocket.STATUS_SENT:
+            print("Frame {} was {}".format(frame, GFrameSocket.STATUS_NAMES[status]))
+        return device_id, frame, status
+
+    def flush(self):
+        """Waits until all frames are acknowledged"""
+        while self.in_flight > 0:
+            self.receive_ack()
+
+    def get_stats(self):
+        stats = dict(self.acks)
+        stats["credits"] = self.credits
+        stats["in_flight"] = self.in_flight
+        return stats
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class GFrameBuffer(object):
+    """
+    Colors of one device in a memory mapped file, written by a producer and sampled by the service.
+    The writer makes the sequence number odd while it updates the colors and even again when it is done,
+    a copy taken between two reads of the same even number is a complete frame.
+    """
+
+    DEFAULT_DIR = "/dev/shm"
+    MAGIC = b"GLFB"
+    VERSION = 1
+
+    HEADER_FORMAT = "<4sBBH"  # magic, version, fields, reserved
+    SEQ_FORMAT = "<I"
+    SEQ_OFFSET = 8
+    COUNT_FORMAT = "<B"       # colors of the last frame
+    COUNT_OFFSET = 12
+    COLORS_OFFSET = 16        # 3 bytes RGB per field
+
+    def __init__(self, path, fields=None, uid=None, gid=None):
+        """
+        :param fields: creates the buffer for that many colors, None opens an existing one
+        :param uid: user owning a created buffer, None keeps the user of the service
+        :param gid: group owning a created buffer, its members may write frames
+        """
+        self.path = path
+        if fields is not None:
+            size = GFrameBuffer.COLORS_OFFSET + 3 * fields
+            fd = GFrameBuffer.create_file(path)
+            try:
+                if uid is not None or gid is not None:
+                    os.fchown(fd, -1 if uid is None else uid, -1 if gid is None else gid)
+                os.fchmod(fd, 0o660)  # not narrowed by the umask
+                os.ftruncate(fd, size)
+                self.map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            struct.pack_into(GFrameBuffer.HEADER_FORMAT, self.map, 0, GFrameBuffer.MAGIC, GFrameBuffer.VERSION, fields, 0)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+            try:
+                self.map = mmap.mmap(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            magic, version, fields, _ = struct.unpack_from(GFrameBuffer.HEADER_FORMAT, self.map, 0)
+            if magic != GFrameBuffer.MAGIC or version != GFrameBuffer.VERSION:
+                self.map.close()
+                raise GControllerException("'{}' is not a frame buffer of version {}".format(path, GFrameBuffer.VERSION))
+        self.fields = fields
+
+    @staticmethod
+    def create_file(path):
+        """
+        Creates a new file, whatever was planted at the path of the world writable directory is removed first
+        and a file or link put there in between makes the creation fail
+        """
+        try:
+            os.unlink(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        try:
+            return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        except OSError as ex:
+            raise GControllerException("Could not create frame buffer '{}': {}".format(path, ex))
+
+    @staticmethod
+    def get_path(directory, device_name):
+        return os.path.join(directory or GFrameBuffer.DEFAULT_DIR, "glight-" + device_name)
+
+    def get_seq(self):
+        return struct.unpack_from(GFrameBuffer.SEQ_FORMAT, self.map, GFrameBuffer.SEQ_OFFSET)[0]
+
+    def write(self, colors):
+        """Writes a frame, colors beyond the fields of the device are dropped"""
+        data = GFrameSocket.encode_colors(colors[0:self.fields])
+        seq = self.get_seq() & ~1
+        struct.pack_into(GFrameBuffer.SEQ_FORMAT, self.map, GFrameBuffer.SEQ_OFFSET, (seq + 1) & 0xffffffff)
+        self.map[GFrameBuffer.COLORS_OFFSET:GFrameBuffer.COLORS_OFFSET + len(data)] = data
+        struct.pack_into(GFrameBuffer.COUNT_FORMAT, self.map, GFrameBuffer.COUNT_OFFSET, len(data) // 3)
+        struct.pack_into(GFrameBuffer.SEQ_FORMAT, self.map, GFrameBuffer.SEQ_OFFSET, (seq + 2) & 0xffffffff)
+
+    def read(self):
+        """:return: (seq, colors), None while the writer is busy"""
+        seq = self.get_seq()
+        if seq & 1:
+            return None
+        count = struct.unpack_from(GFrameBuffer.COUNT_FORMAT, self.map, GFrameBuffer.COUNT_OFFSET)[0]
+        data = self.map[GFrameBuffer.COLORS_OFFSET:GFrameBuffer.COLORS_OFFSET + 3 * min(count, self.fields)]
+        if self.get_seq() != seq:
+            return None
+        return seq, GFrameSocket.decode_colors(data)
+
+    def close(self):
+        self.map.close()
+
+
+class GFrameBufferProducer(object):
+    """Writes frames to the frame buffers of the service, can stand in for GlightController.set_colors"""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.buffers = {}  # device_name_short -> GFrameBuffer
+
+    def set_colors(self, device_name, colors):
+        for color in colors:
+            GDevice.assert_valid_color(color)
+        buffer = self.buffers.get(device_name)
+        if buffer is None:
+            path = GFrameBuffer.get_path(self.directory, device_name)
+            if not os.path.exists(path):
+                raise GControllerException("No frame buffer for device '{}' at '{}'".format(device_name, path))
+            buffer = GFrameBuffer(path)
+            self.buffers[device_name] = buffer
+        buffer.write(colors)
+
+    def close(self):
+        for buffer in self.buffers.values():
+            buffer.close()
+        self.buffers = {}
+
+
+class GFrameBufferSampler(object):
+    """
+    Samples the frame buffers of the service at a fixed rate and queues each new frame in the
+    latest-wins frame slot of the device, so producers and devices run at their own rates.
+    """
+
+    DEFAULT_RATE = 30.0  # samples per second
+
+    def __init__(self, service, directory=None, rate=None, uid=None, gid=None, verbose=False):
+        """
+        :param service: GlightService
+        :param uid: user owning the buffers, see GFrameBuffer
+        :param gid: group owning the buffers, its members may write frames
+        """
+        self.service = service
+        self.directory = directory or GFrameBuffer.DEFAULT_DIR
+        self.rate = GFrameBufferSampler.DEFAULT_RATE if rate is None else rate
+        if self.rate <= 0:
+            raise GControllerException("Sample rate must be positive, not {}".format(self.rate))
+        self.uid = uid
+        self.gid = gid
+        self.verbose = verbose
+        self.timer = None
+        self.buffers = OrderedDict()  # device_name_short -> GFrameBuffer
+        self.last_seqs = {}  # device_name_short -> sequence number of the last frame queued
+
+        self.stats = {"samples": 0, "frames": 0, "busy": 0, "failed": 0}
+
+    def start(self):
+        for device in self.service.device_registry.known_devices:
+            name = device.device_name_short
+            self.buffers[name] = GFrameBuffer(GFrameBuffer.get_path(self.directory, name), max(device.max_color_fields, 1),
+                                              self.uid, self.gid)
+            self.last_seqs[name] = 0
+        # rates above 1000 Hz sample every millisecond
+        self.timer = GLib.timeout_add(max(1, int(1000 / self.rate)), self.on_timer)
+        print("Sampling frame buffers in '{}' at {} Hz".format(self.directory, self.rate))
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        for buffer in self.buffers.values():
+            buffer.close()
+            if os.path.exists(buffer.path):
+                os.remove(buffer.path)
+        self.buffers = OrderedDict()
+
+    def on_timer(self):
+        self.sample()
+        return True
+
+    def sample(self):
+        """Queues the frames written since the last sample"""
+        self.stats["samples"] += 1
+        for name, buffer in self.buffers.items():
+            frame = buffer.read()
+            if frame is None:
+                self.stats["busy"] += 1  # picked up with the next sample
+                continue
+            seq, colors = frame
+            if seq == self.last_seqs[name] or len(colors) == 0:
+                continue
+            self.last_seqs[name] = seq
+            try:
+                self.service.queue_command(name, GCommandQueue.KEY_FRAME,
+                                           lambda device, colors=colors: device.send_colors_command(colors),
+                                           replaces_all=True)
+                self.stats["frames"] += 1
+            except Exception as ex:
+                self.stats["failed"] += 1
+                if self.verbose:
+                    print("Could not queue frame of device '{}': {}".format(name, ex))
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["rate"] = self.rate
+        return stats
+
+
 class GlightApp(object):
 
     @staticmethod
@@ -1429,18 +5262,51 @@ class GlightApp(object):
         argsparser = argparse.ArgumentParser(
             description='Changes the colors on some Logitech devices (V' + app_version + ')', add_help=False)
 
-        argsparser.add_argument('-d', '--device',  dest='device',  nargs='?', action='store', help='select device (#DEVICES)', metavar='device_name')
+        argsparser.add_argument('-d', '--device',  dest='device',  nargs='+', action='store', help='select device(s) (#DEVICES), several devices are set at once', metavar='device_name')
         argsparser.add_argument('-c', '--color',   dest='colors',  nargs='+', action='store', help='set color(s)', metavar='color')
         argsparser.add_argument('-x', '--cycle',   dest='cycle',   nargs='+', action='store', help='set color cycle animation',  metavar='#X') #,  metavar='speed [brightness]')
         argsparser.add_argument('-b', '--breathe', dest='breathe', nargs='+', action='store', help='set breathing animation',  metavar='#B') #, metavar='color [speed [brightness]]')
-        argsparser.add_argument('--backend',       dest='backend', nargs=1,   action='store', help='set backend (usb1, pyusb), usb1 is strongly recommended', metavar='(usb1|pyusb)')
+        argsparser.add_argument('--backend',       dest='backend', nargs=1,   action='store',
+                                choices=[UsbBackend.TYPE_USB1, UsbBackend.TYPE_PYUSB, UsbBackend.TYPE_HIDRAW, UsbBackend.TYPE_SIM], help='set backend (usb1, pyusb, hidraw, sim), usb1 is strongly recommended, sim simulates the devices', metavar='(usb1|pyusb|hidraw|sim)')
+        argsparser.add_argument('--pacing',        dest='pacing',  nargs='?', action='store', choices=[GDevice.PACING_ACK, GDevice.PACING_FIXED],
+                                help='send the next command on the device ack or after fixed delays', metavar='(ack|fixed)')
+        argsparser.add_argument('--async-depth',   dest='async_depth', nargs='?', action='store', type=int,
+                                help='queue up to n asynchronous control transfers per device (usb1 only)', metavar='n')
+        argsparser.add_argument('--detach-mode',   dest='detach_mode', nargs='?', action='store', choices=[UsbBackend.DETACH_MANUAL, UsbBackend.DETACH_AUTO],
+                                help='detach the kernel driver manually or let libusb do it on claim (usb1 only)', metavar='(manual|auto)')
+        argsparser.add_argument('--request-timeout', dest='request_timeout', nargs='?', action='store', type=float,
+                                help='seconds a command may take including the USB transfers (default 1)', metavar='seconds')
+        argsparser.add_argument('--failure-threshold', dest='failure_threshold', nargs='?', action='store', type=int,
+                                help='reject commands to a device after n failures in a row until it recovers (default 3)', metavar='n')
+        argsparser.add_argument('--trace-file',    dest='trace_file', nargs='?', action='store', help='capture all packets sent to the devices to a binary trace file', metavar='filename')
+        argsparser.add_argument('--replay',        dest='replay',  nargs='?', action='store', help='send the packets of a trace file to the devices again', metavar='filename')
+        argsparser.add_argument('--replay-speed',  dest='replay_speed', nargs='?', action='store', type=float, default=1.0,
+                                help='1 keeps the timing of the trace, 2 replays twice as fast, 0 as fast as possible', metavar='factor')
+        argsparser.add_argument('--dedup',         dest='dedup',   action='store_const', const=True, help='skip commands that would not change the state of the device')
 
         argsparser.add_argument('--state-file',    dest='state_file', nargs='?', action='store', help='file where the state is saved', metavar='filename')
+        argsparser.add_argument('--save-delay',    dest='save_delay', nargs='?', action='store', type=float,
+                                help='seconds until the service writes a saved state to the state file (default {:g})'.format(GlightService.DEFAULT_SAVE_DELAY), metavar='seconds')
         argsparser.add_argument('--load-state',    dest='load_state', action='store_const', const=True, help='load state from state file')
         argsparser.add_argument('--save-state',    dest='save_state', action='store_const', const=True, help='save state to state file')
 
         argsparser.add_argument('-C', '--client',  dest='client',  action='store_const', const=True, help='run as client')
         argsparser.add_argument('--service',       dest='service', action='store_const', const=True, help='run as service')
+        argsparser.add_argument('--coalesce',      dest='coalesce', action='store_const', const=True, help='return once a color or effect call is queued, newer calls replace unsent ones (service only)')
+        argsparser.add_argument('--frame-socket',  dest='frame_socket', nargs='?', action='store', const=GFrameSocket.DEFAULT_PATH,
+                                help='stream frames over a local socket, offered by the service and used by the client (default {})'.format(GFrameSocket.DEFAULT_PATH), metavar='path')
+        argsparser.add_argument('--frame-socket-uid', dest='frame_socket_uids', nargs='+', action='store', type=int,
+                                help='users allowed to stream frames besides root and the user of the service', metavar='uid')
+        argsparser.add_argument('--frame-buffer',  dest='frame_buffer', nargs='?', action='store', const=GFrameBuffer.DEFAULT_DIR,
+                                help='offer a shared memory frame buffer per device in the directory (service only, default {})'.format(GFrameBuffer.DEFAULT_DIR), metavar='directory')
+        argsparser.add_argument('--frame-buffer-rate', dest='frame_buffer_rate', nargs='?', action='store', type=float,
+                                help='samples of the frame buffers per second (default {:g})'.format(GFrameBufferSampler.DEFAULT_RATE), metavar='hz')
+        argsparser.add_argument('--frame-buffer-uid', dest='frame_buffer_uid', nargs='?', action='store', type=int,
+                                help='user owning the frame buffers, may write frames', metavar='uid')
+        argsparser.add_argument('--frame-buffer-gid', dest='frame_buffer_gid', nargs='?', action='store', type=int,
+                                help='group owning the frame buffers, its members may write frames', metavar='gid')
+        argsparser.add_argument('--idle-timeout',  dest='idle_timeout', nargs='?', action='store', type=float, help='seconds until an idle device is given back to the kernel (0 releases after every call)', metavar='seconds')
+        argsparser.add_argument('--stats',         dest='stats',   action='store_const', const=True, help='print the latency statistics of the devices (of the service in client mode)')
         argsparser.add_argument('-l', '--list',    dest='do_list', action='store_const', const=True, help='list devices')
         argsparser.add_argument('-v', '--verbose', dest='verbose', action='store_const', const=True, help='be verbose')
         argsparser.add_argument('-h', '--help',    dest='help',    action='store_const', const=True, help='show help')
@@ -1512,85 +5378,163 @@ class GlightApp(object):
 
         return args
 
+    @staticmethod
+    def get_registry_options(args):
+        """Options for the GDeviceRegistry used locally or by the service"""
+        options = {}
+        if args.backend is not None:
+            options["backend_type"] = args.backend[0]
+        if args.pacing is not None:
+            options["pacing"] = args.pacing
+        if args.async_depth is not None:
+            options["async_depth"] = args.async_depth
+        if args.detach_mode is not None:
+            options["detach_mode"] = args.detach_mode
+        if args.dedup:
+            options["dedup"] = True
+        if args.request_timeout is not None:
+            options["request_timeout"] = args.request_timeout
+        if args.failure_threshold is not None:
+            options["failure_threshold"] = args.failure_threshold
+        if args.trace_file is not None:
+            options["trace_file"] = args.trace_file
+        return options
+
     @staticmethod
     def handle(args, verbose=False):
         """"""
-        if args.service:
-            srv = GlightService(state_file=args.state_file, verbose=verbose)
+        registry_options = GlightApp.get_registry_options(args)
+
+        if args.replay:
+            GlightApp.run_replay(args, registry_options, verbose)
+
+        elif args.service:
+            srv = GlightService(state_file=args.state_file, verbose=verbose, idle_timeout=args.idle_timeout,
+                                registry_options=registry_options, coalesce=bool(args.coalesce),
+                                frame_socket=args.frame_socket, frame_socket_uids=args.frame_socket_uids,
+                                frame_buffer=args.frame_buffer, frame_buffer_rate=args.frame_buffer_rate,
+                                frame_buffer_uid=args.frame_buffer_uid, frame_buffer_gid=args.frame_buffer_gid,
+                                save_delay=args.save_delay)
             srv.run()
             sys.exit(0) # Ends here
 
         else:
             backend_type = GlightController.BACKEND_LOCAL
-            if args.client:
+            if args.frame_socket:
+                backend_type = GlightController.BACKEND_SOCKET
+            elif args.client:
                 backend_type = GlightController.BACKEND_DBUS
-            client = GlightController(backend_type, verbose=verbose)
-
-            # Saving state
-            if args.load_state:
-                if verbose:
-                    if args.state_file is None:
-                        print("Loading state remotely")
-                    else:
-                        print("Loading state from {}".format(args.state_file))
-                client.load_state(args.state_file)
-
-            # Listing devices
-            if args.do_list:
-                devices = client.list_devices()
-                print("{} devices:".format(len(devices)))
-                i = 0
-                for device_name_short, device_name in devices.items():
-                    i = i + 1
-                    print("[{}] {} ({})".format(i, device_name, device_name_short))
-
-            # Setting colors
-            if args.colors is not None:
-                if verbose:
-                    print("Setting device {} colors to {}"
-                          .format(args.device, args.colors))
+            # without --idle-timeout the devices stay claimed for all commands and are given back once on close
+            client = GlightController(backend_type, verbose=verbose, registry_options=registry_options,
+                                      idle_timeout=args.idle_timeout, frame_socket=args.frame_socket)
+
+            try:
+                GlightApp.handle_controller(client, args, verbose)
+            finally:
+                client.close()
+
+    @staticmethod
+    def handle_controller(client, args, verbose=False):
+        """
+        :param client: GlightController
+        """
+        device_names = args.device or [None]
+        # printed like a single device name was before
+        device_label = ", ".join(args.device) if args.device else None
+
+        # Saving state
+        if args.load_state:
+            if verbose:
+                if args.state_file is None:
+                    print("Loading state remotely")
+                else:
+                    print("Loading state from {}".format(args.state_file))
+            client.load_state(args.state_file)
+
+        # Listing devices
+        if args.do_list:
+            devices = client.list_devices()
+            print("{} devices:".format(len(devices)))
+            i = 0
+            for device_name_short, device_name in devices.items():
+                i = i + 1
+                print("[{}] {} ({})".format(i, device_name, device_name_short))
+
+        # Setting colors
+        if args.colors is not None:
+            if verbose:
+                print("Setting device {} colors to {}"
+                      .format(device_label, args.colors))
+            if len(device_names) > 1:
+                GlightApp.handle_broadcast(client, device_names, "colors", verbose, colors=args.colors)
+            else:
                 client.set_colors(
-                    device_name=args.device,
+                    device_name=device_names[0],
                     colors=args.colors)
 
-            # Setting breathing
-            if args.breathe is not None:
-                color = GlightApp.get_val_at(args.breathe, 0)
-                speed = GlightApp.get_num_at(args.breathe, 1)
-                brightness = GlightApp.get_num_at(args.breathe, 2)
+        # Setting breathing
+        if args.breathe is not None:
+            color = GlightApp.get_val_at(args.breathe, 0)
+            speed = GlightApp.get_num_at(args.breathe, 1)
+            brightness = GlightApp.get_num_at(args.breathe, 2)
 
-                if verbose:
-                    print("Setting device {} breathe mode to color {}, speed {}, brightness {}"
-                          .format(args.device, color, speed, brightness))
+            if verbose:
+                print("Setting device {} breathe mode to color {}, speed {}, brightness {}"
+                      .format(device_label, color, speed, brightness))
 
+            if len(device_names) > 1:
+                GlightApp.handle_broadcast(client, device_names, "breathe", verbose,
+                                           color=color, speed=speed, brightness=brightness)
+            else:
                 client.set_breathe(
-                    device_name=args.device,
+                    device_name=device_names[0],
                     color=color,
                     speed=speed,
                     brightness=brightness)
 
-            # Setting cycle
-            if args.cycle is not None:
-                speed = GlightApp.get_num_at(args.cycle, 0)
-                brightness = GlightApp.get_num_at(args.cycle, 1)
+        # Setting cycle
+        if args.cycle is not None:
+            speed = GlightApp.get_num_at(args.cycle, 0)
+            brightness = GlightApp.get_num_at(args.cycle, 1)
 
-                if verbose:
-                    print("Setting device {} cycle mode to speed {}, brightness {}"
-                          .format(args.device, speed, brightness))
+            if verbose:
+                print("Setting device {} cycle mode to speed {}, brightness {}"
+                      .format(device_label, speed, brightness))
 
+            if len(device_names) > 1:
+                GlightApp.handle_broadcast(client, device_names, "cycle", verbose,
+                                           speed=speed, brightness=brightness)
+            else:
                 client.set_cycle(
-                    device_name=args.device,
+                    device_name=device_names[0],
                     speed=speed,
                     brightness=brightness)
 
-            # Saving state
-            if args.save_state:
-                if verbose:
-                    if args.state_file is None:
-                        print("Saving state remotely")
-                    else:
-                        print("Saving state to {}".format(args.state_file))
-                client.save_state(args.state_file)
+        # Saving state
+        if args.save_state:
+            if verbose:
+                if args.state_file is None:
+                    print("Saving state remotely")
+                else:
+                    print("Saving state to {}".format(args.state_file))
+            client.save_state(args.state_file)
+
+        # Dumping statistics
+        if args.stats:
+            print(json.dumps(client.get_stats(), indent=4, sort_keys=True))
+
+    @staticmethod
+    def handle_broadcast(client, device_names, command, verbose=False, **params):
+        """
+        :param client: GlightController
+        """
+        report = client.broadcast(device_names, command, **params)
+        if verbose:
+            print("Sent to {} devices in {:.1f} ms, start skew {:.1f} ms"
+                  .format(len(report["devices"]), report["total_ms"], report["start_skew_ms"]))
+        failed = ["{} ({})".format(name, result["error"]) for name, result in report["devices"].items() if not result["ok"]]
+        if len(failed) > 0:
+            raise GControllerException("Failed to set device(s) {}".format(", ".join(failed)))
 
     @staticmethod
     def handle_experimental_features(args, verbose=False):
@@ -1606,6 +5550,9 @@ class GlightApp(object):
                 client.connect()
                 client.do()
 
+            elif experiment == 'sim-bench':
+                GlightApp.run_sim_benchmark(args, verbose)
+
             elif experiment == 'devdev':
                 state = GDeviceState()
                 for i in range(1,6):
@@ -1617,6 +5564,35 @@ class GlightApp(object):
                 print("Unknown experimental feature '{}'".format(experiment))
                 sys.exit(2)
 
+    @staticmethod
+    def run_replay(args, registry_options, verbose=False):
+        """Replays a trace file on the local devices"""
+        registry = GDeviceRegistry(verbose=verbose, **registry_options)
+        try:
+            report = GTraceReplay(registry, speed=args.replay_speed, verbose=verbose).run(args.replay)
+            print(json.dumps(report, indent=4, sort_keys=True))
+        finally:
+            registry.close()
+
+    @staticmethod
+    def run_sim_benchmark(args, verbose=False, frames=50):
+        """Pushes color frames through the service using simulated devices"""
+        registry_options = GlightApp.get_registry_options(args)
+        registry_options["backend_type"] = UsbBackend.TYPE_SIM
+        srv = GlightService(verbose=verbose, registry_options=registry_options, coalesce=bool(args.coalesce))
+
+        colors = ["ff0000", "00ff00", "0000ff", "ffff00", "00ffff"]
+        started = time()
+        for i in range(frames):
+            srv.set_colors("g213", colors[i % len(colors):] + colors[:i % len(colors)])
+        srv.wait_for_command_queues()
+        elapsed = time() - started
+
+        print("{} frames in {:.3f} s ({:.2f} ms per frame)".format(frames, elapsed, elapsed * 1000 / frames))
+        print(json.dumps(srv.collect_stats(), indent=4))
+        srv.stop_command_queues()
+        srv.device_registry.close()
+
 
 if __name__ == "__main__":
 
@@ -272,6 +272,8 @@ class GlightFxApp(object):
                                 metavar='name')
 
         argsparser.add_argument('-C', '--client',  dest='client',  action='store_const', const=True, help='run as client')
+        argsparser.add_argument('--frame-buffer',  dest='frame_buffer', nargs='?', action='store', const=glight.GFrameBuffer.DEFAULT_DIR,
+                                help='write the frames to the frame buffers of the service', metavar='directory')
         argsparser.add_argument('-l', '--list',    dest='do_list', action='store_const', const=True, help='list devices')
         argsparser.add_argument('-v', '--verbose', dest='verbose', action='store_const', const=True, help='be verbose')
         argsparser.add_argument('-h', '--help',    dest='help',    action='store_const', const=True, help='show help')
@@ -314,13 +316,20 @@ class GlightFxApp(object):
         if args.device is None:
             raise "Need at least a device"
 
+        # the service picks the frames up from its frame buffers at its own rate
+        fx_client = client
+        if args.frame_buffer is not None:
+            fx_client = glight.GFrameBufferProducer(args.frame_buffer)
+
         if args.effect == "cpux":
-            fx = CpuxEffect(client)
+            fx = CpuxEffect(fx_client)
 
             state = client.get_state()
             try:
                 fx.run()
             finally:
+                if args.frame_buffer is not None:
+                    fx_client.close()
                 client.set_state(state)
 
 
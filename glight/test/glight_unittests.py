@@ -1,6 +1,22 @@
 import unittest
+import binascii
+import json
+import os
+import pty
+import tty
+import threading
+import tempfile
 import glight
 import logging
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+try:
+    import pydbus
+except ImportError:
+    pydbus = None  # the tests of the published service are skipped
 
 # Usage: python -m glight-unittests
 
@@ -83,5 +99,1470 @@ class TestGlightClientMethods(unittest.TestCase):
     #     with self.assertRaises(TypeError):
     #         s.split(2)
 
+
+class TestGDevicePacketEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = [glight.G203(), glight.G213()]
+
+    def test_encoded_commands_match_hex_templates(self):
+        for device in self.devices:
+            for color in ["ffffff", "FF0000", "00ff00", "0000ff"]:
+                for field in [0, 1, 5, 7]:
+                    expected = device.cmd_color.format(
+                        field=device.field_spec.format_num(field),
+                        color=device.color_spec.format_color_hex(color))
+                    packet = device.encode_command("color", field=field, color=color)
+                    self.assertEqual(expected, binascii.hexlify(packet).decode("ascii"))
+
+                for speed in [None, 500, 2000, 30000]:
+                    expected = device.cmd_breathe.format(
+                        color=device.color_spec.format_color_hex(color),
+                        speed=device.speed_spec.format_num(speed),
+                        bright=device.bright_spec.format_num(50))
+                    packet = device.encode_command("breathe", color=color, speed=speed, bright=50)
+                    self.assertEqual(expected, binascii.hexlify(packet).decode("ascii"))
+
+    def test_packet_cache_reuses_encoded_packets(self):
+        device = self.devices[1]
+        first = device.encode_command("cycle", speed=2000, bright=80)
+        second = device.encode_command("cycle", speed=2000, bright=80)
+        self.assertEqual(first, second)
+        self.assertEqual(1, device.packet_cache.hits)
+
+        # changing a returned packet must not change the cached one
+        first[0] = 0
+        self.assertEqual(second, device.encode_command("cycle", speed=2000, bright=80))
+
+        device.packet_cache.max_size = 2
+        device.encode_command("cycle", speed=3000, bright=80)
+        device.encode_command("cycle", speed=4000, bright=80)
+        self.assertEqual(2, len(device.packet_cache.packets))
+
+
+class TestGLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = glight.GLatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000.0)
+
+        stats = histogram.get_stats()
+        self.assertEqual(100, stats["count"])
+        self.assertAlmostEqual(50.5, stats["avg_ms"])
+        self.assertTrue(25.6 <= stats["p50_ms"] <= 51.2)
+        self.assertTrue(51.2 <= stats["p99_ms"] <= 100)
+        self.assertAlmostEqual(100, stats["max_ms"])
+
+    def test_empty_histogram(self):
+        stats = glight.GLatencyHistogram().get_stats()
+        self.assertEqual(0, stats["count"])
+        self.assertIsNone(stats["p50_ms"])
+
+
+class TestUsbBackendSim(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.controller = glight.GlightController(
+            glight.GlightController.BACKEND_LOCAL,
+            registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+        self.device = self.controller.device_registry.get_known_device("g213")
+        self.sim_device = glight.UsbSimBus.get_device(self.device.id_vendor, self.device.id_product)
+
+    def tearDown(self):
+        self.controller.close()
+
+    def test_frame_is_sent_with_one_prepare(self):
+        colors = ["ff0000", "00ff00", "0000ff", "ffff00", "00ffff"]
+        self.controller.set_colors("g213", colors)
+
+        packets = [binascii.hexlify(packet[4]).decode("ascii") for packet in self.sim_device.packets]
+        self.assertEqual(len(colors) + 1, len(packets))
+        self.assertEqual(self.device.cmd_prepare, packets[0])
+        self.assertEqual(len(colors), self.device.get_ack_stats()["acks"] - 1)
+        self.assertEqual(colors, self.device.device_state.colors[1:])
+        self.assertFalse(self.device.device_state.colors_uniform)
+
+    def test_kernel_driver_is_given_back(self):
+        self.controller.set_cycle("g213", 2000)
+        self.assertTrue(self.sim_device.kernel_driver_active)
+        self.assertIsNone(self.sim_device.claimed_by)
+        self.assertEqual(1, self.device.backend.detach_count)
+        self.assertEqual(1, self.device.backend.attach_count)
+
+    def test_burst_of_the_command_line_detaches_once(self):
+        for detach_mode in [glight.UsbBackend.DETACH_MANUAL, glight.UsbBackend.DETACH_AUTO]:
+            args = glight.GlightApp.get_argsparser().parse_args(
+                ["-d", "g213", "-c", "ff0000", "00ff00", "-b", "0000ff", "2000", "-x", "1000"])
+            controller = glight.GlightController(
+                glight.GlightController.BACKEND_LOCAL, idle_timeout=args.idle_timeout,
+                registry_options={"backend_type": glight.UsbBackend.TYPE_SIM, "detach_mode": detach_mode})
+            device = controller.device_registry.get_known_device("g213")
+            try:
+                glight.GlightApp.handle_controller(controller, args)
+                controller.set_colors("g213", ["ffffff"])
+
+                backend = device.backend
+                self.assertFalse(self.sim_device.kernel_driver_active)
+                self.assertEqual({"mode": detach_mode, "detached": 1, "attached": 0}, backend.get_kernel_driver_stats())
+            finally:
+                controller.close()
+            self.assertTrue(self.sim_device.kernel_driver_active)
+            self.assertEqual(1, backend.attach_count)
+
+    def test_missing_libusb1_is_named(self):
+        usb1 = glight.usb1
+        glight.usb1 = None
+        try:
+            with self.assertRaises(glight.GDeviceException) as context:
+                glight.UsbBackendUsb1.create_context()
+        finally:
+            glight.usb1 = usb1
+        self.assertIn("libusb1", str(context.exception))
+
+    def test_missing_ack_falls_back_to_deadline(self):
+        self.sim_device.configure(stall_rate=1.0)
+        self.device.ack_timeout = 0.05
+        self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertEqual(2, self.device.get_ack_stats()["timeouts"])
+
+    def test_ack_latency_is_measured(self):
+        self.sim_device.configure(ack_delay=0.02)
+        self.controller.set_color_at("g213", "ff00ff", 0)
+
+        stats = self.device.get_ack_stats()
+        self.assertEqual((2, 0), (stats["acks"], stats["timeouts"]))
+        self.assertGreaterEqual(stats["last_ms"], 20)
+        self.assertLess(stats["max_ms"], self.device.ack_timeout * 1000)
+
+    def test_ack_wait_ends_at_the_request_deadline(self):
+        self.sim_device.configure(stall_rate=1.0)
+        self.device.ack_timeout = 1.0
+        self.device.request_timeout = 0.1
+        started = glight.time()
+        with self.assertRaises(glight.GDeviceException):
+            self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertLess(glight.time() - started, 0.5)
+        self.assertEqual(1, self.device.get_ack_stats()["timeouts"])
+
+    def test_pacing_waits_for_the_ack_or_the_timings(self):
+        self.device.timeout_after_prepare = 0.05
+        self.device.timeout_after_cmd = 0.05
+
+        self.device.pacing = glight.GDevice.PACING_ACK
+        self.controller.set_color_at("g213", "ff00ff", 0)
+        pace = self.device.latency.get_stats()["pace"]
+        self.assertLess(max(pace["prepare"]["max_ms"], pace["color"]["max_ms"]), 50)
+
+        self.device.latency.reset()
+        self.device.pacing = glight.GDevice.PACING_FIXED
+        self.controller.set_color_at("g213", "00ff00", 0)
+        pace = self.device.latency.get_stats()["pace"]
+        self.assertGreaterEqual(min(pace["prepare"]["min_ms"], pace["color"]["min_ms"]), 50)
+        self.assertEqual(4, self.device.get_ack_stats()["acks"])
+
+    def test_fixed_pacing_does_not_wait_for_a_missing_ack(self):
+        self.sim_device.configure(stall_rate=1.0)
+        self.device.ack_timeout = 1.0
+        self.device.timeout_after_prepare = 0.01
+        self.device.timeout_after_cmd = 0.01
+        self.device.pacing = glight.GDevice.PACING_FIXED
+
+        started = glight.time()
+        self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertLess(glight.time() - started, 0.5)
+        stats = self.device.get_ack_stats()
+        self.assertEqual((0, 0), (stats["acks"], stats["timeouts"]))
+
+    def test_injected_errors_are_raised(self):
+        self.sim_device.configure(error_rate=1.0)
+        with self.assertRaises(glight.GDeviceException):
+            self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertIsNone(self.sim_device.claimed_by)
+
+    def test_failed_write_is_only_raised(self):
+        self.sim_device.configure(error_rate=1.0)
+        done = []
+        self.device.connect()
+        try:
+            with self.assertRaises(glight.GDeviceException):
+                self.device.backend.submit_data(0x21, 0x09, 0x0210, bytearray(7), callback=done.append)
+        finally:
+            self.device.disconnect()
+        self.assertEqual([], done)
+
+    def test_unchanged_state_is_not_sent_again(self):
+        self.device.dedup = True
+        self.controller.set_breathe("g213", "00ff00", 2000, 80)
+        sent = len(self.sim_device.packets)
+        self.controller.set_breathe("g213", "00FF00", 2000, 80)
+        self.assertEqual(sent, len(self.sim_device.packets))
+        self.assertEqual(1, self.device.suppressed_writes)
+
+        self.device.connect()
+        try:
+            self.device.send_breathe_command("00ff00", 2000, 80, force=True)
+        finally:
+            self.device.disconnect()
+        self.assertEqual(2 * sent, len(self.sim_device.packets))
+
+        self.controller.set_breathe("g213", "00ff00", 1000, 80)
+        self.assertEqual(3 * sent, len(self.sim_device.packets))
+
+    def test_uniform_color_replaces_the_field_colors(self):
+        self.device.dedup = True
+        self.controller.set_colors("g213", ["ff0000", "00ff00", "0000ff"])
+        self.controller.set_color_at("g213", "ffffff", 0)
+        self.controller.set_color_at("g213", "00ff00", 1)
+        sent = len(self.sim_device.packets)
+
+        # field 3 shows white since the uniform color, not its old blue
+        self.controller.set_color_at("g213", "0000ff", 3)
+        self.assertEqual(sent + 2, len(self.sim_device.packets))
+        self.controller.set_color_at("g213", "ffffff", 2)
+        self.assertEqual(sent + 2, len(self.sim_device.packets))
+        self.assertEqual(1, self.device.suppressed_writes)
+
+    def test_failing_device_is_rejected_until_probed(self):
+        self.sim_device.configure(error_rate=1.0)
+        for i in range(self.device.breaker.failure_threshold):
+            with self.assertRaises(glight.GDeviceException):
+                self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertTrue(self.device.breaker.is_open())
+
+        sent = len(self.sim_device.packets)
+        with self.assertRaises(glight.GDeviceException):
+            self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertEqual(sent, len(self.sim_device.packets))
+        self.assertEqual(1, self.device.breaker.rejections)
+
+        self.sim_device.configure(error_rate=0.0)
+        self.assertTrue(self.device.probe())
+        self.assertEqual(glight.GCircuitBreaker.STATE_CLOSED, self.device.breaker.state)
+        self.controller.set_color_at("g213", "ff00ff", 0)
+
+    def trip_breaker(self):
+        breaker = self.device.breaker
+        for i in range(breaker.failure_threshold):
+            breaker.record_failure(glight.GDeviceException("No answer"))
+        return breaker
+
+    def test_failing_device_is_not_connected(self):
+        self.trip_breaker()
+        with self.assertRaises(glight.GDeviceException):
+            self.controller.set_color_at("g213", "ff00ff", 0)
+        self.assertNotIn("connect", self.device.latency.get_stats())
+        self.assertIsNone(self.sim_device.claimed_by)
+
+    def test_only_one_probe_is_let_through(self):
+        breaker = self.trip_breaker()
+        breaker.opened_at -= breaker.probe_interval
+
+        prober = glight.Thread(target=breaker.assert_allows, args=("g213",))
+        prober.start()
+        prober.join()
+        self.assertEqual(glight.GCircuitBreaker.STATE_HALF_OPEN, breaker.state)
+        with self.assertRaises(glight.GDeviceException):
+            breaker.assert_allows("g213")
+        self.assertFalse(self.device.probe())
+        self.assertEqual(1, breaker.probes)
+
+        breaker.record_success()
+        breaker.assert_allows("g213")
+
+    def test_suppressed_probe_leaves_the_breaker_open(self):
+        self.device.dedup = True
+        self.controller.set_cycle("g213", 2000)
+        breaker = self.trip_breaker()
+        breaker.opened_at -= breaker.probe_interval
+
+        self.controller.set_cycle("g213", 2000)
+        self.assertEqual(1, self.device.suppressed_writes)
+        self.assertEqual(glight.GCircuitBreaker.STATE_OPEN, breaker.state)
+
+        # the next command probes the device
+        self.controller.set_cycle("g213", 1000)
+        self.assertEqual(2, breaker.probes)
+        self.assertEqual(glight.GCircuitBreaker.STATE_CLOSED, breaker.state)
+
+    def test_deadline_limits_the_request(self):
+        self.sim_device.configure(latency=0.1)
+        self.device.request_timeout = 0.25
+        started = glight.time()
+        with self.assertRaises(glight.GDeviceException):
+            self.controller.set_colors("g213", ["ff0000"] * 5)
+        self.assertLess(glight.time() - started, 0.5)
+
+    def test_broadcast_starts_devices_together(self):
+        report = self.controller.broadcast(["g203", "g213"], "breathe", color="00ff00", speed=2000, brightness=50)
+
+        self.assertTrue(report["ok"])
+        self.assertEqual(["g203", "g213"], sorted(report["devices"].keys()))
+        self.assertLess(report["start_skew_ms"], report["total_ms"])
+        for name in ["g203", "g213"]:
+            state = self.controller.device_registry.get_known_device(name).device_state
+            self.assertTrue(state.breathing)
+            self.assertEqual(2000, state.speed)
+
+    def test_broadcast_reports_failed_devices(self):
+        self.sim_device.configure(error_rate=1.0)
+        report = self.controller.broadcast(["g203", "g213", "g999"], "cycle", speed=2000)
+
+        self.assertFalse(report["ok"])
+        self.assertTrue(report["devices"]["g203"]["ok"])
+        self.assertFalse(report["devices"]["g213"]["ok"])
+        self.assertFalse(report["devices"]["g999"]["ok"])
+
+    def test_batch_connects_each_device_once(self):
+        report = self.controller.apply_batch([
+            {"device": "g213", "op": "colors", "colors": ["ff0000", "00ff00"]},
+            {"device": "g203", "op": "cycle", "speed": 2000},
+            {"device": "g213", "op": "color_at", "color": "0000ff", "field": 1}
+        ])
+
+        self.assertTrue(report["ok"])
+        self.assertEqual(["g213", "g203", "g213"], [result["device"] for result in report["results"]])
+        self.assertEqual(1, self.device.latency.get_stats()["connect"]["device"]["count"])
+        self.assertEqual(["0000ff", "00ff00"], self.device.device_state.colors[1:3])
+        self.assertTrue(self.controller.device_registry.get_known_device("g203").device_state.cycling)
+
+    def test_invalid_batch_is_not_sent(self):
+        operations = [
+            {"device": "g213", "op": "colors", "colors": ["ff0000"]},
+            {"device": "g213", "op": "color_at", "color": "nocolor"},
+            {"device": "g999", "op": "cycle", "speed": 2000}
+        ]
+        with self.assertRaises(glight.GControllerException) as context:
+            self.controller.apply_batch(operations)
+
+        self.assertIn("Operation 1", str(context.exception))
+        self.assertIn("Operation 2", str(context.exception))
+        self.assertEqual([], self.sim_device.packets)
+
+    def test_invalid_values_are_rejected_before_sending(self):
+        operations = [
+            {"device": "g213", "op": "colors", "colors": ["ff0000"]},
+            {"device": "g203", "op": "cycle", "speed": "fast"},
+            {"device": "g213", "op": "breathe", "color": "00ff00", "speed": 2000, "brightness": 500},
+            {"device": "g213", "op": "color_at", "color": "0000ff", "field": "1"},
+            {"device": "g213", "op": "colors", "colors": "ff0000"}
+        ]
+        with self.assertRaises(glight.GControllerException) as context:
+            self.controller.apply_batch(operations)
+
+        for index in range(1, 5):
+            self.assertIn("Operation {}".format(index), str(context.exception))
+        self.assertNotIn("Operation 0", str(context.exception))
+        self.assertEqual([], self.sim_device.packets)
+
+    def test_batch_skips_the_rest_of_a_failed_device(self):
+        self.sim_device.configure(error_rate=1.0)
+        report = self.controller.apply_batch([
+            {"device": "g213", "op": "colors", "colors": ["ff0000"]},
+            {"device": "g203", "op": "colors", "colors": ["ff0000"]},
+            {"device": "g213", "op": "cycle", "speed": 2000}
+        ])
+
+        self.assertFalse(report["ok"])
+        self.assertEqual([False, True, False], [result["ok"] for result in report["results"]])
+        self.assertIn("Skipped", report["results"][2]["error"])
+
+    def test_latencies_are_recorded_per_command(self):
+        self.controller.set_colors("g213", ["ff0000", "00ff00"])
+        latency = self.device.latency.get_stats()
+
+        self.assertEqual(1, latency["transfer"]["prepare"]["count"])
+        self.assertEqual(2, latency["transfer"]["color"]["count"])
+        self.assertEqual(1, latency["command"]["color"]["count"])
+        self.assertEqual(1, latency["connect"]["device"]["count"])
+        self.assertEqual(3, latency["ack"]["prepare"]["count"] + latency["ack"]["color"]["count"])
+
+    def test_detached_device_is_not_listed(self):
+        self.sim_device.present = False
+        self.controller.device_registry.rescan()
+        self.assertNotIn("g213", self.controller.list_devices())
+
+    def test_rescan_reports_changed_presence_once(self):
+        registry = self.controller.device_registry
+        events = []
+        registry.presence_callbacks.append(lambda device, is_present:
+                                           events.append((device.device_name_short, is_present)))
+        registry.rescan()
+        self.sim_device.present = False
+        registry.rescan()
+        registry.rescan()
+        registry.poll_monitor()
+        self.assertEqual([("g213", False)], events)
+
+        self.sim_device.present = True
+        registry.rescan()
+        registry.poll_monitor()
+        self.assertEqual([("g213", False), ("g213", True)], events)
+
+
+class FakeUsb1Device(object):
+    """Device descriptor as listed by FakeUsb1Context"""
+
+    def __init__(self, vendor_id, product_id, address=1):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.address = address
+
+    def getVendorID(self):
+        return self.vendor_id
+
+    def getProductID(self):
+        return self.product_id
+
+    def getBusNumber(self):
+        return 1
+
+    def getDeviceAddress(self):
+        return self.address
+
+
+class FakeUsb1Transfer(object):
+    """Transfer completed by FakeUsb1Context.handleEventsTimeout(), oldest first"""
+
+    def __init__(self, context):
+        self.context = context
+        self.callback = None
+        self.user_data = None
+        self.status = None
+        self.submitted = False
+
+    def setControl(self, request_type, request, value, index, buffer_or_len, callback=None, user_data=None,
+                   timeout=0):
+        self.callback = callback
+        self.user_data = user_data
+
+    def setInterrupt(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0):
+        self.callback = callback
+        self.user_data = user_data
+
+    def submit(self):
+        self.submitted = True
+        self.context.transfers.append(self)
+        if self.context.complete_on_submit:
+            self.context.handleEventsTimeout()
+
+    def cancel(self):
+        self.submitted = False
+        self.context.transfers.remove(self)
+
+    def isSubmitted(self):
+        return self.submitted
+
+    def getUserData(self):
+        return self.user_data
+
+    def getStatus(self):
+        return self.status
+
+
+class FakeUsb1Handle(object):
+    """Opened device of FakeUsb1Context"""
+
+    def __init__(self, context):
+        self.context = context
+        self.kernel_driver_active = True
+
+    def kernelDriverActive(self, interface):
+        return self.kernel_driver_active
+
+    def detachKernelDriver(self, interface):
+        self.kernel_driver_active = False
+
+    def attachKernelDriver(self, interface):
+        self.kernel_driver_active = True
+
+    def setAutoDetachKernelDriver(self, enable):
+        pass
+
+    def claimInterface(self, interface):
+        return interface
+
+    def releaseInterface(self, interface):
+        pass
+
+    def controlWrite(self, request_type, request, value, index, data, timeout=0):
+        self.context.written += 1
+
+    def getTransfer(self):
+        return FakeUsb1Transfer(self.context)
+
+    def close(self):
+        pass
+
+
+class FakeUsb1Context(object):
+    """Stands in for usb1.USBContext, the attached devices are listed by descriptor only"""
+
+    attached = []  # FakeUsb1Device
+
+    def __init__(self):
+        self.transfers = []  # submitted FakeUsb1Transfer
+        self.failing = False  # transfers end with an error
+        self.complete_on_submit = False  # as if another thread handled the events during submit()
+        self.opened = 0
+        self.written = 0  # synchronous control writes
+        self.listed = 0
+        self.hotplug_callbacks = {}  # handle -> (callback, vendor_id, product_id)
+
+    def getDeviceList(self, skip_on_error=False):
+        self.listed += 1
+        return list(FakeUsb1Context.attached)
+
+    def openByVendorIDAndProductID(self, vendor_id, product_id, skip_on_error=False):
+        for usb_device in FakeUsb1Context.attached:
+            if (usb_device.getVendorID(), usb_device.getProductID()) == (vendor_id, product_id):
+                self.opened += 1
+                return FakeUsb1Handle(self)
+        return None
+
+    def handleEventsTimeout(self, timeout=0):
+        if len(self.transfers) > 0:
+            transfer = self.transfers.pop(0)
+            transfer.submitted = False
+            transfer.status = glight.usb1.TRANSFER_ERROR if self.failing else glight.usb1.TRANSFER_COMPLETED
+            transfer.callback(transfer)
+
+    def hotplugRegisterCallback(self, callback, vendor_id, product_id):
+        handle = len(self.hotplug_callbacks) + 1
+        self.hotplug_callbacks[handle] = (callback, vendor_id, product_id)
+        for usb_device in FakeUsb1Context.attached:
+            self._notify(handle, usb_device, glight.usb1.HOTPLUG_EVENT_DEVICE_ARRIVED)
+        return handle
+
+    def hotplugDeregisterCallback(self, handle):
+        del self.hotplug_callbacks[handle]
+
+    def plug(self, usb_device, arrived=True):
+        if arrived:
+            FakeUsb1Context.attached.append(usb_device)
+            event = glight.usb1.HOTPLUG_EVENT_DEVICE_ARRIVED
+        else:
+            FakeUsb1Context.attached.remove(usb_device)
+            event = glight.usb1.HOTPLUG_EVENT_DEVICE_LEFT
+        for handle in list(self.hotplug_callbacks.keys()):
+            self._notify(handle, usb_device, event)
+
+    def _notify(self, handle, usb_device, event):
+        callback, vendor_id, product_id = self.hotplug_callbacks[handle]
+        if (usb_device.getVendorID(), usb_device.getProductID()) == (vendor_id, product_id):
+            callback(self, usb_device, event)
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(glight.usb1 is None, "python-libusb1 is not installed")
+class TestUsbBackendUsb1(unittest.TestCase):
+
+    def setUp(self):
+        self.context = FakeUsb1Context()
+        self.backend = glight.UsbBackendUsb1(0x046d, 0xc336, 0, context=self.context)
+        self.backend.connect(FakeUsb1Handle(self.context))
+
+    def tearDown(self):
+        self.backend.disconnect()
+
+    def test_transfers_in_flight_are_limited(self):
+        self.backend.async_depth = 2
+        done = []
+        futures = [self.backend.submit_data(0x21, 0x09, 0x0211, bytearray(20), callback=done.append)
+                   for i in range(5)]
+
+        stats = self.backend.get_queue_stats()
+        self.assertEqual((5, 2, 3), (stats["submitted"], stats["max_depth"], stats["full"]))
+        self.assertEqual(2, stats["depth"])
+        self.assertTrue(all(future.done() for future in futures[0:3]))
+
+        self.assertTrue(self.backend.flush(1.0))
+        self.assertEqual(futures, done)
+        self.assertEqual(5, self.backend.get_queue_stats()["completed"])
+        self.assertTrue(all(future.completed_at >= future.submitted_at for future in futures))
+
+    def test_failed_transfer_raises_from_its_future(self):
+        self.backend.async_depth = 2
+        self.context.failing = True
+        future = self.backend.submit_data(0x21, 0x09, 0x0211, bytearray(20))
+        self.assertFalse(future.done())
+
+        with self.assertRaises(glight.GDeviceException):
+            future.result(1.0)
+        self.assertEqual(1, self.backend.get_queue_stats()["failed"])
+
+    def test_without_depth_transfers_are_sent_synchronously(self):
+        future = self.backend.submit_data(0x21, 0x09, 0x0211, bytearray(20))
+        self.assertTrue(future.done())
+        self.assertEqual(1, self.context.written)
+        self.assertEqual(0, self.backend.get_queue_stats()["submitted"])
+
+
+@unittest.skipIf(glight.usb1 is None, "python-libusb1 is not installed")
+class TestGDeviceRegistryUsb1(unittest.TestCase):
+
+    def setUp(self):
+        self.usb_context_class = glight.usb1.USBContext
+        self.has_capability = glight.usb1.hasCapability
+        glight.usb1.USBContext = FakeUsb1Context
+        glight.usb1.hasCapability = lambda capability: True
+        glight.UsbBackendUsb1.context_creations = 0
+
+        self.registry = glight.GDeviceRegistry(backend_type=glight.UsbBackend.TYPE_USB1)
+        self.g203 = self.registry.get_known_device("g203")
+        self.g213 = self.registry.get_known_device("g213")
+        self.usb_g203 = FakeUsb1Device(self.g203.id_vendor, self.g203.id_product, address=2)
+        self.usb_g213 = FakeUsb1Device(self.g213.id_vendor, self.g213.id_product, address=3)
+        FakeUsb1Context.attached = [self.usb_g213]
+
+    def tearDown(self):
+        self.registry.close()
+        FakeUsb1Context.attached = []
+        glight.usb1.USBContext = self.usb_context_class
+        glight.usb1.hasCapability = self.has_capability
+
+    def test_hotplug_events_update_the_presence(self):
+        events = []
+        self.registry.presence_callbacks.append(lambda device, is_present:
+                                                events.append((device.device_name_short, is_present)))
+        self.assertTrue(self.registry.start_monitoring())
+        self.registry.poll_monitor()
+        self.assertEqual([], events)
+        self.assertEqual([self.g213], self.registry.find_devices())
+
+        context = self.registry.usb_context
+        context.plug(self.usb_g213, arrived=False)
+        context.plug(self.usb_g203)
+        self.registry.poll_monitor()
+
+        self.assertEqual([("g213", False), ("g203", True)], events)
+        self.assertEqual([self.g203], self.registry.find_devices())
+        self.assertEqual(0, context.listed)
+
+        self.registry.stop_monitoring()
+        self.assertFalse(self.registry.is_monitoring)
+
+    def test_lookups_do_not_open_devices(self):
+        self.assertEqual([self.g213], self.registry.find_devices())
+        self.assertIs(self.g213, self.registry.get_device("g213"))
+        self.assertIsNone(self.registry.get_device("g203"))
+        self.assertTrue(self.registry.is_present(self.g213))
+
+        context = self.registry.usb_context
+        self.assertEqual(1, context.listed)
+        self.assertTrue(self.g213.exists())
+        self.assertEqual(0, context.opened)
+
+    def test_devices_share_one_context(self):
+        FakeUsb1Context.attached.append(self.usb_g203)
+        self.registry.rescan()
+        for i in range(2):
+            for device in self.registry.find_devices():
+                device.connect()
+                device.disconnect()
+
+        self.assertEqual(1, glight.UsbBackendUsb1.context_creations)
+        self.assertEqual(4, self.registry.usb_context.opened)
+        for device in [self.g203, self.g213]:
+            self.assertIs(self.registry.usb_context, device.backend.context)
+
+    def test_frame_is_queued_before_it_is_waited_for(self):
+        self.registry.close()
+        self.registry = glight.GDeviceRegistry(backend_type=glight.UsbBackend.TYPE_USB1, async_depth=3)
+        device = self.registry.get_known_device("g213")
+        device.connect()
+        try:
+            device.send_colors_command(["ff0000", "00ff00", "0000ff", "ffff00", "00ffff"])
+            stats = device.backend.get_queue_stats()
+        finally:
+            device.disconnect()
+
+        self.assertEqual((6, 3), (stats["submitted"], stats["max_depth"]))
+        self.assertEqual(6, stats["completed"])
+        ack_stats = device.get_ack_stats()
+        self.assertEqual((6, 0), (ack_stats["acks"], ack_stats["timeouts"]))
+
+    def test_ack_handled_during_submit_is_counted(self):
+        self.g213.connect()
+        self.g213.backend.context.complete_on_submit = True
+        try:
+            futures = self.g213.send_data_batch([bytearray(20)] * 2, command="color")
+        finally:
+            self.g213.disconnect()
+
+        stats = self.g213.get_ack_stats()
+        self.assertEqual((len(futures), 0), (stats["acks"], stats["timeouts"]))
+
+
+class TestGCommandQueue(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.service = glight.GlightService(
+            registry_options={"backend_type": glight.UsbBackend.TYPE_SIM}, coalesce=True)
+        self.device = self.service.device_registry.get_known_device("g213")
+        glight.UsbSimBus.get_device(self.device.id_vendor, self.device.id_product).configure(latency=0.005)
+
+    def tearDown(self):
+        self.service.stop_command_queues()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+
+    def test_newer_frames_replace_unsent_ones(self):
+        frames = [[color] * 5 for color in ["ff0000", "00ff00", "0000ff", "ffff00", "00ffff", "ff00ff"]]
+        for frame in frames:
+            self.service.set_colors("g213", frame)
+        self.assertTrue(self.service.wait_for_command_queues(5))
+
+        stats = self.service.command_queues["g213"].get_stats()
+        self.assertEqual(len(frames), stats["queued"])
+        self.assertEqual(len(frames), stats["sent"] + stats["superseded"])
+        self.assertGreater(stats["superseded"], 0)
+        self.assertEqual(frames[-1], self.device.device_state.colors[1:])
+
+    def test_field_commands_keep_their_order(self):
+        self.service.set_colors("g213", ["ff0000"] * 5)
+        self.service.set_color_at("g213", "00ff00", 2)
+        self.service.set_color_at("g213", "0000ff", 3)
+        self.service.set_color_at("g213", "ffffff", 2)
+        self.assertTrue(self.service.wait_for_command_queues(5))
+        self.assertEqual(["ff0000", "ffffff", "0000ff"], self.device.device_state.colors[1:4])
+
+    def test_invalid_color_is_rejected_by_the_caller(self):
+        with self.assertRaises(ValueError):
+            self.service.set_colors("g213", ["nocolor"])
+
+
+def block_worker(service, device_name):
+    """:return: Event ending the command the worker of the device is busy with"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(device):
+        started.set()
+        release.wait(5)
+
+    service.queue_command(device_name, "blocker", block)
+    started.wait(5)
+    return release
+
+
+class FakeInvocation(object):
+    """Gio.DBusMethodInvocation passing the error of the reply, None if it succeeded"""
+
+    def __init__(self, on_reply):
+        self.on_reply = on_reply
+
+    def return_value(self, value):
+        self.on_reply(None)
+
+    def return_dbus_error(self, error_name, message):
+        self.on_reply(error_name)
+
+
+class TestGlightServiceConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.service = glight.GlightService(registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+        for device in self.service.device_registry.known_devices:
+            glight.UsbSimBus.get_device(device.id_vendor, device.id_product).configure(latency=0.01)
+        self.device = self.service.device_registry.get_known_device("g213")
+
+    def tearDown(self):
+        self.service.stop_command_queues()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+
+    @unittest.skipIf(glight.Gio is None, "GDBus is not available")
+    def test_devices_do_not_wait_for_each_other(self):
+        publication = glight.GServicePublication(None, self.service.bus_path, self.service)
+        self.service.publication = publication
+        release = block_worker(self.service, "g213")
+        replies = []
+
+        def on_reply(device_name, error):
+            replies.append((device_name, error))
+            if device_name == "g203":
+                release.set()
+
+        for device_name, color in [("g213", "00ff00"), ("g203", "ff00ff")]:
+            # returns right away, the worker of the device replies
+            publication.on_method_call(None, None, self.service.bus_path, self.service.bus_name, "set_color_at",
+                                       glight.GLib.Variant("(ssq)", (device_name, color, 0)),
+                                       FakeInvocation(lambda error, device_name=device_name:
+                                                      on_reply(device_name, error)))
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+
+        self.assertEqual([("g203", None), ("g213", None)], replies)
+        self.assertEqual("ff00ff", self.service.device_registry.get_known_device("g203").device_state.colors[0])
+        self.assertEqual("00ff00", self.device.device_state.colors[0])
+
+    def test_list_devices_does_not_touch_the_device_locks(self):
+        lock = self.service.device_locks["g213"]
+        lock.acquire()
+        try:
+            self.assertIn("g213", self.service.list_devices())
+        finally:
+            lock.release()
+        self.service.set_color_at("g213", "ff00ff", 0)
+
+    def test_batch_is_applied_by_the_service(self):
+        report = json.loads(self.service.apply_batch(json.dumps([
+            {"device": "g203", "op": "breathe", "color": "00ff00", "speed": 2000},
+            {"device": "g213", "op": "colors", "colors": ["ff0000"]}
+        ])))
+
+        self.assertTrue(report["ok"])
+        self.assertTrue(self.service.device_registry.get_known_device("g203").device_state.breathing)
+        self.assertEqual("ff0000", self.service.device_registry.get_known_device("g213").device_state.colors[0])
+
+    def _record_signals(self, names=("RequestCompleted", "RequestFailed")):
+        signals = []
+
+        def emit(name, *args):
+            if name in names:
+                signals.append((name,) + args)
+
+        self.service.emit_signal_idle = emit
+        return signals
+
+    def test_state_changes_are_signaled_in_sequence(self):
+        signals = self._record_signals(names=("StateChanged",))
+        self.service.set_colors("g213", ["ff0000"])
+        self.service.set_colors("g213", ["ff0000"])
+        self.service.set_cycle("g203", 2000, -1)
+        self.service.set_colors("g213", ["00ff00"])
+
+        self.assertEqual([("g213", 1), ("g203", 1), ("g213", 2)], [signal[1:3] for signal in signals])
+        self.assertEqual(["00ff00"], json.loads(signals[-1][3])["colors"][0:1])
+
+        del signals[:]
+        self.service.set_state(self.service.get_state())
+        self.assertEqual([("g203", 2), ("g213", 3)], sorted(signal[1:3] for signal in signals))
+
+    def test_async_requests_signal_their_completion(self):
+        signals = self._record_signals()
+        first = self.service.set_color_at_async("g213", "ff0000", 0)
+        second = self.service.set_cycle_async("g203", 1000, 100)
+        self.assertNotEqual(first, second)
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+        self.assertEqual(sorted([("RequestCompleted", first, "g213"), ("RequestCompleted", second, "g203")]),
+                         sorted(signals))
+        self.assertEqual("ff0000", self.service.device_registry.get_known_device("g213").device_state.colors[0])
+
+    def test_async_requests_are_sent_in_order_unless_coalesced(self):
+        signals = self._record_signals()
+        ids = [self.service.set_colors_async("g213", [color]) for color in ["ff0000", "00ff00", "0000ff"]]
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+        self.assertEqual([("RequestCompleted", request_id, "g213") for request_id in ids], signals)
+
+        del signals[:]
+        self.service.coalesce = True
+        device = self.service.device_registry.get_known_device("g213")
+        # the worker is busy before the first request is queued, so each request replaces the one before
+        release = block_worker(self.service, "g213")
+        try:
+            first = self.service.set_colors_async("g213", ["ff0000"])
+            second = self.service.set_colors_async("g213", ["00ff00"])
+            third = self.service.set_colors_async("g213", ["0000ff"])
+        finally:
+            release.set()
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+        self.assertIn(("RequestCompleted", third, "g213"), signals)
+        failed = [signal for signal in signals if signal[0] == "RequestFailed"]
+        self.assertEqual([first, second], [signal[1] for signal in failed])
+        self.assertEqual(len(signals), len(set(signal[1] for signal in signals)))
+        self.assertEqual("0000ff", device.device_state.colors[0])
+
+    def test_async_request_failure_is_signaled(self):
+        signals = self._record_signals()
+        breaker = self.service.device_registry.get_known_device("g213").breaker
+        for i in range(breaker.failure_threshold):
+            breaker.record_failure(glight.GDeviceException("No answer"))
+        request_id = self.service.set_colors_async("g213", ["ff0000"])
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+        self.assertEqual(1, len(signals))
+        self.assertEqual(("RequestFailed", request_id, "g213"), signals[0][:3])
+
+    def test_pending_requests_are_limited(self):
+        release = block_worker(self.service, "g213")
+        try:
+            for i in range(glight.GCommandQueue.DEFAULT_MAX_PENDING):
+                self.service.set_colors_async("g213", ["ff0000"])
+            with self.assertRaises(glight.GDeviceException):
+                self.service.set_colors_async("g213", ["ff0000"])
+        finally:
+            release.set()
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+        self.assertEqual(1, self.service.command_queues["g213"].get_stats()["rejected"])
+
+    def test_attached_device_is_restored_by_its_worker(self):
+        self.service.set_cycle("g213", 2000, -1)
+        sim_device = glight.UsbSimBus.get_device(self.device.id_vendor, self.device.id_product)
+        sent = len(sim_device.packets)
+
+        release = block_worker(self.service, "g213")
+        self.service.on_presence_changed(self.device, True)
+        self.assertEqual(sent, len(sim_device.packets))
+        release.set()
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+        self.assertGreater(len(sim_device.packets), sent)
+
+    def test_broadcast_is_sent_by_the_workers(self):
+        report = json.loads(self.service.broadcast(["g203", "g213", "g999"], "cycle", json.dumps({"speed": 2000})))
+
+        self.assertFalse(report["ok"])
+        self.assertTrue(report["devices"]["g203"]["ok"])
+        self.assertTrue(report["devices"]["g213"]["ok"])
+        self.assertFalse(report["devices"]["g999"]["ok"])
+        for device_name in ["g203", "g213"]:
+            self.assertEqual(1, self.service.command_queues[device_name].get_stats()["sent"])
+
+    def test_coalesced_broadcast_takes_the_frame_slot(self):
+        self.service.coalesce = True
+        reports = []
+        release = block_worker(self.service, "g213")
+        queue = self.service.command_queues["g213"]
+        try:
+            self.service.set_colors_async("g213", ["ff0000"])
+            sender = threading.Thread(target=lambda: reports.append(
+                json.loads(self.service.broadcast(["g213"], "colors", json.dumps({"colors": ["0000ff"]})))))
+            sender.start()
+            for i in range(100):
+                if queue.get_stats()["superseded"] > 0:
+                    break
+                glight.sleep(0.01)
+        finally:
+            release.set()
+        sender.join(5)
+
+        self.assertTrue(reports[0]["ok"])
+        self.assertEqual(1, queue.get_stats()["superseded"])
+        self.assertEqual(2, queue.get_stats()["sent"])
+        self.assertEqual("0000ff", self.device.device_state.colors[0])
+
+
+@unittest.skipIf(glight.Gio is None or pydbus is None or which("dbus-daemon") is None,
+                 "GDBus, pydbus or dbus-daemon is missing")
+class TestGServicePublication(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.test_bus = glight.Gio.TestDBus.new(glight.Gio.TestDBusFlags.NONE)
+        self.test_bus.up()
+        self.service = glight.GlightService(registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+        self.service.publish(pydbus.connect(self.test_bus.get_bus_address()))
+        self.client = glight.Gio.DBusConnection.new_for_address_sync(
+            self.test_bus.get_bus_address(),
+            glight.Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT |
+            glight.Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION, None, None)
+
+    def tearDown(self):
+        self.service.unpublish()
+        self.service.stop_command_queues()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+        self.client.close_sync(None)
+        self.test_bus.down()
+
+    def _call(self, method_name, parameters, on_reply):
+        """Calls the service asynchronously, on_reply gets the result or the error"""
+        def on_finished(connection, result, user_data):
+            try:
+                on_reply(connection.call_finish(result).unpack())
+            except glight.GLib.Error as ex:
+                on_reply(ex)
+
+        self.client.call(self.service.bus_name, self.service.bus_path, self.service.bus_name, method_name,
+                         parameters, None, glight.Gio.DBusCallFlags.NONE, 10000, None, on_finished, None)
+
+    def test_fast_call_returns_while_a_slow_one_is_pending(self):
+        loop = glight.GLib.MainLoop()
+        release = block_worker(self.service, "g213")
+        replies = []
+
+        def on_reply(device_name, result):
+            replies.append((device_name, result))
+            if device_name == "g203":
+                release.set()
+            else:
+                loop.quit()
+
+        for device_name in ["g213", "g203"]:
+            self._call("set_color_at", glight.GLib.Variant("(ssq)", (device_name, "ff00ff", 0)),
+                       lambda result, device_name=device_name: on_reply(device_name, result))
+        timeout = glight.GLib.timeout_add_seconds(10, loop.quit)
+        loop.run()
+        glight.GLib.source_remove(timeout)
+
+        self.assertEqual([("g203", ()), ("g213", ())], replies)
+
+    def test_results_and_errors_are_replied(self):
+        loop = glight.GLib.MainLoop()
+        replies = {}
+
+        def on_reply(method_name, result):
+            replies[method_name] = result
+            if len(replies) == 2:
+                loop.quit()
+
+        self._call("apply_batch", glight.GLib.Variant("(s)", (json.dumps([
+            {"device": "g213", "op": "colors", "colors": ["ff0000"]}]),)),
+                   lambda result: on_reply("apply_batch", result))
+        self._call("set_color_at", glight.GLib.Variant("(ssq)", ("g213", "nocolor", 0)),
+                   lambda result: on_reply("set_color_at", result))
+        timeout = glight.GLib.timeout_add_seconds(10, loop.quit)
+        loop.run()
+        glight.GLib.source_remove(timeout)
+
+        self.assertTrue(json.loads(replies["apply_batch"][0])["ok"])
+        self.assertIsInstance(replies["set_color_at"], glight.GLib.Error)
+
+
+class TestGlightServiceSessions(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+
+    def _create_service(self, idle_timeout):
+        self.service = glight.GlightService(idle_timeout=idle_timeout,
+                                            registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+        self.device = self.service.device_registry.get_known_device("g213")
+        self.sim_device = glight.UsbSimBus.get_device(self.device.id_vendor, self.device.id_product)
+
+    def tearDown(self):
+        self.service.stop_command_queues()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+
+    def test_session_is_kept_until_idle(self):
+        self._create_service(5.0)
+        self.service.set_colors("g213", ["ff0000"])
+        self.service.set_colors("g213", ["00ff00"])
+
+        sessions = self.service.collect_stats()["sessions"]
+        self.assertEqual((1, 1), (sessions["hits"], sessions["misses"]))
+        self.assertEqual(["g213"], sessions["open"])
+        self.assertFalse(self.sim_device.kernel_driver_active)
+
+        self.service.release_idle_sessions(now=glight.time() + 1.0)
+        self.assertIsNotNone(self.sim_device.claimed_by)
+
+        self.service.release_idle_sessions(now=glight.time() + 5.0)
+        self.assertIsNone(self.sim_device.claimed_by)
+        self.assertTrue(self.sim_device.kernel_driver_active)
+        self.assertEqual([], self.service.collect_stats()["sessions"]["open"])
+
+        self.service.set_colors("g213", ["0000ff"])
+        self.assertEqual(2, self.service.collect_stats()["sessions"]["misses"])
+        self.assertEqual(2, self.device.backend.detach_count)
+
+    def test_no_idle_timeout_releases_after_each_call(self):
+        self._create_service(0)
+        for color in ["ff0000", "00ff00"]:
+            self.service.set_colors("g213", [color])
+            self.assertIsNone(self.sim_device.claimed_by)
+
+        sessions = self.service.collect_stats()["sessions"]
+        self.assertEqual((0, 2), (sessions["hits"], sessions["misses"]))
+        self.assertEqual(2, self.device.backend.attach_count)
+
+
+class TestGlightServiceStateFile(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, "test.gstate")
+        self.service = glight.GlightService(state_file=self.state_file, save_delay=0.05,
+                                            registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+
+    def tearDown(self):
+        self.service.flush_state()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+        os.rmdir(self.directory)
+
+    def _wait_for_write(self, writes):
+        for i in range(100):
+            if self.service.state_writes + self.service.state_writes_skipped >= writes:
+                return
+            glight.sleep(0.01)
+        self.fail("State file was not written")
+
+    def test_saves_are_written_behind_once(self):
+        self.service.set_colors("g213", ["ff0000"])
+        for i in range(5):
+            self.service.save_state()
+        self.assertFalse(os.path.exists(self.state_file))
+
+        self._wait_for_write(1)
+        self.assertEqual(1, self.service.state_writes)
+        with open(self.state_file) as fh:
+            self.assertEqual("ff0000", json.load(fh)["g213"]["colors"][0])
+        self.assertEqual(["test.gstate"], os.listdir(self.directory))
+
+    def test_unchanged_state_is_not_written_again(self):
+        self.service.save_state()
+        self.service.flush_state()
+        os.chmod(self.state_file, 0o600)
+        modified = os.stat(self.state_file).st_mtime
+
+        self.service.save_state()
+        self.service.flush_state()
+        self.assertEqual(1, self.service.state_writes)
+        self.assertEqual(1, self.service.state_writes_skipped)
+        self.assertEqual(modified, os.stat(self.state_file).st_mtime)
+
+        self.service.set_cycle("g213", 2000, -1)
+        self.service.save_state()
+        self.service.flush_state()
+        self.assertEqual(2, self.service.state_writes)
+        self.assertEqual(0o600, os.stat(self.state_file).st_mode & 0o777)
+
+    def test_failed_write_stays_pending(self):
+        signals = []
+        self.service.emit_signal_idle = lambda name, *args: signals.append((name,) + args)
+        self.service.state_file = os.path.join(self.directory, "missing", "test.gstate")
+        self.service.save_state()
+        self.service.flush_state(retry=False)
+
+        state_file = self.service.collect_stats()["state_file"]
+        self.assertEqual(1, state_file["failed"])
+        self.assertIsNotNone(state_file["last_error"])
+        self.assertTrue(state_file["dirty"])
+        self.assertEqual(["StateSaveFailed"], [signal[0] for signal in signals])
+
+        self.service.state_file = self.state_file
+        self.service.flush_state()
+        self.assertEqual(1, self.service.state_writes)
+        self.assertIsNone(self.service.collect_stats()["state_file"]["last_error"])
+
+    def test_failed_write_leaves_no_temp_file(self):
+        def fail(fd, mode):
+            raise OSError("fchmod failed")
+
+        open_fds = len(os.listdir("/proc/self/fd"))
+        fchmod = glight.os.fchmod
+        glight.os.fchmod = fail
+        try:
+            with self.assertRaises(OSError):
+                self.service.device_registry.write_state_of_devices(self.state_file)
+        finally:
+            glight.os.fchmod = fchmod
+        self.assertEqual([], os.listdir(self.directory))
+        self.assertEqual(open_fds, len(os.listdir("/proc/self/fd")))
+
+
+class TestGFrameSocket(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.service = glight.GlightService(registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+        self.path = os.path.join(tempfile.mkdtemp(), "frames.sock")
+        self.server = glight.GFrameSocketServer(self.service, self.path, credits=2)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.service.stop_command_queues()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+        os.rmdir(os.path.dirname(self.path))
+
+    def test_frames_are_acknowledged(self):
+        controller = glight.GlightController(glight.GlightController.BACKEND_SOCKET, frame_socket=self.path)
+        try:
+            self.assertIn("g213", controller.list_devices())
+            controller.set_colors("g213", ["ff0000", "00ff00"])
+            controller.set_color_at("g203", "0000ff")
+            with self.assertRaises(glight.GControllerException):
+                controller.set_breathe("g213", "ff0000", 1000)
+        finally:
+            controller.close()
+
+        self.assertEqual(2, controller.get_stats()["frame_socket"]["sent"])
+        self.assertEqual(["ff0000", "00ff00"], self.service.device_registry.get_known_device("g213").device_state.colors[1:3])
+        self.assertEqual("0000ff", self.service.device_registry.get_known_device("g203").device_state.colors[0])
+
+    def test_credits_limit_the_frames_in_flight(self):
+        device = self.service.device_registry.get_known_device("g213")
+        glight.UsbSimBus.get_device(device.id_vendor, device.id_product).configure(latency=0.01)
+        client = glight.GFrameSocketClient(self.path)
+        client.connect()
+        try:
+            colors = ["{:02x}0000".format(i) for i in range(20)]
+            for color in colors:
+                client.send_frame("g213", [color])
+                self.assertLessEqual(client.in_flight, 2)
+            client.flush()
+        finally:
+            client.close()
+
+        stats = client.get_stats()
+        self.assertEqual(20, stats["sent"] + stats["superseded"])
+        self.assertEqual(0, stats["rejected"] + stats["failed"])
+        self.assertEqual(colors[-1], device.device_state.colors[0])
+
+    def test_other_users_are_refused(self):
+        self.server.allowed_uids = set()
+        client = glight.GFrameSocketClient(self.path)
+        with self.assertRaises(glight.GControllerException):
+            client.connect()
+        self.assertEqual(1, self.server.get_stats()["refused"])
+
+    def test_device_attached_later_is_addressable(self):
+        device = self.service.device_registry.get_known_device("g213")
+        sim_device = glight.UsbSimBus.get_device(device.id_vendor, device.id_product)
+        sim_device.present = False
+        self.service.device_registry.rescan()
+
+        client = glight.GFrameSocketClient(self.path)
+        client.connect()
+        try:
+            self.assertIn("g213", client.device_ids)
+            sim_device.present = True
+            self.service.device_registry.rescan()
+            client.send_frame("g213", ["ff0000"])
+            client.flush()
+        finally:
+            client.close()
+
+        self.assertEqual(1, client.get_stats()["sent"])
+        self.assertEqual("ff0000", device.device_state.colors[0])
+
+    def test_socket_in_use_is_not_taken_over(self):
+        server = glight.GFrameSocketServer(self.service, self.path)
+        with self.assertRaises(glight.GControllerException):
+            server.start()
+        client = glight.GFrameSocketClient(self.path)
+        client.connect()
+        client.close()
+
+
+class TestGFrameBuffer(unittest.TestCase):
+
+    def setUp(self):
+        glight.UsbSimBus.reset()
+        self.service = glight.GlightService(registry_options={"backend_type": glight.UsbBackend.TYPE_SIM})
+        self.directory = tempfile.mkdtemp()
+        self.sampler = glight.GFrameBufferSampler(self.service, self.directory)
+        self.sampler.start()
+        self.producer = glight.GFrameBufferProducer(self.directory)
+
+    def tearDown(self):
+        self.producer.close()
+        self.sampler.stop()
+        self.service.stop_command_queues()
+        self.service.release_all_sessions()
+        self.service.device_registry.close()
+        os.rmdir(self.directory)
+
+    def _sample(self):
+        self.sampler.sample()
+        self.assertTrue(self.service.wait_for_command_queues(timeout=5.0))
+
+    def test_latest_frame_is_sampled(self):
+        for color in ["ff0000", "00ff00", "0000ff"]:
+            self.producer.set_colors("g213", [color, "ffffff"])
+        self._sample()
+        self._sample()
+
+        self.assertEqual(1, self.sampler.get_stats()["frames"])
+        self.assertEqual(["0000ff", "ffffff"], self.service.device_registry.get_known_device("g213").device_state.colors[1:3])
+
+    def test_frame_being_written_is_skipped(self):
+        self.producer.set_colors("g203", ["ff0000"])
+        buffer = self.sampler.buffers["g203"]
+        seq = buffer.get_seq()
+        # the writer is halfway through the next frame
+        glight.struct.pack_into(glight.GFrameBuffer.SEQ_FORMAT, buffer.map, glight.GFrameBuffer.SEQ_OFFSET, seq + 1)
+        self._sample()
+        self.assertEqual(0, self.sampler.get_stats()["frames"])
+
+        glight.struct.pack_into(glight.GFrameBuffer.SEQ_FORMAT, buffer.map, glight.GFrameBuffer.SEQ_OFFSET, seq + 2)
+        self._sample()
+        self.assertEqual("ff0000", self.service.device_registry.get_known_device("g203").device_state.colors[0])
+
+    def test_unknown_buffer_is_reported(self):
+        with self.assertRaises(glight.GControllerException):
+            self.producer.set_colors("g999", ["ff0000"])
+
+    def test_planted_link_is_not_followed(self):
+        target = os.path.join(self.directory, "target")
+        with open(target, "w") as f:
+            f.write("keep")
+        path = os.path.join(self.directory, "glight-g999")
+        os.symlink(target, path)
+
+        buffer = glight.GFrameBuffer(path, 6, gid=os.getgid())
+        try:
+            self.assertFalse(os.path.islink(path))
+            self.assertEqual(0o660, os.stat(path).st_mode & 0o777)
+        finally:
+            buffer.close()
+            os.remove(path)
+        with open(target) as f:
+            self.assertEqual("keep", f.read())
+        os.remove(target)
+
+    def test_sample_rate_is_checked(self):
+        with self.assertRaises(glight.GControllerException):
+            glight.GFrameBufferSampler(self.service, self.directory, rate=0)
+        with self.assertRaises(glight.GControllerException):
+            glight.GFrameBufferSampler(self.service, self.directory, rate=-30)
+
+
+class TestGTraceReplay(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.trace_file = tempfile.mkstemp(suffix=".trace")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.trace_file)
+
+    def _sent_packets(self, registry):
+        device = registry.get_known_device("g213")
+        sim_device = glight.UsbSimBus.get_device(device.id_vendor, device.id_product)
+        return [packet[4] for packet in sim_device.packets]
+
+    def test_replay_sends_the_captured_packets(self):
+        glight.UsbSimBus.reset()
+        controller = glight.GlightController(
+            glight.GlightController.BACKEND_LOCAL,
+            registry_options={"backend_type": glight.UsbBackend.TYPE_SIM, "trace_file": self.trace_file})
+        controller.set_colors("g213", ["ff0000", "00ff00", "0000ff"])
+        controller.set_breathe("g213", "00ff00", 2000, 80)
+        captured = self._sent_packets(controller.device_registry)
+        controller.close()
+
+        records = list(glight.UsbTraceWriter.read(self.trace_file))
+        kinds = [record.kind for record in records]
+        self.assertEqual(len(captured), kinds.count(glight.UsbTraceRecord.KIND_PACKET))
+        self.assertEqual(len(captured), kinds.count(glight.UsbTraceRecord.KIND_ACK))
+
+        glight.UsbSimBus.reset()
+        registry = glight.GDeviceRegistry(backend_type=glight.UsbBackend.TYPE_SIM)
+        try:
+            report = glight.GTraceReplay(registry, speed=0).run(self.trace_file)
+            self.assertEqual(2, report["batches"])
+            self.assertEqual(0, report["failed"])
+            self.assertEqual(captured, self._sent_packets(registry))
+        finally:
+            registry.close()
+
+    def test_replay_clock_starts_once_connected(self):
+        glight.UsbSimBus.reset()
+        controller = glight.GlightController(
+            glight.GlightController.BACKEND_LOCAL,
+            registry_options={"backend_type": glight.UsbBackend.TYPE_SIM, "trace_file": self.trace_file})
+        controller.set_colors("g213", ["ff0000", "00ff00"])
+        glight.sleep(0.2)
+        controller.set_breathe("g213", "00ff00", 2000, 80)
+        controller.close()
+
+        glight.UsbSimBus.reset()
+        registry = glight.GDeviceRegistry(backend_type=glight.UsbBackend.TYPE_SIM)
+        device = registry.get_known_device("g213")
+        connect = device.connect
+
+        def slow_connect():
+            glight.sleep(0.3)
+            connect()
+
+        device.connect = slow_connect
+        try:
+            glight.GTraceReplay(registry, speed=1.0).run(self.trace_file)
+            sim_device = glight.UsbSimBus.get_device(device.id_vendor, device.id_product)
+            timestamps = [packet[0] for packet in sim_device.packets]
+            self.assertGreaterEqual(timestamps[3] - timestamps[0], 0.15)
+        finally:
+            registry.close()
+
+
+class TestUsbBackendHidraw(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = glight.GlightController(
+            glight.GlightController.BACKEND_LOCAL,
+            registry_options={"backend_type": glight.UsbBackend.TYPE_HIDRAW})
+        self.device = self.controller.device_registry.get_known_device("g213")
+        self.key = (self.device.id_vendor, self.device.id_product)
+        self.device.ack_timeout = 0.05
+
+    def tearDown(self):
+        self.controller.close()
+        glight.UsbBackendHidraw.device_paths.pop(self.key, None)
+
+    def test_reports_are_written_to_node(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            glight.UsbBackendHidraw.device_paths[self.key] = path
+            self.controller.set_color_at("g213", "ff00ff", 0)
+            self.controller.close()
+            with open(path, "rb") as node:
+                written = binascii.hexlify(node.read()).decode("ascii")
+            self.assertEqual(80, len(written))
+            self.assertTrue(written.startswith(self.device.cmd_prepare))
+            self.assertIn("ff00ff", written[40:])
+            self.assertEqual(2, self.device.get_ack_stats()["timeouts"])
+        finally:
+            os.remove(path)
+
+    def test_acks_are_read_from_node(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        responder = threading.Thread(target=self._respond, args=(master, 2))
+        responder.start()
+        try:
+            glight.UsbBackendHidraw.device_paths[self.key] = os.ttyname(slave)
+            self.controller.set_color_at("g213", "00ff00", 0)
+            responder.join(2)
+            self.assertEqual(2, self.device.get_ack_stats()["acks"])
+        finally:
+            self.controller.close()
+            os.close(slave)
+            os.close(master)
+
+    def test_dead_node_is_closed_and_reopened(self):
+        master, slave = pty.openpty()
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            glight.UsbBackendHidraw.device_paths[self.key] = os.ttyname(slave)
+            self.assertIn("g213", self.controller.list_devices())
+            self.device.connect()
+            os.close(master)  # writes to the open node fail like those to an unplugged device
+            with self.assertRaises(glight.GDeviceException):
+                self.controller.set_color_at("g213", "00ff00", 0)
+            self.assertIsNone(self.device.backend.fd)
+
+            glight.UsbBackendHidraw.device_paths[self.key] = path
+            self.controller.set_color_at("g213", "00ff00", 0)
+            self.assertEqual(path, self.device.backend.device_path)
+        finally:
+            self.controller.close()
+            os.close(slave)
+            os.remove(path)
+
+    def _respond(self, fd, count):
+        report_size = len(self.device.cmd_prepare) // 2
+        received = b""
+        while count > 0:
+            received += os.read(fd, 64)
+            while len(received) >= report_size and count > 0:
+                os.write(fd, b"\x11" + received[1:report_size])
+                received = received[report_size:]
+                count -= 1
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file